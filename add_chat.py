@@ -5,6 +5,8 @@ from aiogram.filters import Command
 from aiogram import Router
 from config import config
 from db import db
+from rank_cache import rank_cache
+from chat_profiles import chat_profiles
 from datetime import datetime
 
 router = Router()
@@ -16,7 +18,7 @@ async def add_chat_to_db(message: Message):
     chat_title = message.chat.title or "Личный чат"
     
     # Проверяем, является ли пользователь суперадмином
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     if user_rank != 'superadmin':
         await message.reply("❌ <b>Доступ запрещен!</b> Только суперадмины могут добавлять чаты.", parse_mode="HTML")
         return
@@ -29,11 +31,7 @@ async def add_chat_to_db(message: Message):
         if db.pool is None:
             await message.reply("❌ <b>Ошибка:</b> Нет подключения к базе данных.", parse_mode="HTML")
             return
-        pool = db.pool
-        existing_chat = await pool.fetchrow(
-            'SELECT * FROM "VSEPExchanger"."user" WHERE id = $1',
-            chat_id
-        )
+        existing_chat = await db.get_user_by_id(chat_id)
         
         if existing_chat:
             response = f"⚠️ <b>Чат уже существует в базе данных!</b>\n\n"
@@ -78,7 +76,7 @@ async def add_chat_tct(message: Message):
 async def add_chat_with_type(message: Message, chat_type: str):
     """Общая функция для добавления чата с указанным типом"""
     # Проверяем, является ли пользователь суперадмином
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     if user_rank != 'superadmin':
         await message.reply("❌ <b>Доступ запрещен!</b> Только суперадмины могут добавлять чаты.", parse_mode="HTML")
         return
@@ -102,26 +100,17 @@ async def add_chat_with_type(message: Message, chat_type: str):
         if db.pool is None:
             await message.reply("❌ <b>Ошибка:</b> Нет подключения к базе данных.", parse_mode="HTML")
             return
-        pool = db.pool
-        existing_chat = await pool.fetchrow(
-            'SELECT * FROM "VSEPExchanger"."user" WHERE id = $1',
-            chat_id
-        )
+        existing_chat = await db.get_user_by_id(chat_id)
         
         if existing_chat:
             # Обновляем существующий чат
-            await pool.execute(
-                'UPDATE "VSEPExchanger"."user" SET nickneim = $1, rang = $2, updated_at = $3 WHERE id = $4',
-                nickneim, 'group', datetime.now(), chat_id
-            )
+            await db.update_group_chat(chat_id, nickneim, datetime.now())
             action = "обновлен"
         else:
             # Добавляем новый чат
-            await pool.execute(
-                'INSERT INTO "VSEPExchanger"."user" (id, nickneim, rang, created_at, updated_at) VALUES ($1, $2, $3, $4, $5)',
-                chat_id, nickneim, 'group', datetime.now(), datetime.now()
-            )
+            await db.insert_group_chat(chat_id, nickneim, datetime.now())
             action = "добавлен"
+        chat_profiles.invalidate()
         
         response = f"✅ <b>Чат успешно {action}!</b>\n\n"
         response += f"🆔 <b>ID чата:</b> <code>{chat_id}</code>\n"
@@ -144,7 +133,7 @@ async def add_chat_with_type(message: Message, chat_type: str):
 async def update_chat(message: Message):
     """Обновление существующего чата"""
     # Проверяем, является ли пользователь суперадмином
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     if user_rank != 'superadmin':
         await message.reply("❌ <b>Доступ запрещен!</b> Только суперадмины могут обновлять чаты.", parse_mode="HTML")
         return
@@ -172,13 +161,10 @@ async def update_chat(message: Message):
         if db.pool is None:
             await message.reply("❌ <b>Ошибка:</b> Нет подключения к базе данных.", parse_mode="HTML")
             return
-        pool = db.pool
-        result = await pool.execute(
-            'UPDATE "VSEPExchanger"."user" SET nickneim = $1, updated_at = $2 WHERE id = $3',
-            nickneim, datetime.now(), chat_id
-        )
+        updated = await db.rename_chat(chat_id, nickneim, datetime.now())
         
-        if result == "UPDATE 1":
+        if updated:
+            chat_profiles.invalidate()
             response = f"✅ <b>Чат успешно обновлен!</b>\n\n"
             response += f"🆔 <b>ID чата:</b> <code>{chat_id}</code>\n"
             response += f"👤 <b>Новый nickneim:</b> <code>{nickneim}</code>\n"
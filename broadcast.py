@@ -0,0 +1,162 @@
+"""
+🟤 Рассылка по множеству чатов
+==============================
+Отправляет одно сообщение во многие чаты параллельно, не выходя за лимиты Telegram:
+не более BROADCAST_CONCURRENCY одновременных запросов, не более BROADCAST_GLOBAL_RATE
+сообщений в секунду на бота и не чаще одного сообщения в BROADCAST_CHAT_INTERVAL секунд в один чат.
+На TelegramRetryAfter рассылка ставится на паузу на указанное Telegram время и сообщение повторяется.
+Итог по каждому получателю можно отправить в админскую группу через report_broadcast.
+"""
+import asyncio
+import html
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+
+from logger import log_system, log_warning
+from messages import send_to_admin_group_safe
+
+BROADCAST_CONCURRENCY = 10       # одновременных запросов к Telegram
+BROADCAST_GLOBAL_RATE = 25       # сообщений в секунду на бота (лимит Telegram — около 30)
+BROADCAST_CHAT_INTERVAL = 1.0    # минимальный интервал между сообщениями в один чат, сек
+BROADCAST_MAX_ATTEMPTS = 3       # попыток на получателя (RetryAfter и сетевые ошибки)
+BROADCAST_REPORT_LIMIT = 50      # сколько получателей перечислять в отчёте
+
+ChatId = Union[int, str]
+
+
+@dataclass
+class BroadcastResult:
+    """Итог отправки одному получателю"""
+    chat_id: ChatId
+    label: str
+    ok: bool
+    attempts: int
+    error: Optional[str] = None
+
+
+class Broadcaster:
+
+    def __init__(
+        self,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        rate: float = BROADCAST_GLOBAL_RATE,
+        chat_interval: float = BROADCAST_CHAT_INTERVAL,
+        max_attempts: int = BROADCAST_MAX_ATTEMPTS,
+    ):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._slot_lock = asyncio.Lock()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._chat_next: Dict[str, float] = {}
+
+    async def _wait_slot(self, chat_id: ChatId):
+        """Ждёт свободного окна с учётом общего лимита, лимита чата и паузы после RetryAfter"""
+        loop = asyncio.get_running_loop()
+        key = str(chat_id)
+        while True:
+            async with self._slot_lock:
+                now = loop.time()
+                slot = max(now, self._next_slot, self._paused_until, self._chat_next.get(key, 0.0))
+                self._next_slot = slot + 1.0 / self.rate
+                self._chat_next[key] = slot + self.chat_interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пока ждали, Telegram мог попросить паузу — тогда занимаем новое окно
+            if loop.time() >= self._paused_until:
+                return
+
+    def _pause(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    def _prune(self):
+        """Забывает чаты, для которых ограничение уже истекло"""
+        now = asyncio.get_running_loop().time()
+        self._chat_next = {key: t for key, t in self._chat_next.items() if t > now}
+
+    async def _send_one(self, chat_id: ChatId, label: str, send: Callable[[ChatId], Awaitable]) -> BroadcastResult:
+        attempts = 0
+        error = None
+        async with self._semaphore:
+            while attempts < self.max_attempts:
+                attempts += 1
+                await self._wait_slot(chat_id)
+                try:
+                    await send(chat_id)
+                    return BroadcastResult(chat_id, label, True, attempts)
+                except TelegramRetryAfter as e:
+                    error = f"flood control, retry after {e.retry_after}s"
+                    log_warning(f"Broadcast: Telegram просит паузу {e.retry_after} сек (чат {chat_id})")
+                    self._pause(e.retry_after)
+                except TelegramNetworkError as e:
+                    error = str(e)
+                    log_warning(f"Broadcast: сетевая ошибка при отправке в {chat_id}, попытка {attempts}: {e}")
+                    await asyncio.sleep(attempts)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    # Бот удалён из чата, чат не найден и т.п. — повтор не поможет
+                    return BroadcastResult(chat_id, label, False, attempts, str(e))
+                except Exception as e:
+                    return BroadcastResult(chat_id, label, False, attempts, str(e))
+        return BroadcastResult(chat_id, label, False, attempts, error)
+
+    async def broadcast(
+        self,
+        title: str,
+        recipients: Iterable[Tuple[ChatId, str]],
+        send: Callable[[ChatId], Awaitable],
+    ) -> List[BroadcastResult]:
+        """
+        Рассылает сообщение получателям (chat_id, подпись для отчёта).
+        send(chat_id) — корутина отправки одному получателю.
+        Возвращает итоги в порядке recipients.
+        """
+        recipients = list(recipients)
+        if not recipients:
+            return []
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await asyncio.gather(*(self._send_one(chat_id, label, send) for chat_id, label in recipients))
+        self._prune()
+        delivered = sum(1 for result in results if result.ok)
+        log_system(
+            f"Broadcast «{title}»: доставлено {delivered} из {len(results)} за {loop.time() - started:.1f} сек"
+        )
+        for result in results:
+            if not result.ok:
+                log_warning(f"Broadcast «{title}»: не доставлено в {result.chat_id} ({result.label}): {result.error}")
+        return list(results)
+
+
+def format_broadcast_report(title: str, results: List[BroadcastResult]) -> str:
+    """Отчёт о рассылке для админской группы: сводка и итог по каждому получателю"""
+    delivered = [result for result in results if result.ok]
+    failed = [result for result in results if not result.ok]
+    lines = [f"📣 <b>Рассылка «{html.escape(title)}»</b>: доставлено {len(delivered)} из {len(results)}"]
+    # Сначала недоставленные — именно они требуют внимания
+    for result in (failed + delivered)[:BROADCAST_REPORT_LIMIT]:
+        label = html.escape(result.label or str(result.chat_id))
+        if result.ok:
+            retry_note = f" (попыток: {result.attempts})" if result.attempts > 1 else ""
+            lines.append(f"✅ {label}{retry_note}")
+        else:
+            lines.append(f"❌ {label} <code>{result.chat_id}</code>: {html.escape(result.error or 'неизвестная ошибка')}")
+    if len(results) > BROADCAST_REPORT_LIMIT:
+        lines.append(f"… и ещё {len(results) - BROADCAST_REPORT_LIMIT}")
+    return "\n".join(lines)
+
+
+async def report_broadcast(bot, title: str, results: List[BroadcastResult]):
+    """Отправляет итог рассылки в админскую группу"""
+    if not results:
+        return
+    await send_to_admin_group_safe(bot, format_broadcast_report(title, results))
+
+
+# Глобальный рассыльщик: общие лимиты на все рассылки бота
+broadcaster = Broadcaster()
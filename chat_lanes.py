@@ -0,0 +1,107 @@
+"""
+🟤 Последовательная обработка обновлений по чатам
+=================================================
+Outer-middleware на dp.update: у каждого чата своя очередь (lane) — обновления одного чата
+обрабатываются строго по порядку поступления, разные чаты — параллельно.
+Общее число одновременно выполняемых обработчиков ограничено MAX_CONCURRENT_UPDATES;
+слот занимается только когда подошла очередь чата, поэтому долгий /transfer или /control
+в одном чате не держит слоты за ожидающими обновлениями этого же чата.
+Middleware стоит перед FSM (main.py), чтобы состояние читалось уже после предыдущего
+обновления чата. Метрики очередей — snapshot() и команда /lanes.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from config import config
+from logger import log_warning
+
+LANE_DEPTH_WARNING = 20     # при такой глубине очереди чата пишем предупреждение в лог
+
+
+class _Lane:
+    """Очередь одного чата: FIFO-замок и число обновлений в ней (ожидающие + выполняющееся)"""
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class ChatLanes(BaseMiddleware):
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._lanes: Dict[int, _Lane] = {}
+        self.in_flight = 0
+        self.processed = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def _lane_key(data: Dict[str, Any]) -> Optional[int]:
+        # event_chat / event_from_user выставляет UserContextMiddleware aiogram до нашего middleware
+        chat = data.get("event_chat")
+        if chat is not None:
+            return chat.id
+        user = data.get("event_from_user")
+        return user.id if user is not None else None
+
+    async def _run(self, handler, event, data):
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        key = self._lane_key(data)
+        if key is None:
+            return await self._run(handler, event, data)
+
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane()
+        lane.depth += 1
+        if lane.depth > self.max_depth:
+            self.max_depth = lane.depth
+        if lane.depth == LANE_DEPTH_WARNING:
+            log_warning(f"ChatLanes: в очереди чата {key} накопилось обновлений: {lane.depth}")
+        queued_at = time.monotonic()
+        try:
+            async with lane.lock:
+                self.max_wait = max(self.max_wait, time.monotonic() - queued_at)
+                return await self._run(handler, event, data)
+        finally:
+            lane.depth -= 1
+            if lane.depth == 0:
+                self._lanes.pop(key, None)
+
+    def snapshot(self, top: int = 5) -> Dict[str, Any]:
+        """Метрики: активные очереди, ожидающие обновления, занятые слоты, самые длинные очереди"""
+        busiest = sorted(self._lanes.items(), key=lambda item: item[1].depth, reverse=True)[:top]
+        return {
+            "lanes": len(self._lanes),
+            "queued": sum(lane.depth - lane.lock.locked() for lane in self._lanes.values()),
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "processed": self.processed,
+            "max_depth": self.max_depth,
+            "max_wait": round(self.max_wait, 3),
+            "busiest": [(chat_id, lane.depth) for chat_id, lane in busiest],
+        }
+
+
+# Глобальный планировщик очередей обновлений по чатам
+chat_lanes = ChatLanes(config.MAX_CONCURRENT_UPDATES)
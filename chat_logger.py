@@ -1,14 +1,15 @@
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
-import pytz
 import os
-from messages import get_bali_and_msk_time_list
-from logger import log_user, LogCategory
+from time_utils import clock
+from logger import logger, log_warning, LogCategory
 
 def get_time_str():
     """Получить строку с временем в формате Бали/МСК"""
-    times = get_bali_and_msk_time_list()
-    return f"{times[6]} (Bali) / {times[5]} (MSK)"
+    return clock.bali_msk_str()
 
 # Определяем путь к файлу лога в директории бота
 BOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -26,10 +27,63 @@ if not os.path.exists(LOG_FILE):
     with open(LOG_FILE, "w", encoding="utf-8") as f:
         f.write("--- Лог истории чатов ---\n")
 
+# Максимум событий в очереди; при переполнении новые события отбрасываются и считаются
+CHAT_LOG_QUEUE_SIZE = 10000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler, который не блокирует event loop: при полной очереди событие отбрасывается"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log_warning(f"chat_history: очередь логирования переполнена, отброшено событий: {self.dropped}")
+
+
+class BotLogForwardHandler(logging.Handler):
+    """Пересылает уже отформатированное событие в основной лог (bot.log + stdout) из потока слушателя"""
+
+    def emit(self, record):
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
 file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
 file_formatter = logging.Formatter("%(message)s")
 file_handler.setFormatter(file_formatter)
-chat_logger.addHandler(file_handler)
+
+# Запись на диск идёт в отдельном потоке QueueListener, обработчики событий только кладут запись в очередь
+chat_log_queue = queue.Queue(maxsize=CHAT_LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(chat_log_queue)
+chat_logger.addHandler(queue_handler)
+chat_logger.propagate = False
+
+chat_log_listener = QueueListener(chat_log_queue, file_handler, BotLogForwardHandler(), respect_handler_level=True)
+chat_log_listener.start()
+
+
+def stop_chat_logger():
+    """Дописывает очередь и останавливает поток записи истории чатов"""
+    global chat_log_listener
+    if chat_log_listener is not None:
+        chat_log_listener.stop()
+        chat_log_listener = None
+        file_handler.close()
+
+
+def get_dropped_count() -> int:
+    """Сколько событий истории чатов отброшено из-за переполнения очереди"""
+    return queue_handler.dropped
+
+
+atexit.register(stop_chat_logger)
 
 def log_message(event_type, chat, user, text=None, old_text=None, new_text=None, file_type=None, file_id=None):
     """Логирование сообщений в чате"""
@@ -71,8 +125,5 @@ def log_message(event_type, chat, user, text=None, old_text=None, new_text=None,
     else:
         msg = f"[{time_str}] {emoji} {chat_info} {user_info} событие: {event_type}\n"
     
-    # Логируем в файл истории чатов
-    chat_logger.info(msg)
-    
-    # Логируем в основной лог с категорией USER
-    log_user(msg) 
\ No newline at end of file
+    # Одна запись уходит и в chat_history.log, и в основной лог с категорией USER
+    chat_logger.info(msg, extra={'category': LogCategory.USER}) 
\ No newline at end of file
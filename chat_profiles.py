@@ -0,0 +1,113 @@
+"""
+🟢 Кэш профилей рабочих чатов
+=============================
+Профиль чата собирается из записи "VSEPExchanger"."user" с rang='group':
+nickneim вида "MBT_Компания" даёт префикс, название компании, лист Google Sheets и слот медиа.
+Все группы загружаются одним запросом, кэш сбрасывается при изменении чатов (/add_chat, /update_chat, смена ранга).
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from config import system_settings
+from db import db
+from logger import log_system, log_error
+
+# Страховочное перечитывание групп из БД, если кэш никто не сбросил
+CHAT_PROFILES_TTL = 300
+
+# Префикс nickneim -> атрибут system_settings с медиа для суммы
+MEDIA_SLOTS = {
+    "MBT": "media_mbt",
+    "LGI": "media_lgi",
+    "TCT": "media_tct",
+}
+
+
+@dataclass(frozen=True)
+class ChatProfile:
+    chat_id: int
+    nickneim: str
+    prefix: str
+    company_name: str
+    worksheet_name: str
+    media_slot: Optional[str]
+
+    @property
+    def nick3(self) -> str:
+        """Трёхбуквенный код чата для номера заявки"""
+        return self.nickneim[:3].upper() if self.nickneim else "NON"
+
+    @property
+    def media(self) -> Optional[Dict[str, str]]:
+        """Текущее медиа для суммы — берётся из system_settings, чтобы /set_media_* действовали сразу"""
+        return getattr(system_settings, self.media_slot) if self.media_slot else None
+
+    @classmethod
+    def from_nickneim(cls, chat_id: int, nickneim: str) -> "ChatProfile":
+        prefix = nickneim.split('_')[0]
+        if '_' in nickneim:
+            company_name = nickneim.split('_', 1)[1].strip()
+        else:
+            company_name = nickneim.strip()
+        return cls(
+            chat_id=chat_id,
+            nickneim=nickneim,
+            prefix=prefix,
+            company_name=company_name,
+            worksheet_name=f"VSEP_{prefix}",
+            media_slot=MEDIA_SLOTS.get(nickneim[:3].upper()),
+        )
+
+
+class ChatProfileCache:
+    """Профили всех групп в памяти; отсутствие чата в загруженном наборе означает, что это не рабочая группа"""
+
+    def __init__(self, ttl: float = CHAT_PROFILES_TTL):
+        self.ttl = ttl
+        self._profiles: Optional[Dict[int, ChatProfile]] = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> bool:
+        """Загружает все группы одним запросом"""
+        async with self._lock:
+            return await self._load()
+
+    async def _load(self) -> bool:
+        try:
+            rows = await db.get_group_chats()
+        except Exception as e:
+            log_error(f"ChatProfileCache: ошибка загрузки групп: {e}")
+            return False
+        if rows is None:
+            return False
+        self._profiles = {
+            row['id']: ChatProfile.from_nickneim(row['id'], row['nickneim'])
+            for row in rows if row['nickneim']
+        }
+        self._loaded_at = time.monotonic()
+        log_system(f"ChatProfileCache: загружено профилей чатов: {len(self._profiles)}")
+        return True
+
+    def _is_fresh(self) -> bool:
+        return self._profiles is not None and time.monotonic() - self._loaded_at <= self.ttl
+
+    async def get(self, chat_id: int) -> Optional[ChatProfile]:
+        """Профиль чата или None, если чат не зарегистрирован как группа"""
+        if not self._is_fresh():
+            async with self._lock:
+                if not self._is_fresh():
+                    await self._load()
+        if self._profiles is None:
+            return None
+        return self._profiles.get(int(chat_id))
+
+    def invalidate(self):
+        """Сбрасывает кэш — следующий get() перечитает группы из БД"""
+        self._profiles = None
+
+
+# Глобальный экземпляр кэша профилей чатов
+chat_profiles = ChatProfileCache()
@@ -19,10 +19,7 @@ async def check_chat_info(message: Message):
     
     try:
         # Проверяем, есть ли чат в базе данных
-        chat_info = await db.pool.fetchrow(
-            'SELECT * FROM "VSEPExchanger"."user" WHERE id = $1',
-            chat_id
-        )
+        chat_info = await db.get_user_by_id(chat_id)
         
         response = f"📋 <b>Информация о чате:</b>\n\n"
         response += f"🆔 <b>ID чата:</b> <code>{chat_id}</code>\n"
@@ -12,10 +12,12 @@ from aiogram.filters import Command
 
 from config import config
 from db import db
+from transactions import TransactionEvent
+from rank_cache import rank_cache
 from permissions import is_operator_or_admin
-from messages import get_bali_and_msk_time_list
+from time_utils import clock
 from utils import fmt_0
-from logger import log_func, log_db
+from logger import log_func
 
 router = Router()
 
@@ -55,6 +57,8 @@ async def cmd_accept(message: Message):
     if not transaction:
         await message.reply(f"{base_error}\n🚫 Не выполнено.\nПРИЧИНА: заявка с таким номером не найдена.")
         return
+    # Номер мог быть введён коротким кодом (T2N9) — дальше работаем с полным номером
+    transaction_number = transaction['transaction_number']
 
     if transaction.get('status') not in ("created", "timeout"):
         await message.reply(f"{base_error}\n🚫 Не выполнено.\nПРИЧИНА: это архивная команда. В текщей реальности 'accept' осуществляется кнопкой под запросом.")
@@ -65,13 +69,12 @@ async def cmd_accept(message: Message):
         await message.reply("🚫 Не выполнено.\nПРИЧИНА: не удалось определить пользователя.")
         return
 
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     if user_rank not in ("operator", "admin"):
         await message.reply("🚫 Не выполнено.\nПРИЧИНА: команда доступна только оператору сервиса и администратору.")
         return
 
     user = message.from_user
-    times = get_bali_and_msk_time_list()
     now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
 
     # Извлекаем note из команды /control
@@ -82,7 +85,7 @@ async def cmd_accept(message: Message):
     await db.update_transaction_note(transaction_number, note_from_control)
 
     await db.update_transaction_status(transaction_number, "accept", now_utc)
-    confirm_time = times[6]  # дата+время по Бали
+    confirm_time = clock.bali_datetime()  # дата+время по Бали
     user_username = f"@{user.username}" if user.username else user.full_name
     rub = transaction.get('rub_amount', '-')
     idr = transaction.get('idr_amount', '-')
@@ -113,7 +116,6 @@ async def cmd_accept(message: Message):
     notification_msg_id = notification_msg.message_id
     
     # Добавляем запись в history
-    now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
     user_nick = f"@{user.username}" if user.username else user.full_name
     chat_id = message.chat.id
     msg_id = message.message_id
@@ -142,7 +144,7 @@ async def cmd_accept(message: Message):
     # Данные о сообщении-контроле (reply)
     reply_user = reply.from_user
     reply_nick = f"@{reply_user.username}" if reply_user and reply_user.username else (reply_user.full_name if reply_user else "unknown")
-    reply_date = reply.date.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S") if hasattr(reply, 'date') and reply.date else "unknown"
+    reply_date = reply.date.astimezone(timezone.utc).replace(tzinfo=None) if hasattr(reply, 'date') and reply.date else None
     reply_msg_id = reply.message_id if hasattr(reply, 'message_id') else None
     if message.chat.username and reply_msg_id:
         link_control = f"https://t.me/{message.chat.username}/{reply_msg_id}"
@@ -155,24 +157,16 @@ async def cmd_accept(message: Message):
         link_control = f"https://t.me/c/{chat_id_num}/{reply_msg_id}"
     else:
         link_control = "-"
-    # Формируем две записи
-    control_entry = f"{reply_date}${reply_nick}$контроль${link_control}"
-    accept_entry = f"{now_str}${user_nick}$accept${link_accept}"
-    notification_entry = f"{now_str}${user_nick}$notification${link_notification}"
-    # Получаем старую history
-    old_history = transaction.get('history', '')
-    if old_history:
-        history = old_history + "%%%" + control_entry + "%%%" + accept_entry + "%%%" + notification_entry
-    else:
-        history = control_entry + "%%%" + accept_entry + "%%%" + notification_entry
-    await db.update_transaction_history(transaction_number, history)
+    # Добавляем три события одним запросом: контроль, accept, уведомление
+    await db.add_transaction_events([
+        TransactionEvent(transaction_number, reply_date, reply_nick, "контроль", link_control),
+        TransactionEvent(transaction_number, now_utc, user_nick, "accept", link_accept),
+        TransactionEvent(transaction_number, now_utc, user_nick, "notification", link_notification),
+    ])
     # --- Счетчик контроля ---
-    key = f"{chat_id}_control_counter"
-    counter = await db.get_control_counter(chat_id)
-    if counter > 0:
-        await db.set_control_counter(chat_id, counter - 1)
-        log_func(f"Счетчик контроля для чата {chat_id} (ключ: {key}) уменьшен: {counter} -> {counter-1}")
-        log_db(f"[DB] set_system_setting: {key} = {counter-1}")
+    new_counter = await db.decrement_control_counter(chat_id)
+    if new_counter is not None:
+        log_func(f"Счетчик контроля для чата {chat_id} уменьшен: -> {new_counter}")
     else:
         await message.reply(f'''
         ВНИМАНИЕ!!!
@@ -182,4 +176,4 @@ async def cmd_accept(message: Message):
 <u>Команда принята, подтврждение заявки выполнено.</u>
 
 <blockquote><i>Флаг лишь отмечает, что количество CONTROL меньше количества ACCEPT. Это не является критической ошибкой – однако, рекомендуется проверить корректность всех проведенных ордеров. Если найдете ошибку – обращайтесь к суперадмину для ручной корректировки.</i></blockquote>''')
-        log_func(f"Попытка уменьшить счетчик контроля при нуле для чата {chat_id} (ключ: {key})") 
\ No newline at end of file
+        log_func(f"Попытка уменьшить счетчик контроля при нуле для чата {chat_id}") 
\ No newline at end of file
@@ -2,7 +2,7 @@ from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
 from logger import log_func, log_error
-import aiohttp
+from http_client import http_clients
 import random
 import asyncio
 from typing import Optional
@@ -17,18 +17,18 @@ async def get_meme_from_api() -> Optional[dict]:
         # Используем бесплатный API для мемов
         url = "https://meme-api.com/gimme"
         
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    return {
-                        "title": data.get("title", "Мем"),
-                        "url": data.get("url", ""),
-                        "author": data.get("author", "Неизвестно"),
-                        "subreddit": data.get("subreddit", ""),
-                        "source": "Reddit API"
-                    }
+        session = http_clients.get("web")
+        async with session.get(url) as response:
+            if response.status == 200:
+                data = await response.json()
+                
+                return {
+                    "title": data.get("title", "Мем"),
+                    "url": data.get("url", ""),
+                    "author": data.get("author", "Неизвестно"),
+                    "subreddit": data.get("subreddit", ""),
+                    "source": "Reddit API"
+                }
                         
     except Exception as e:
         log_error(f"Ошибка при получении мема через API: {e}")
@@ -13,9 +13,11 @@ from datetime import datetime, timezone, timedelta
 import traceback
 
 from db import db
+from transactions import format_history_lines
 from logger import logger, log_system, log_user, log_func, log_db, log_warning, log_error
 from permissions import is_admin_or_superadmin, is_superadmin
 from utils import fmt_0
+from order_locks import order_locks, answer_already_processed, ALREADY_IN_PROGRESS_TEXT
 
 # Создаем роутер для команды
 router = Router()
@@ -72,51 +74,8 @@ async def format_order_card(transaction: dict) -> str:
     lines.append(f"\n<b>📝 Примечание:</b> {note}")
     
     # История статусов
-    history = transaction.get('history', '')
-    hist_lines = []
-    if history:
-        events = history.split('%%%')
-        prev_time = None
-        for idx, ev in enumerate(events):
-            # Поддержка $ и & как разделителей
-            if '$' in ev:
-                parts = ev.split('$', 3)
-            else:
-                parts = ev.split('&', 3)
-            
-            if len(parts) < 4:
-                if idx == 0 and ev.strip():
-                    hist_lines.append(f"{ev.strip()} (создано)")
-                continue
-            
-            dt_str, user, status, link = [p.strip() for p in parts]
-            try:
-                dt = datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
-                dt_bali = dt.replace(tzinfo=timezone.utc).astimezone(BALI_TZ)
-            except Exception:
-                dt = None
-                dt_bali = None
-            
-            status_disp = ALL_STATUSES.get(status, status)
-            time_str = dt_bali.strftime("%H:%M") if dt_bali else "--:--"
-            
-            if idx == 0:
-                # Первая строка — дата дд.мм.гг
-                date_str = dt_bali.strftime("%d.%m.%y") if dt_bali else "--.--.--"
-                hist_lines.append(f"{date_str} {status_disp}: {time_str} {user} (<a href='{link}'>link</a>)")
-            else:
-                # Разница во времени с предыдущим статусом
-                if prev_time and dt:
-                    delta = dt - prev_time
-                    total_seconds = int(delta.total_seconds())
-                    hours = total_seconds // 3600
-                    minutes = (total_seconds % 3600) // 60
-                    seconds = total_seconds % 60
-                    delta_str = f"+{hours:02}:{minutes:02}:{seconds:02}"
-                else:
-                    delta_str = "+--:--:--"
-                hist_lines.append(f"{delta_str} {status_disp}: {time_str} {user} (<a href='{link}'>link</a>)")
-            prev_time = dt
+    events = await db.get_transaction_events(order_number)
+    hist_lines = format_history_lines(events, ALL_STATUSES)
     
     if hist_lines:
         lines.append("\n<b>📜 Хронология:</b>")
@@ -192,6 +151,8 @@ async def cmd_order_change(message: Message, state: FSMContext):
             "ПРИЧИНА: заявка с таким номером не найдена."
         )
         return
+    # Номер мог быть введён коротким кодом (T2N9) — дальше работаем с полным номером
+    order_number = transaction['transaction_number']
     
     # Проверка возможности изменения статуса
     current_status = transaction.get('status', '')
@@ -297,6 +258,11 @@ async def order_change_confirm_callback(call: CallbackQuery, state: FSMContext):
     """Обработчик подтверждения изменения статуса"""
     log_user(f"Подтверждено изменение статуса заявки пользователем {call.from_user.id}")
     
+    # Повторное нажатие уже выполненной кнопки — ответ без запросов к БД
+    if order_locks.is_done(call):
+        await answer_already_processed(call)
+        return
+    
     # Получение данных из состояния
     data = await state.get_data()
     order_number = data.get('order_number')
@@ -309,67 +275,79 @@ async def order_change_confirm_callback(call: CallbackQuery, state: FSMContext):
         await call.answer("❌ Это не ваша кнопка!", show_alert=True)
         return
     
-    try:
-        # Обновление статуса в базе данных
-        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
-        await db.update_transaction_status(order_number, new_status, now_utc)
-        
-        # Формирование записи в историю
-        now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
+    async with order_locks.claim(order_number) as claimed:
+        if not claimed:
+            await call.answer(ALREADY_IN_PROGRESS_TEXT, show_alert=True)
+            return
+        try:
+            # Обновление статуса в базе данных
+            now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
         
-        # Формирование ссылки на сообщение
-        chat_id = call.message.chat.id
-        msg_id = call.message.message_id
-        if call.message.chat.username:
-            link = f"https://t.me/{call.message.chat.username}/{msg_id}"
-        else:
-            chat_id_num = str(chat_id)
-            if chat_id_num.startswith('-100'):
-                chat_id_num = chat_id_num[4:]
-            elif chat_id_num.startswith('-'):
-                chat_id_num = chat_id_num[1:]
-            link = f"https://t.me/c/{chat_id_num}/{msg_id}"
+            # Формирование записи в историю
+            now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
         
-        # Добавление записи в историю
-        history_entry = f"{now_str}${user_nick} сменил статус${new_status}${link}"
-        
-        # Получение текущей истории и добавление новой записи
-        transaction = await db.get_transaction_by_number(order_number)
-        old_history = transaction.get('history', '') if transaction else ''
-        new_history = old_history + "%%%" + history_entry if old_history else history_entry
+            # Формирование ссылки на сообщение
+            chat_id = call.message.chat.id
+            msg_id = call.message.message_id
+            if call.message.chat.username:
+                link = f"https://t.me/{call.message.chat.username}/{msg_id}"
+            else:
+                chat_id_num = str(chat_id)
+                if chat_id_num.startswith('-100'):
+                    chat_id_num = chat_id_num[4:]
+                elif chat_id_num.startswith('-'):
+                    chat_id_num = chat_id_num[1:]
+                link = f"https://t.me/c/{chat_id_num}/{msg_id}"
         
-        await db.update_transaction_history(order_number, new_history)
+            # Статус и запись в историю — только если заявка всё ещё в статусе, показанном в карточке
+            updated = await db.transition_transaction(
+                order_number, current_status, new_status, now_utc, f"{user_nick} сменил статус", new_status, link
+            )
+            if updated is None:
+                transaction = await db.get_transaction_by_number(order_number)
+                actual_status = transaction.get('status') if transaction else None
+                order_locks.mark_done(call)
+                await call.message.edit_text(
+                    f"⚠️ <b>СТАТУС НЕ ИЗМЕНЕН</b>\n\n"
+                    f"Заявка <code>{order_number}</code> уже обработана: текущий статус "
+                    f"<b>{ALL_STATUSES.get(actual_status, actual_status)}</b>.",
+                    parse_mode="HTML"
+                )
+                await answer_already_processed(call, actual_status)
+                await state.clear()
+                return
         
-        # Формирование сообщения об успехе
-        new_status_display = ALL_STATUSES.get(new_status, new_status)
-        current_status_display = ALL_STATUSES.get(current_status, current_status)
+            # Формирование сообщения об успехе
+            new_status_display = ALL_STATUSES.get(new_status, new_status)
+            current_status_display = ALL_STATUSES.get(current_status, current_status)
         
-        success_text = (
-            f"✅ <b>СТАТУС ЗАЯВКИ ИЗМЕНЕН!</b>\n\n"
-            f"📋 <b>Заявка:</b> <code>{order_number}</code>\n"
-            f"🔄 <b>Изменение:</b> {current_status_display} → {new_status_display}\n"
-            f"👤 <b>Оператор:</b> {user_nick}\n"
-            f"⏰ <b>Время:</b> {now_str}\n\n"
-            f"📝 <b>Запись добавлена в историю заявки</b>"
-        )
+            success_text = (
+                f"✅ <b>СТАТУС ЗАЯВКИ ИЗМЕНЕН!</b>\n\n"
+                f"📋 <b>Заявка:</b> <code>{order_number}</code>\n"
+                f"🔄 <b>Изменение:</b> {current_status_display} → {new_status_display}\n"
+                f"👤 <b>Оператор:</b> {user_nick}\n"
+                f"⏰ <b>Время:</b> {now_str}\n\n"
+                f"📝 <b>Запись добавлена в историю заявки</b>"
+            )
         
-        await call.message.edit_text(success_text, parse_mode="HTML")
-        await call.answer("✅ Статус успешно изменен!")
+            order_locks.mark_done(call)
+            await call.message.edit_text(success_text, parse_mode="HTML")
+            await call.answer("✅ Статус успешно изменен!")
         
-        # Логирование успешного изменения
-        log_system(f"Статус заявки {order_number} изменен: {current_status} → {new_status} пользователем {user_id} ({user_nick})")
-        log_db(f"[DB] update_transaction_status: {order_number} = {new_status}")
+            # Логирование успешного изменения
+            log_system(f"Статус заявки {order_number} изменен: {current_status} → {new_status} пользователем {user_id} ({user_nick})")
+            log_db(f"[DB] transition_transaction: {order_number} {current_status} → {new_status}")
         
-    except Exception as e:
-        log_error(f"Ошибка при изменении статуса заявки {order_number}: {e}")
-        await call.message.edit_text(
-            "❌ <b>ОШИБКА ПРИ ИЗМЕНЕНИИ СТАТУСА</b>\n\n"
-            "Произошла ошибка при обновлении статуса заявки.\n"
-            "Попробуйте позже или обратитесь к администратору.",
-            parse_mode="HTML"
-        )
-        await call.answer("❌ Произошла ошибка!", show_alert=True)
+        except Exception as e:
+            log_error(f"Ошибка при изменении статуса заявки {order_number}: {e}")
+            await call.message.edit_text(
+                "❌ <b>ОШИБКА ПРИ ИЗМЕНЕНИИ СТАТУСА</b>\n\n"
+                "Произошла ошибка при обновлении статуса заявки.\n"
+                "Попробуйте позже или обратитесь к администратору.",
+                parse_mode="HTML"
+            )
+            await call.answer("❌ Произошла ошибка!", show_alert=True)
     
     # Очистка состояния
     await state.clear()
@@ -33,6 +33,21 @@ class Config(BaseModel):
     PHOTO_ID: str = os.getenv('PHOTO_ID')
     LOG_FILE: str = os.getenv('LOG_FILE', os.path.join(BOT_DIR, 'logs', 'bot.log'))
 
+    # Режим получения обновлений: polling (по умолчанию) или webhook
+    BOT_MODE: str = os.getenv('VSEP_BOT_MODE', 'polling')
+    # Webhook: публичный адрес приложения (https://<app>.herokuapp.com) и путь, на который Telegram шлёт обновления
+    WEBHOOK_BASE_URL: Optional[str] = os.getenv('VSEP_WEBHOOK_BASE_URL')
+    WEBHOOK_PATH: str = os.getenv('VSEP_WEBHOOK_PATH', '/telegram/webhook')
+    # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; если не задан — выводится из токена бота
+    WEBHOOK_SECRET: Optional[str] = os.getenv('VSEP_WEBHOOK_SECRET')
+    # Адрес и порт HTTP-сервера (Heroku передаёт порт в PORT)
+    WEBHOOK_HOST: str = os.getenv('VSEP_WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT: int = int(os.getenv('PORT', '8080'))
+    # Сколько обновлений webhook может ждать и выполняться одновременно; сверх этого — 503
+    WEBHOOK_PENDING_LIMIT: int = int(os.getenv('VSEP_WEBHOOK_PENDING_LIMIT', '1000'))
+    # Сколько обновлений обрабатывается одновременно (по всем чатам; внутри чата — строго по очереди)
+    MAX_CONCURRENT_UPDATES: int = int(os.getenv('VSEP_MAX_CONCURRENT_UPDATES', '16'))
+
 class SystemSettings:
     """
     Класс для хранения системных настроек, загружаемых из базы данных.
@@ -123,6 +138,9 @@ class SystemSettings:
             return False
             
         self.__init__(**settings_data)
+        # Пересчитываем моменты открытия/закрытия смены, если время изменилось
+        from shift_state import shift_state
+        shift_state.configure(self.shift_start_time, self.shift_end_time)
         logger.info("Системные настройки перезагружены.")
         return True
 
@@ -3,6 +3,9 @@
 ============
 
 Асинхронная работа с PostgreSQL через asyncpg для VSEPExchangerBot.
+SQL-запросы лежат в реестре db_queries.QUERIES: при открытии соединения пула они готовятся
+один раз (init-хук prepare_queries) и выполняются по имени через fetch / fetchrow / fetchval /
+execute / executemany, время выполнения собирает query_stats.
 
 TODO:
 - [ ] Добавить методы для получения и обновления информации о пользователях
@@ -10,328 +13,457 @@ TODO:
 - [ ] Добавить обработку ошибок подключения
 - [ ] Покрыть тестами методы работы с БД
 """
+import json
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
 import asyncpg
 from config import config
+from db_queries import QUERIES, query_stats
 from logger import logger
+from transactions import TransactionEvent, decode_tx_code
+
+# Статусы открытых заявок (по ним построен частичный индекс transactions_open_orders_idx)
+OPEN_ORDER_STATUSES = ('created', 'accept', 'bill')
+
+
+class QueryConnection(asyncpg.Connection):
+    """Соединение пула с подготовленными запросами реестра: statements[имя] -> PreparedStatement"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = {}
+
+
+async def prepare_queries(conn):
+    """init-хук пула: готовит все запросы реестра на новом соединении"""
+    for name, sql in QUERIES.items():
+        try:
+            conn.statements[name] = await conn.prepare(sql)
+        except asyncpg.PostgresError as e:
+            # Например, миграция для таблицы ещё не применена — запрос подготовится при первом вызове
+            logger.warning(f"Запрос {name} не подготовлен: {e}")
+
 
 class Database:
     def __init__(self):
         self.pool = None
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(dsn=config.CBCLUB_DB_URL, min_size=1, max_size=5)
+        self.pool = await asyncpg.create_pool(
+            dsn=config.CBCLUB_DB_URL, min_size=1, max_size=5,
+            connection_class=QueryConnection, init=prepare_queries
+        )
 
     async def close(self):
         if self.pool:
             await self.pool.close()
 
+    # === Выполнение запросов реестра по имени ===
+
+    async def _run(self, method: str, name: str, args, conn=None):
+        if conn is not None:
+            return await self._run_on(conn, method, name, args)
+        if self.pool is None:
+            logger.error(f"Попытка обращения к БД без подключения (pool=None) в запросе {name}")
+            return None
+        async with self.pool.acquire() as conn:
+            return await self._run_on(conn, method, name, args)
+
+    async def _run_on(self, conn, method: str, name: str, args):
+        started = time.perf_counter()
+        try:
+            try:
+                return await self._call(await self._statement(conn, name), method, args)
+            except asyncpg.InvalidCachedStatementError:
+                # Таблица изменилась после подготовки запроса; внутри транзакции повтор невозможен
+                if conn.is_in_transaction():
+                    raise
+                return await self._call(await self._statement(conn, name, refresh=True), method, args)
+        finally:
+            query_stats.record(name, time.perf_counter() - started)
+
+    @staticmethod
+    async def _statement(conn, name: str, refresh: bool = False):
+        stmt = None if refresh else conn.statements.get(name)
+        if stmt is None:
+            stmt = conn.statements[name] = await conn.prepare(QUERIES[name])
+        return stmt
+
+    @staticmethod
+    async def _call(stmt, method: str, args):
+        if method == 'execute':
+            await stmt.fetch(*args)
+            return stmt.get_statusmsg()
+        return await getattr(stmt, method)(*args)
+
+    async def fetch(self, name: str, *args, conn=None):
+        """Строки запроса name из реестра; None — нет подключения"""
+        return await self._run('fetch', name, args, conn)
+
+    async def fetchrow(self, name: str, *args, conn=None):
+        return await self._run('fetchrow', name, args, conn)
+
+    async def fetchval(self, name: str, *args, conn=None):
+        return await self._run('fetchval', name, args, conn)
+
+    async def execute(self, name: str, *args, conn=None):
+        """Выполняет запрос name и возвращает статус команды ("UPDATE 3")"""
+        return await self._run('execute', name, args, conn)
+
+    async def executemany(self, name: str, args_list, conn=None):
+        return await self._run('executemany', name, (args_list,), conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Соединение пула с открытой транзакцией: запросы с conn=... выполняются атомарно"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+
     async def execute_query(self, query: str, *args):
-        """Выполнение SQL запроса с параметрами"""
+        """Выполнение произвольного SQL запроса с параметрами (вне реестра)"""
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в execute_query")
             return None
         async with self.pool.acquire() as conn:
             return await conn.fetch(query, *args)
 
+    # === Служебные ===
+
     async def check_system_settings_table(self) -> bool:
         """Проверка существования таблицы system_settings в схеме VSEPExchanger"""
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в check_system_settings_table")
+        try:
+            return bool(await self.fetchval("system.settings_table_exists"))
+        except Exception as e:
+            logger.error(f"Ошибка при проверке таблицы system_settings: {e}")
             return False
-        async with self.pool.acquire() as conn:
-            try:
-                # Проверяем существование таблицы
-                exists = await conn.fetchval('''
-                    SELECT EXISTS (
-                        SELECT 1 
-                        FROM information_schema.tables 
-                        WHERE table_schema = 'VSEPExchanger' 
-                        AND table_name = 'system_settings'
-                    );
-                ''')
-                return exists
-            except Exception as e:
-                logger.error(f"Ошибка при проверке таблицы system_settings: {e}")
-                return False
+
+    # === Пользователи и персонал ===
 
     async def add_user_if_not_exists(self, user_id: int, nickname: str):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в add_user_if_not_exists")
-            return None
-        async with self.pool.acquire() as conn:
-            result = await conn.execute('''
-                INSERT INTO "VSEPExchanger"."user" (id, nickneim, registration_date, rang)
-                VALUES ($1, $2, NOW(), 'user')
-                ON CONFLICT (id) DO NOTHING
-            ''', user_id, nickname)
-            return result
+        return await self.execute("user.add", user_id, nickname)
+
+    async def add_users_if_not_exist(self, users):
+        """Пакетное добавление пользователей и обновление сменившихся ников: users — список пар (user_id, nickname)"""
+        await self.executemany("user.add", users)
 
     async def set_user_rank(self, user_id: int, rank: str):
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в set_user_rank")
             return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."user"
-                SET rang = $2
-                WHERE id = $1
-            ''', user_id, rank)
+        await self.execute("user.set_rank", user_id, rank)
+        # Сбрасываем кэши сразу, чтобы новые права и группы действовали немедленно
+        from rank_cache import rank_cache
+        from chat_profiles import chat_profiles
+        rank_cache.invalidate(user_id)
+        chat_profiles.invalidate()
 
     async def get_user_rank(self, user_id: int) -> str | None:
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_user_rank")
-            return None
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT rang FROM "VSEPExchanger"."user" WHERE id = $1
-            ''', user_id)
-            return row['rang'] if row else None
+        return await self.fetchval("user.get_rank", user_id)
 
-    async def get_chat_nickneim(self, chat_id: int) -> str | None:
-        """Получение nickneim чата по его id"""
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_chat_nickneim")
-            return None
-        async with self.pool.acquire() as conn:
-            nickneim = await conn.fetchval('''
-                SELECT nickneim FROM "VSEPExchanger"."user" WHERE id = $1 AND rang = 'group'
-            ''', chat_id)
-            return nickneim
+    async def get_user_by_id(self, user_id: int):
+        """Запись таблицы user (пользователь или чат) по id"""
+        row = await self.fetchrow("user.get", user_id)
+        return dict(row) if row else None
+
+    async def get_privileged_ranks(self):
+        """Все записи с рангом, отличным от обычного пользователя (персонал и группы)"""
+        rows = await self.fetch("user.privileged")
+        return None if rows is None else [dict(row) for row in rows]
 
     async def get_admins(self):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_admins")
-            return None
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT nickneim, id, rang FROM "VSEPExchanger"."user" WHERE rang IN ('admin', 'админ', 'superadmin', 'суперадмин')
-            ''')
-            return rows
+        return await self.fetch("user.admins")
 
     async def get_operators(self):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_operators")
-            return None
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT nickneim, id, rang FROM "VSEPExchanger"."user" WHERE rang IN ('operator', 'оператор')
-            ''')
-            return rows
+        return await self.fetch("user.operators")
+
+    # === Чаты ===
+
+    async def get_chat_nickneim(self, chat_id: int) -> str | None:
+        """Получение nickneim чата по его id"""
+        return await self.fetchval("chat.group_nickneim", chat_id)
+
+    async def get_chat_title(self, chat_id: int) -> str | None:
+        """Получить название чата по его ID"""
+        return await self.fetchval("chat.title", chat_id) or None
+
+    async def get_group_chats(self):
+        rows = await self.fetch("chat.groups")
+        return None if rows is None else [dict(row) for row in rows]
+
+    async def insert_group_chat(self, chat_id: int, nickneim: str, created_at: datetime):
+        """Новая запись группового чата (rang = 'group')"""
+        await self.execute("chat.insert_group", chat_id, nickneim, created_at)
+
+    async def update_group_chat(self, chat_id: int, nickneim: str, updated_at: datetime):
+        """Переименование чата с установкой ранга group"""
+        await self.execute("chat.update_group", chat_id, nickneim, updated_at)
+
+    async def rename_chat(self, chat_id: int, nickneim: str, updated_at: datetime) -> bool:
+        """Смена nickneim чата; False — чата нет в таблице"""
+        return await self.execute("chat.rename", chat_id, nickneim, updated_at) == "UPDATE 1"
+
+    # === Реквизиты ===
 
     async def add_bank_account(self, account_id, bank, card_number, recipient_name, sbp_phone, is_special, is_active, created_by):
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в add_bank_account")
             return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO "VSEPExchanger"."bank_account" (
-                    account_id, bank, card_number, recipient_name, sbp_phone, is_special, is_active, created_at, updated_at, created_by
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, NOW(), NOW(), $8)
-            ''', account_id, bank, card_number, recipient_name, sbp_phone, is_special, is_active, created_by)
-            logger.info(f"Добавлен новый реквизит: account_id={account_id}, bank={bank}, by user_id={created_by}")
+        await self.execute("bank.add", account_id, bank, card_number, recipient_name, sbp_phone, is_special, is_active, created_by)
+        logger.info(f"Добавлен новый реквизит: account_id={account_id}, bank={bank}, by user_id={created_by}")
 
     async def get_active_bank_accounts(self):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_active_bank_accounts")
-            return None
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT * FROM "VSEPExchanger"."bank_account" WHERE is_active = TRUE ORDER BY account_number
-            ''')
-            return [dict(row) for row in rows]
+        rows = await self.fetch("bank.active")
+        return None if rows is None else [dict(row) for row in rows]
 
     async def set_actual_bank_account(self, account_number):
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в set_actual_bank_account")
             return None
-        async with self.pool.acquire() as conn:
-            # Снимаем статус у всех
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."bank_account" SET is_actual = FALSE WHERE is_actual = TRUE
-            ''')
-            # Ставим статус выбранному
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."bank_account" SET is_actual = TRUE WHERE account_number = $1
-            ''', account_number)
+        async with self.transaction() as conn:
+            # Снимаем статус у всех и ставим выбранному
+            await self.execute("bank.clear_actual", conn=conn)
+            await self.execute("bank.set_actual", account_number, conn=conn)
 
     async def set_special_bank_account(self, account_number):
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в set_special_bank_account")
             return None
-        async with self.pool.acquire() as conn:
-            # Снимаем статус у всех
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."bank_account" SET is_special = FALSE WHERE is_special = TRUE
-            ''')
-            # Ставим статус выбранному
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."bank_account" SET is_special = TRUE WHERE account_number = $1
-            ''', account_number)
+        async with self.transaction() as conn:
+            # Снимаем статус у всех и ставим выбранному
+            await self.execute("bank.clear_special", conn=conn)
+            await self.execute("bank.set_special", account_number, conn=conn)
 
     async def get_bank_account_by_number(self, account_number):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_bank_account_by_number")
-            return None
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT * FROM "VSEPExchanger"."bank_account" WHERE account_number = $1
-            ''', account_number)
-            return dict(row) if row else None
+        row = await self.fetchrow("bank.by_number", account_number)
+        return dict(row) if row else None
 
     async def remove_bank_account(self, account_number):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в remove_bank_account")
-            return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                DELETE FROM "VSEPExchanger"."bank_account" WHERE account_number = $1
-            ''', account_number)
+        await self.execute("bank.remove", account_number)
 
     async def deactivate_bank_account(self, account_number):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в deactivate_bank_account")
-            return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."bank_account" SET is_active = FALSE WHERE account_number = $1
-            ''', account_number)
+        await self.execute("bank.deactivate", account_number)
+
+    # === Курсы ===
 
     async def get_actual_rate(self):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_actual_rate")
-            return None
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT * FROM "VSEPExchanger"."rate" WHERE is_actual = TRUE LIMIT 1
-            ''')
-            return dict(row) if row else None
+        row = await self.fetchrow("rate.actual")
+        return dict(row) if row else None
 
     async def get_rate_coefficients(self):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_rate_coefficients")
-            return None
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT * FROM "VSEPExchanger"."rate" WHERE id = 1
-            ''')
-            return dict(row) if row else None
+        row = await self.fetchrow("rate.coefficients")
+        return dict(row) if row else None
 
     async def get_rate_limits(self):
+        row = await self.fetchrow("rate.limits")
+        return dict(row) if row else None
+
+    async def set_actual_rate(self, main_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, created_by) -> bool:
+        """Снятие старого и вставка нового актуального курса одной транзакцией; False — нет подключения"""
         if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_rate_limits")
-            return None
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT * FROM "VSEPExchanger"."rate" WHERE id = 2
-            ''')
-            return dict(row) if row else None
+            logger.error("Попытка обращения к БД без подключения (pool=None) в set_actual_rate")
+            return False
+        async with self.transaction() as conn:
+            await self.execute("rate.clear_actual", conn=conn)
+            await self.execute("rate.insert_actual", main_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, created_by, conn=conn)
+        return True
+
+    async def add_rate_samples(self, samples):
+        """Пакетная запись замеров курса: samples — список (source, rate, sampled_at UTC)"""
+        await self.executemany("rate_sample.add", samples)
+
+    async def get_rate_samples(self, source: str, since: datetime):
+        """Замеры курса источника строго после since (UTC) в хронологическом порядке"""
+        rows = await self.fetch("rate_sample.since", source, since)
+        return [dict(row) for row in rows or []]
+
+    async def delete_rate_samples_before(self, sources, before: datetime) -> int:
+        """Удаляет замеры курса источников sources старше before (UTC), возвращает их количество"""
+        result = await self.execute("rate_sample.delete_before", list(sources), before)
+        return int(result.split()[-1]) if result else 0
 
-    async def add_transaction(self, transaction_number, user_id, created_at, idr_amount, rate_used, rub_amount, note, account_info, status, status_changed_at, log, history=None, source_chat=None, crm_number=None):
+    # === Заявки ===
+
+    async def add_transaction(self, transaction_number, user_id, created_at, idr_amount, rate_used, rub_amount, note, account_info, status, status_changed_at, log, event=None, source_chat=None, crm_number=None):
+        """
+        Создание заявки; event — первое событие истории (TransactionEvent), пишется в той же транзакции.
+        Возвращает tx_id — компактный идентификатор из последовательности (см. encode_tx_id).
+        """
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в add_transaction")
             return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO "VSEPExchanger"."transactions" (transaction_number, user_id, created_at, idr_amount, rate_used, rub_amount, note, account_info, status, status_changed_at, log, history, source_chat, crm_number)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14)
-            ''', transaction_number, user_id, created_at, idr_amount, rate_used, rub_amount, note, account_info, status, status_changed_at, log, history, source_chat, crm_number)
+        async with self.transaction() as conn:
+            tx_id = await self.fetchval(
+                "transactions.add",
+                transaction_number, user_id, created_at, idr_amount, rate_used, rub_amount, note,
+                account_info, status, status_changed_at, log, source_chat, crm_number,
+                conn=conn
+            )
+            if event is not None:
+                await self._insert_transaction_events(conn, [event])
+            return tx_id
 
     async def get_transaction_by_number(self, transaction_number: str):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_transaction_by_number")
-            return None
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT * FROM "VSEPExchanger"."transactions" WHERE transaction_number = $1
-            ''', transaction_number)
-            return dict(row) if row else None
+        """Заявка по номеру; принимает и короткий код вида T2N9 (поиск по tx_id)"""
+        tx_id = decode_tx_code(transaction_number)
+        if tx_id is not None:
+            return await self.get_transaction_by_id(tx_id)
+        row = await self.fetchrow("transactions.by_number", transaction_number)
+        return dict(row) if row else None
+
+    async def get_transaction_by_id(self, tx_id: int):
+        """Заявка по компактному идентификатору tx_id"""
+        row = await self.fetchrow("transactions.by_id", tx_id)
+        return dict(row) if row else None
+
+    async def get_chat_transaction(self, transaction_number: str, chat_id):
+        """Номер, суммы и статус заявки, только если она создана в чате chat_id"""
+        row = await self.fetchrow("transactions.in_chat", transaction_number, str(chat_id))
+        return dict(row) if row else None
 
     async def update_transaction_status(self, transaction_number: str, new_status: str, status_changed_at):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в update_transaction_status")
-            return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."transactions"
-                SET status = $2, status_changed_at = $3
-                WHERE transaction_number = $1
-            ''', transaction_number, new_status, status_changed_at)
-
-    async def update_transaction_history(self, transaction_number, history):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в update_transaction_history")
-            return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."transactions" SET history = $2 WHERE transaction_number = $1
-            ''', transaction_number, history)
+        await self.execute("transactions.set_status", transaction_number, new_status, status_changed_at)
+
+    async def transition_transaction(self, transaction_number: str, expected_status: str, new_status: str,
+                                     changed_at, actor: str, event_status: str, link: str, note: str | None = None):
+        """
+        Смена статуса одной заявки с оптимистичной проверкой: UPDATE ... WHERE status = expected_status RETURNING *.
+        Событие event_status пишется в историю той же транзакцией БД; note, если задан, заменяет примечание.
+        Возвращает обновлённую строку или None, если заявка уже не в статусе expected_status (обработана раньше).
+        """
+        if self.pool is None:
+            logger.error("Попытка обращения к БД без подключения (pool=None) в transition_transaction")
+            return None
+        async with self.transaction() as conn:
+            row = await self.fetchrow(
+                "transactions.transition",
+                transaction_number, expected_status, new_status, changed_at, note,
+                conn=conn
+            )
+            if row is None:
+                return None
+            await self.add_transaction_event(transaction_number, changed_at, actor, event_status, link, conn=conn)
+        return dict(row)
+
+    async def transition_transactions(self, transaction_numbers, new_status, changed_at, actor, link, expected_status=None, conn=None):
+        """
+        Пакетная смена статуса заявок одной транзакцией БД: один UPDATE ... = ANY($1) RETURNING *
+        и одна вставка событий в историю. Если задан expected_status, меняются только заявки в этом статусе.
+        conn — соединение с уже открытой транзакцией вызывающего (db.transaction()), чтобы в неё же
+        записать связанные данные; без conn открывается своя транзакция.
+        Возвращает обновлённые строки в порядке transaction_numbers; при ошибке не меняется ничего.
+        """
+        numbers = list(transaction_numbers)
+        if not numbers:
+            return []
+        if conn is None:
+            if self.pool is None:
+                logger.error("Попытка обращения к БД без подключения (pool=None) в transition_transactions")
+                return None
+            async with self.transaction() as conn:
+                return await self.transition_transactions(
+                    numbers, new_status, changed_at, actor, link, expected_status=expected_status, conn=conn
+                )
+        rows = await self.fetch(
+            "transactions.transition_many", numbers, new_status, changed_at, expected_status, conn=conn
+        )
+        updated = [row['transaction_number'] for row in rows]
+        if updated:
+            await self.execute(
+                "transaction_event.add_many", updated, changed_at, actor, new_status, link, conn=conn
+            )
+        order = {num: idx for idx, num in enumerate(numbers)}
+        return sorted((dict(row) for row in rows), key=lambda r: order.get(r['transaction_number'], len(order)))
+
+    async def timeout_created_orders(self, created_before: datetime, changed_at: datetime):
+        """Переводит в timeout все заявки created, созданные раньше created_before; возвращает их номера"""
+        rows = await self.fetch("transactions.timeout_created_before", created_before, changed_at)
+        return [row['transaction_number'] for row in rows or []]
+
+    async def get_open_orders_by_chat(self, chat_id, statuses=OPEN_ORDER_STATUSES):
+        """
+        Открытые заявки чата одним запросом (status = ANY), сгруппированные по статусу.
+        Возвращает {status: [{'transaction_number', 'rub_amount', 'idr_amount', 'status'}, ...]}
+        с ключами для всех запрошенных статусов; внутри статуса — по status_changed_at.
+        """
+        result = {status: [] for status in statuses}
+        rows = await self.fetch("transactions.open_by_chat", str(chat_id), list(statuses))
+        for row in rows or []:
+            result[row['status']].append(dict(row))
+        return result
 
     async def update_transaction_crm_number(self, transaction_number, crm_number):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в update_transaction_crm_number")
-            return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."transactions" SET crm_number = $2 WHERE transaction_number = $1
-            ''', transaction_number, crm_number)
+        await self.execute("transactions.set_crm_number", transaction_number, crm_number)
 
     async def update_transaction_note(self, transaction_number, note):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в update_transaction_note")
-            return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE "VSEPExchanger"."transactions" SET note = $2 WHERE transaction_number = $1
-            ''', transaction_number, note)
+        await self.execute("transactions.set_note", transaction_number, note)
 
-    async def get_group_chats(self):
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_group_chats")
+    # === История заявок ===
+
+    async def _insert_transaction_events(self, conn, events):
+        await self.executemany(
+            "transaction_event.add",
+            [(e.transaction_number, e.event_at, e.actor, e.status, e.link) for e in events],
+            conn=conn
+        )
+
+    async def add_transaction_events(self, events, conn=None):
+        """Добавление событий в историю заявок (только INSERT, без чтения старой истории)"""
+        if not events:
             return None
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT id, nickneim FROM "VSEPExchanger"."user" WHERE rang = 'group'
-            ''')
-            return [dict(row) for row in rows]
+        if conn is None and self.pool is None:
+            logger.error("Попытка обращения к БД без подключения (pool=None) в add_transaction_events")
+            return None
+        await self._insert_transaction_events(conn, events)
+
+    async def add_transaction_event(self, transaction_number, event_at, actor, status, link, conn=None):
+        """Добавление одного события в историю заявки"""
+        return await self.add_transaction_events(
+            [TransactionEvent(transaction_number, event_at, actor, status, link)], conn=conn
+        )
+
+    async def get_transaction_events(self, transaction_number):
+        """История заявки в порядке добавления"""
+        rows = await self.fetch("transaction_event.by_number", transaction_number)
+        return [TransactionEvent.from_row(row) for row in rows or []]
+
+    async def get_transaction_events_bulk(self, transaction_numbers, conn=None):
+        """История нескольких заявок одним запросом: {transaction_number: [TransactionEvent, ...]}"""
+        result = {num: [] for num in transaction_numbers}
+        rows = await self.fetch("transaction_event.by_numbers", list(transaction_numbers), conn=conn)
+        for row in rows or []:
+            result.setdefault(row['transaction_number'], []).append(TransactionEvent.from_row(row))
+        return result
+
+    # === Системные настройки ===
 
     async def set_system_setting(self, key: str, value: str):
         """Установка значения системной настройки"""
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в set_system_setting")
             return None
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO "VSEPExchanger".system_settings (key, value)
-                VALUES ($1, $2)
-                ON CONFLICT (key) DO UPDATE SET value = $2
-            ''', key, value)
-            logger.info(f"SYSTEM | Обновлена системная настройка: {key}={value}")
+        await self.execute("settings.set", key, value)
+        logger.info(f"SYSTEM | Обновлена системная настройка: {key}={value}")
 
     async def get_system_setting(self, key: str) -> str | None:
         """Получение значения системной настройки"""
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в get_system_setting")
             return None
-        async with self.pool.acquire() as conn:
-            value = await conn.fetchval('''
-                SELECT value FROM "VSEPExchanger".system_settings
-                WHERE key = $1
-            ''', key)
-            logger.info(f"SYSTEM | Получена системная настройка: {key}={value}")
-            return value
+        value = await self.fetchval("settings.get", key)
+        logger.info(f"SYSTEM | Получена системная настройка: {key}={value}")
+        return value
 
     async def toggle_system_setting(self, key: str) -> bool:
         """Переключение булевой системной настройки (true/false)"""
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в toggle_system_setting")
             return False
-        async with self.pool.acquire() as conn:
+        async with self.transaction() as conn:
             # Получаем текущее значение
-            current_value = await conn.fetchval('''
-                SELECT value FROM "VSEPExchanger".system_settings
-                WHERE key = $1
-            ''', key)
-            
+            current_value = await self.fetchval("settings.get", key, conn=conn)
+
             # Определяем новое значение (переключаем true/false)
             if current_value is None:
                 new_value = "true"
@@ -339,66 +471,38 @@ class Database:
                 new_value = "false"
             else:
                 new_value = "true"
-            
+
             # Обновляем значение
-            await conn.execute('''
-                INSERT INTO "VSEPExchanger".system_settings (key, value)
-                VALUES ($1, $2)
-                ON CONFLICT (key) DO UPDATE SET value = $2
-            ''', key, new_value)
-            
-            logger.info(f"SYSTEM | Переключена системная настройка: {key}={new_value}")
-            return new_value.lower() == "true"
+            await self.execute("settings.set", key, new_value, conn=conn)
+
+        logger.info(f"SYSTEM | Переключена системная настройка: {key}={new_value}")
+        return new_value.lower() == "true"
 
     async def get_all_system_settings(self) -> dict | None:
         """Получение всех системных настроек"""
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_all_system_settings")
-            return None
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT key, value FROM "VSEPExchanger".system_settings;
-            ''')
-            return {row['key']: row['value'] for row in rows}
+        rows = await self.fetch("settings.all")
+        return None if rows is None else {row['key']: row['value'] for row in rows}
 
     async def migrate_photo_to_video_ids(self):
         """Миграция ключей photo_id на video_id"""
         if self.pool is None:
             logger.error("Попытка обращения к БД без подключения (pool=None) в migrate_photo_to_video_ids")
             return None
-        async with self.pool.acquire() as conn:
+        async with self.transaction() as conn:
             # Получаем текущие значения
-            photo_start = await conn.fetchval('''
-                SELECT value FROM "VSEPExchanger".system_settings
-                WHERE key = 'photo_id_start'
-            ''')
-            photo_end = await conn.fetchval('''
-                SELECT value FROM "VSEPExchanger".system_settings
-                WHERE key = 'photo_id_end'
-            ''')
-            
+            photo_start = await self.fetchval("settings.get", 'photo_id_start', conn=conn)
+            photo_end = await self.fetchval("settings.get", 'photo_id_end', conn=conn)
+
             # Если есть значения, создаем новые записи
             if photo_start:
-                await conn.execute('''
-                    INSERT INTO "VSEPExchanger".system_settings (key, value)
-                    VALUES ('video_id_start', $1)
-                    ON CONFLICT (key) DO UPDATE SET value = $1
-                ''', photo_start)
-            
+                await self.execute("settings.set", 'video_id_start', photo_start, conn=conn)
             if photo_end:
-                await conn.execute('''
-                    INSERT INTO "VSEPExchanger".system_settings (key, value)
-                    VALUES ('video_id_end', $1)
-                    ON CONFLICT (key) DO UPDATE SET value = $1
-                ''', photo_end)
-            
+                await self.execute("settings.set", 'video_id_end', photo_end, conn=conn)
+
             # Удаляем старые записи
-            await conn.execute('''
-                DELETE FROM "VSEPExchanger".system_settings
-                WHERE key IN ('photo_id_start', 'photo_id_end')
-            ''')
-            
-            logger.info("Миграция ключей photo_id на video_id завершена")
+            await self.execute("settings.delete_photo_ids", conn=conn)
+
+        logger.info("Миграция ключей photo_id на video_id завершена")
 
     async def ensure_system_settings(self):
         """Проверка и установка значений по умолчанию для системных настроек"""
@@ -417,88 +521,150 @@ class Database:
             'send_info_lgi': 'true',
             'send_info_tct': 'true'
         }
-        
+
         async with self.pool.acquire() as conn:
             for key, default_value in default_settings.items():
-                # Проверяем существование настройки
-                exists = await conn.fetchval('''
-                    SELECT EXISTS (
-                        SELECT 1 
-                        FROM "VSEPExchanger"."system_settings" 
-                        WHERE key = $1
-                    )
-                ''', key)
-                
-                if not exists:
-                    # Если настройка не существует, создаем её
-                    await conn.execute('''
-                        INSERT INTO "VSEPExchanger"."system_settings" (key, value)
-                        VALUES ($1, $2)
-                    ''', key, str(default_value))
+                # Создаём настройку, только если её ещё нет
+                created = await self.fetchval("settings.add_if_missing", key, str(default_value), conn=conn)
+                if created:
                     logger.info(f"Создана системная настройка {key} со значением по умолчанию {default_value}")
 
+    # === Счётчики контроля ===
+
     async def get_control_counter(self, chat_id: int) -> int:
-        key = f"{chat_id}_control_counter"
-        value = await self.get_system_setting(key)
-        return int(value) if value is not None else 0
+        return await self.fetchval("control_counter.get", chat_id) or 0
 
     async def set_control_counter(self, chat_id: int, value: int):
-        key = f"{chat_id}_control_counter"
-        await self.set_system_setting(key, str(value))
+        await self.execute("control_counter.set", chat_id, value)
 
-    async def get_all_control_counters(self):
-        """Получить все счетчики контроля по всем чатам"""
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_all_control_counters")
-            return None
-        async with self.pool.acquire() as conn:
-            # Получаем все ключи, которые заканчиваются на _control_counter
-            rows = await conn.fetch('''
-                SELECT key, value 
-                FROM "VSEPExchanger".system_settings 
-                WHERE key LIKE '%_control_counter'
-            ''')
-            
-            counters = []
-            for row in rows:
-                key = row['key']
-                value = int(row['value']) if row['value'] else 0
-                
-                # Извлекаем chat_id из ключа (убираем _control_counter)
-                chat_id_str = key.replace('_control_counter', '')
-                try:
-                    chat_id = int(chat_id_str)
-                    
-                    # Получаем название чата (если есть в базе)
-                    chat_title = await self.get_chat_title(chat_id)
-                    
-                    counters.append({
-                        'chat_id': chat_id,
-                        'chat_title': chat_title or f"Чат {chat_id}",
-                        'counter': value
-                    })
-                except ValueError:
-                    # Пропускаем некорректные ключи
-                    continue
-            
-            # Сортируем по убыванию счетчика
-            counters.sort(key=lambda x: x['counter'], reverse=True)
-            return counters
+    async def increment_control_counter(self, chat_id: int, delta: int = 1) -> int | None:
+        """Атомарно увеличивает счётчик контроля чата и возвращает новое значение"""
+        return await self.fetchval("control_counter.increment", chat_id, delta)
 
-    async def get_chat_title(self, chat_id: int) -> str | None:
-        """Получить название чата по его ID"""
-        if self.pool is None:
-            logger.error("Попытка обращения к БД без подключения (pool=None) в get_chat_title")
-            return None
-        async with self.pool.acquire() as conn:
-            # Пытаемся найти чат в таблице user
-            row = await conn.fetchrow('''
-                SELECT nickneim 
-                FROM "VSEPExchanger"."user" 
-                WHERE id = $1
-            ''', chat_id)
-            if row and row['nickneim']:
-                return row['nickneim']
-            return None
+    async def decrement_control_counter(self, chat_id: int) -> int | None:
+        """
+        Атомарно уменьшает счётчик контроля на 1, если он больше нуля.
+        Возвращает новое значение или None, если счётчик уже был нулевым.
+        """
+        return await self.fetchval("control_counter.decrement", chat_id)
 
-db = Database() 
\ No newline at end of file
+    async def get_all_control_counters(self):
+        """Получить все счетчики контроля по всем чатам вместе с названиями чатов (один запрос)"""
+        rows = await self.fetch("control_counter.all")
+        if rows is None:
+            return None
+        return [
+            {
+                'chat_id': row['chat_id'],
+                'chat_title': row['nickneim'] or f"Чат {row['chat_id']}",
+                'counter': row['counter']
+            }
+            for row in rows
+        ]
+
+    # === Планировщик ===
+
+    async def get_scheduler_markers(self) -> dict:
+        """Отметки планировщика: {job: плановый момент последнего срабатывания (UTC)}"""
+        rows = await self.fetch("scheduler_marker.all")
+        return {row['job']: row['fired_for'] for row in rows or []}
+
+    async def set_scheduler_marker(self, job: str, fired_for: datetime):
+        """Запоминает, что задача job выполнена за плановый момент fired_for (UTC); поздняя отметка не затирается ранней"""
+        await self.execute("scheduler_marker.set", job, fired_for)
+
+    async def claim_scheduler_marker(self, job: str, fired_for: datetime) -> bool:
+        """
+        Атомарно забирает срабатывание job за fired_for (UTC): True — отметка поставлена этим вызовом,
+        False — срабатывание уже забрал другой процесс бота (или ручное открытие/закрытие смены)
+        """
+        return await self.fetchval("scheduler_marker.claim", job, fired_for) is not None
+
+    # === FSM-состояния aiogram (fsm_storage) ===
+
+    async def get_fsm_record(self, key: str):
+        """Состояние и данные FSM по ключу; None, если записи нет или она просрочена"""
+        row = await self.fetchrow("fsm_state.get", key)
+        if row is None:
+            return None
+        return {'state': row['state'], 'data': json.loads(row['data'])}
+
+    async def _store_fsm_record(self, name: str, key: str, value, ttl: int):
+        if self.pool is None:
+            logger.error(f"Попытка обращения к БД без подключения (pool=None) в запросе {name}")
+            return None
+        async with self.pool.acquire() as conn:
+            row = await self.fetchrow(name, key, value, ttl, conn=conn)
+            record = {'state': row['state'], 'data': json.loads(row['data'])}
+            if record['state'] is None and not record['data']:
+                await self.execute("fsm_state.delete_empty", key, conn=conn)
+            return record
+
+    async def set_fsm_state(self, key: str, state: str | None, ttl: int):
+        """Записывает состояние FSM и возвращает запись; данные просроченной записи не наследуются, пустая запись удаляется"""
+        return await self._store_fsm_record("fsm_state.set_state", key, state, ttl)
+
+    async def set_fsm_data(self, key: str, data: dict, ttl: int):
+        """Записывает данные FSM и возвращает запись; состояние просроченной записи не наследуется, пустая запись удаляется"""
+        return await self._store_fsm_record("fsm_state.set_data", key, json.dumps(data, ensure_ascii=False), ttl)
+
+    async def delete_expired_fsm_states(self) -> int:
+        """Удаляет просроченные FSM-записи, возвращает их количество"""
+        result = await self.execute("fsm_state.delete_expired")
+        return int(result.split()[-1]) if result else 0
+
+    # === Очередь записей в Google Sheets (gsheet_outbox) ===
+
+    async def enqueue_gsheet_rows(self, rows, conn=None):
+        """
+        Ставит строки в очередь записи в Google Sheets.
+        rows — список кортежей (transaction_number, chat_id, worksheet_name, row_data);
+        заявки, уже стоящие в очереди или записанные, повторно не добавляются.
+        conn — транзакция вызывающего: строки очереди фиксируются вместе со сменой статуса заявок.
+        """
+        await self.executemany(
+            "gsheet_outbox.enqueue",
+            [(num, str(chat_id), ws, json.dumps(row, ensure_ascii=False)) for num, chat_id, ws, row in rows],
+            conn=conn
+        )
+
+    async def claim_gsheet_rows(self, limit: int, lease: int):
+        """
+        Забирает строки очереди, которые пора отправить: статус 'sending' на lease секунд.
+        FOR UPDATE SKIP LOCKED — воркеры разных процессов получают разные строки;
+        строки, не отмеченные за lease секунд (воркер упал), забираются снова.
+        """
+        rows = await self.fetch("gsheet_outbox.claim", limit, lease)
+        result = []
+        for row in sorted(rows or [], key=lambda r: r['id']):
+            item = dict(row)
+            item['row_data'] = json.loads(item['row_data'])
+            result.append(item)
+        return result
+
+    async def mark_gsheet_rows_done(self, ids):
+        await self.execute("gsheet_outbox.mark_done", list(ids))
+
+    async def mark_gsheet_rows_retry(self, ids, error: str, base_delay: int, max_delay: int, max_attempts: int):
+        """Увеличивает счётчик попыток и откладывает строки с экспоненциальной задержкой; после max_attempts — failed"""
+        await self.execute("gsheet_outbox.mark_retry", list(ids), error, base_delay, max_delay, max_attempts)
+
+    async def retry_failed_gsheet_rows(self) -> int:
+        """Возвращает строки со статусом failed в очередь"""
+        result = await self.execute("gsheet_outbox.retry_failed")
+        return int(result.split()[-1]) if result else 0
+
+    async def get_gsheet_queue(self, limit: int = 20):
+        """Сводка очереди: количество по статусам и последние незавершённые строки"""
+        if self.pool is None:
+            logger.error("Попытка обращения к БД без подключения (pool=None) в get_gsheet_queue")
+            return None
+        async with self.pool.acquire() as conn:
+            counts = await self.fetch("gsheet_outbox.counts", conn=conn)
+            rows = await self.fetch("gsheet_outbox.unsent", limit, conn=conn)
+            return {
+                'counts': {row['status']: row['cnt'] for row in counts},
+                'rows': [dict(row) for row in rows],
+            }
+
+db = Database()
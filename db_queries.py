@@ -0,0 +1,412 @@
+"""
+🟤 Реестр SQL-запросов бота
+===========================
+Весь SQL к схеме "VSEPExchanger" в одном месте: именованные запросы готовятся (PREPARE)
+один раз на каждое соединение пула в init-хуке db.connect и выполняются по имени
+через db.fetch / db.fetchrow / db.fetchval / db.execute / db.executemany —
+без повторного разбора и планирования.
+Время выполнения каждого запроса собирает query_stats (команда /db_stats).
+"""
+import time
+from typing import Dict, List
+
+from logger import log_db
+
+SLOW_QUERY_SECONDS = 1.0     # запросы дольше этого пишутся в лог
+
+QUERIES: Dict[str, str] = {
+    # --- Служебные ---
+    "system.settings_table_exists": '''
+        SELECT EXISTS (
+            SELECT 1
+            FROM information_schema.tables
+            WHERE table_schema = 'VSEPExchanger'
+            AND table_name = 'system_settings'
+        )
+    ''',
+
+    # --- Пользователи, персонал и чаты ---
+    "user.add": '''
+        INSERT INTO "VSEPExchanger"."user" (id, nickneim, registration_date, rang)
+        VALUES ($1, $2, NOW(), 'user')
+        ON CONFLICT (id) DO UPDATE SET nickneim = EXCLUDED.nickneim
+        WHERE "user".nickneim IS DISTINCT FROM EXCLUDED.nickneim
+    ''',
+    "user.set_rank": '''
+        UPDATE "VSEPExchanger"."user"
+        SET rang = $2
+        WHERE id = $1
+    ''',
+    "user.get_rank": '''
+        SELECT rang FROM "VSEPExchanger"."user" WHERE id = $1
+    ''',
+    "user.get": '''
+        SELECT * FROM "VSEPExchanger"."user" WHERE id = $1
+    ''',
+    "user.privileged": '''
+        SELECT id, rang FROM "VSEPExchanger"."user" WHERE rang IS NOT NULL AND rang <> 'user'
+    ''',
+    "user.admins": '''
+        SELECT nickneim, id, rang FROM "VSEPExchanger"."user" WHERE rang IN ('admin', 'админ', 'superadmin', 'суперадмин')
+    ''',
+    "user.operators": '''
+        SELECT nickneim, id, rang FROM "VSEPExchanger"."user" WHERE rang IN ('operator', 'оператор')
+    ''',
+    "chat.group_nickneim": '''
+        SELECT nickneim FROM "VSEPExchanger"."user" WHERE id = $1 AND rang = 'group'
+    ''',
+    "chat.title": '''
+        SELECT nickneim FROM "VSEPExchanger"."user" WHERE id = $1
+    ''',
+    "chat.groups": '''
+        SELECT id, nickneim FROM "VSEPExchanger"."user" WHERE rang = 'group'
+    ''',
+    "chat.insert_group": '''
+        INSERT INTO "VSEPExchanger"."user" (id, nickneim, rang, created_at, updated_at)
+        VALUES ($1, $2, 'group', $3, $3)
+    ''',
+    "chat.update_group": '''
+        UPDATE "VSEPExchanger"."user" SET nickneim = $2, rang = 'group', updated_at = $3 WHERE id = $1
+    ''',
+    "chat.rename": '''
+        UPDATE "VSEPExchanger"."user" SET nickneim = $2, updated_at = $3 WHERE id = $1
+    ''',
+
+    # --- Реквизиты ---
+    "bank.add": '''
+        INSERT INTO "VSEPExchanger"."bank_account" (
+            account_id, bank, card_number, recipient_name, sbp_phone, is_special, is_active, created_at, updated_at, created_by
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, NOW(), NOW(), $8)
+    ''',
+    "bank.active": '''
+        SELECT * FROM "VSEPExchanger"."bank_account" WHERE is_active = TRUE ORDER BY account_number
+    ''',
+    "bank.clear_actual": '''
+        UPDATE "VSEPExchanger"."bank_account" SET is_actual = FALSE WHERE is_actual = TRUE
+    ''',
+    "bank.set_actual": '''
+        UPDATE "VSEPExchanger"."bank_account" SET is_actual = TRUE WHERE account_number = $1
+    ''',
+    "bank.clear_special": '''
+        UPDATE "VSEPExchanger"."bank_account" SET is_special = FALSE WHERE is_special = TRUE
+    ''',
+    "bank.set_special": '''
+        UPDATE "VSEPExchanger"."bank_account" SET is_special = TRUE WHERE account_number = $1
+    ''',
+    "bank.by_number": '''
+        SELECT * FROM "VSEPExchanger"."bank_account" WHERE account_number = $1
+    ''',
+    "bank.remove": '''
+        DELETE FROM "VSEPExchanger"."bank_account" WHERE account_number = $1
+    ''',
+    "bank.deactivate": '''
+        UPDATE "VSEPExchanger"."bank_account" SET is_active = FALSE WHERE account_number = $1
+    ''',
+
+    # --- Курсы ---
+    "rate.actual": '''
+        SELECT * FROM "VSEPExchanger"."rate" WHERE is_actual = TRUE LIMIT 1
+    ''',
+    "rate.coefficients": '''
+        SELECT * FROM "VSEPExchanger"."rate" WHERE id = 1
+    ''',
+    "rate.limits": '''
+        SELECT * FROM "VSEPExchanger"."rate" WHERE id = 2
+    ''',
+    "rate.clear_actual": '''
+        UPDATE "VSEPExchanger"."rate" SET is_actual = FALSE WHERE is_actual = TRUE
+    ''',
+    "rate.insert_actual": '''
+        INSERT INTO "VSEPExchanger"."rate" (main_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, created_by, created_at, is_actual)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW(), TRUE)
+    ''',
+    "rate_sample.add": '''
+        INSERT INTO "VSEPExchanger"."rate_sample" (source, rate, sampled_at)
+        VALUES ($1, $2, $3)
+    ''',
+    "rate_sample.since": '''
+        SELECT rate, sampled_at FROM "VSEPExchanger"."rate_sample"
+        WHERE source = $1 AND sampled_at > $2
+        ORDER BY sampled_at
+    ''',
+    "rate_sample.delete_before": '''
+        DELETE FROM "VSEPExchanger"."rate_sample"
+        WHERE source = ANY($1::text[]) AND sampled_at < $2
+    ''',
+
+    # --- Заявки ---
+    "transactions.add": '''
+        INSERT INTO "VSEPExchanger"."transactions" (transaction_number, user_id, created_at, idr_amount, rate_used, rub_amount, note, account_info, status, status_changed_at, log, source_chat, crm_number)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+        RETURNING tx_id
+    ''',
+    "transactions.by_number": '''
+        SELECT * FROM "VSEPExchanger"."transactions" WHERE transaction_number = $1
+    ''',
+    "transactions.by_id": '''
+        SELECT * FROM "VSEPExchanger"."transactions" WHERE tx_id = $1
+    ''',
+    "transactions.in_chat": '''
+        SELECT transaction_number, rub_amount, idr_amount, status
+        FROM "VSEPExchanger"."transactions"
+        WHERE transaction_number = $1 AND source_chat = $2
+    ''',
+    "transactions.open_by_chat": '''
+        SELECT transaction_number, rub_amount, idr_amount, status
+        FROM "VSEPExchanger"."transactions"
+        WHERE source_chat = $1 AND status = ANY($2::text[])
+        ORDER BY status_changed_at
+    ''',
+    "transactions.set_status": '''
+        UPDATE "VSEPExchanger"."transactions"
+        SET status = $2, status_changed_at = $3
+        WHERE transaction_number = $1
+    ''',
+    "transactions.transition": '''
+        UPDATE "VSEPExchanger"."transactions"
+        SET status = $3, status_changed_at = $4, note = COALESCE($5, note)
+        WHERE transaction_number = $1 AND status = $2
+        RETURNING *
+    ''',
+    "transactions.transition_many": '''
+        UPDATE "VSEPExchanger"."transactions"
+        SET status = $2, status_changed_at = $3
+        WHERE transaction_number = ANY($1::text[])
+          AND ($4::text IS NULL OR status = $4::text)
+        RETURNING *
+    ''',
+    "transactions.timeout_created_before": '''
+        UPDATE "VSEPExchanger"."transactions"
+        SET status = 'timeout', status_changed_at = $2
+        WHERE status = 'created' AND created_at < $1
+        RETURNING transaction_number
+    ''',
+    "transactions.set_crm_number": '''
+        UPDATE "VSEPExchanger"."transactions" SET crm_number = $2 WHERE transaction_number = $1
+    ''',
+    "transactions.set_note": '''
+        UPDATE "VSEPExchanger"."transactions" SET note = $2 WHERE transaction_number = $1
+    ''',
+
+    # --- История заявок ---
+    "transaction_event.add": '''
+        INSERT INTO "VSEPExchanger"."transaction_event" (transaction_number, event_at, actor, status, link)
+        VALUES ($1, $2, $3, $4, $5)
+    ''',
+    "transaction_event.add_many": '''
+        INSERT INTO "VSEPExchanger"."transaction_event" (transaction_number, event_at, actor, status, link)
+        SELECT num, $2, $3, $4, $5 FROM unnest($1::text[]) WITH ORDINALITY AS u(num, pos)
+        ORDER BY pos
+    ''',
+    "transaction_event.by_number": '''
+        SELECT * FROM "VSEPExchanger"."transaction_event"
+        WHERE transaction_number = $1
+        ORDER BY id
+    ''',
+    "transaction_event.by_numbers": '''
+        SELECT * FROM "VSEPExchanger"."transaction_event"
+        WHERE transaction_number = ANY($1::text[])
+        ORDER BY transaction_number, id
+    ''',
+
+    # --- Системные настройки ---
+    "settings.set": '''
+        INSERT INTO "VSEPExchanger".system_settings (key, value)
+        VALUES ($1, $2)
+        ON CONFLICT (key) DO UPDATE SET value = $2
+    ''',
+    "settings.get": '''
+        SELECT value FROM "VSEPExchanger".system_settings
+        WHERE key = $1
+    ''',
+    "settings.all": '''
+        SELECT key, value FROM "VSEPExchanger".system_settings
+    ''',
+    "settings.add_if_missing": '''
+        INSERT INTO "VSEPExchanger"."system_settings" (key, value)
+        VALUES ($1, $2)
+        ON CONFLICT (key) DO NOTHING
+        RETURNING key
+    ''',
+    "settings.delete_photo_ids": '''
+        DELETE FROM "VSEPExchanger".system_settings
+        WHERE key IN ('photo_id_start', 'photo_id_end')
+    ''',
+
+    # --- Счётчики контроля ---
+    "control_counter.get": '''
+        SELECT counter FROM "VSEPExchanger"."control_counter" WHERE chat_id = $1
+    ''',
+    "control_counter.set": '''
+        INSERT INTO "VSEPExchanger"."control_counter" (chat_id, counter, updated_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (chat_id) DO UPDATE SET counter = EXCLUDED.counter, updated_at = NOW()
+    ''',
+    "control_counter.increment": '''
+        INSERT INTO "VSEPExchanger"."control_counter" (chat_id, counter, updated_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (chat_id) DO UPDATE
+        SET counter = "VSEPExchanger"."control_counter".counter + $2, updated_at = NOW()
+        RETURNING counter
+    ''',
+    "control_counter.decrement": '''
+        UPDATE "VSEPExchanger"."control_counter"
+        SET counter = counter - 1, updated_at = NOW()
+        WHERE chat_id = $1 AND counter > 0
+        RETURNING counter
+    ''',
+    "control_counter.all": '''
+        SELECT c.chat_id, c.counter, u.nickneim
+        FROM "VSEPExchanger"."control_counter" c
+        LEFT JOIN "VSEPExchanger"."user" u ON u.id = c.chat_id
+        ORDER BY c.counter DESC
+    ''',
+
+    # --- Планировщик ---
+    "scheduler_marker.all": '''
+        SELECT job, fired_for FROM "VSEPExchanger"."scheduler_marker"
+    ''',
+    "scheduler_marker.set": '''
+        INSERT INTO "VSEPExchanger"."scheduler_marker" (job, fired_for, fired_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (job) DO UPDATE
+        SET fired_for = GREATEST("VSEPExchanger"."scheduler_marker".fired_for, EXCLUDED.fired_for),
+            fired_at = NOW()
+    ''',
+    "scheduler_marker.claim": '''
+        INSERT INTO "VSEPExchanger"."scheduler_marker" (job, fired_for, fired_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (job) DO UPDATE
+        SET fired_for = EXCLUDED.fired_for, fired_at = NOW()
+        WHERE "VSEPExchanger"."scheduler_marker".fired_for < EXCLUDED.fired_for
+        RETURNING job
+    ''',
+
+    # --- FSM-состояния ---
+    "fsm_state.get": '''
+        SELECT state, data FROM "VSEPExchanger"."fsm_state"
+        WHERE key = $1 AND expires_at > NOW()
+    ''',
+    "fsm_state.set_state": '''
+        INSERT INTO "VSEPExchanger"."fsm_state" (key, state, updated_at, expires_at)
+        VALUES ($1, $2, NOW(), NOW() + make_interval(secs => $3::float8))
+        ON CONFLICT (key) DO UPDATE
+        SET state = EXCLUDED.state,
+            data = CASE WHEN "VSEPExchanger"."fsm_state".expires_at > NOW()
+                        THEN "VSEPExchanger"."fsm_state".data ELSE '{}'::jsonb END,
+            updated_at = NOW(),
+            expires_at = EXCLUDED.expires_at
+        RETURNING state, data
+    ''',
+    "fsm_state.set_data": '''
+        INSERT INTO "VSEPExchanger"."fsm_state" (key, data, updated_at, expires_at)
+        VALUES ($1, $2::jsonb, NOW(), NOW() + make_interval(secs => $3::float8))
+        ON CONFLICT (key) DO UPDATE
+        SET data = EXCLUDED.data,
+            state = CASE WHEN "VSEPExchanger"."fsm_state".expires_at > NOW()
+                         THEN "VSEPExchanger"."fsm_state".state ELSE NULL END,
+            updated_at = NOW(),
+            expires_at = EXCLUDED.expires_at
+        RETURNING state, data
+    ''',
+    "fsm_state.delete_empty": '''
+        DELETE FROM "VSEPExchanger"."fsm_state"
+        WHERE key = $1 AND state IS NULL AND data = '{}'::jsonb
+    ''',
+    "fsm_state.delete_expired": '''
+        DELETE FROM "VSEPExchanger"."fsm_state" WHERE expires_at <= NOW()
+    ''',
+
+    # --- Очередь Google Sheets ---
+    "gsheet_outbox.enqueue": '''
+        INSERT INTO "VSEPExchanger"."gsheet_outbox" (transaction_number, chat_id, worksheet_name, row_data)
+        VALUES ($1, $2, $3, $4::jsonb)
+        ON CONFLICT (transaction_number) DO NOTHING
+    ''',
+    "gsheet_outbox.claim": '''
+        UPDATE "VSEPExchanger"."gsheet_outbox"
+        SET status = 'sending', locked_until = NOW() + make_interval(secs => $2::float8)
+        WHERE id IN (
+            SELECT id FROM "VSEPExchanger"."gsheet_outbox"
+            WHERE (status = 'pending' AND next_attempt_at <= NOW())
+               OR (status = 'sending' AND locked_until <= NOW())
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, transaction_number, chat_id, worksheet_name, row_data, attempts
+    ''',
+    "gsheet_outbox.mark_done": '''
+        UPDATE "VSEPExchanger"."gsheet_outbox"
+        SET status = 'done', sent_at = NOW(), last_error = NULL, locked_until = NULL
+        WHERE id = ANY($1::bigint[])
+    ''',
+    "gsheet_outbox.mark_retry": '''
+        UPDATE "VSEPExchanger"."gsheet_outbox"
+        SET attempts = attempts + 1,
+            last_error = $2,
+            status = CASE WHEN attempts + 1 >= $5::int THEN 'failed' ELSE 'pending' END,
+            locked_until = NULL,
+            next_attempt_at = NOW() + make_interval(secs => LEAST($4::float8, $3::float8 * power(2, attempts)))
+        WHERE id = ANY($1::bigint[])
+    ''',
+    "gsheet_outbox.retry_failed": '''
+        UPDATE "VSEPExchanger"."gsheet_outbox"
+        SET status = 'pending', attempts = 0, next_attempt_at = NOW()
+        WHERE status = 'failed'
+    ''',
+    "gsheet_outbox.counts": '''
+        SELECT status, count(*) AS cnt FROM "VSEPExchanger"."gsheet_outbox" GROUP BY status
+    ''',
+    "gsheet_outbox.unsent": '''
+        SELECT transaction_number, worksheet_name, status, attempts, next_attempt_at, last_error
+        FROM "VSEPExchanger"."gsheet_outbox"
+        WHERE status <> 'done'
+        ORDER BY status, id
+        LIMIT $1
+    ''',
+}
+
+
+class QueryStats:
+    """Время выполнения запросов реестра: число вызовов, суммарное, среднее и максимальное время"""
+
+    def __init__(self, slow_threshold: float = SLOW_QUERY_SECONDS):
+        self.slow_threshold = slow_threshold
+        # {имя: [вызовов, суммарное время, максимальное время]}
+        self._stats: Dict[str, List[float]] = {}
+        self.started_at = time.time()
+
+    def record(self, name: str, elapsed: float):
+        stat = self._stats.get(name)
+        if stat is None:
+            stat = self._stats[name] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += elapsed
+        if elapsed > stat[2]:
+            stat[2] = elapsed
+        if elapsed >= self.slow_threshold:
+            log_db(f"Медленный запрос {name}: {elapsed:.3f} с")
+
+    def snapshot(self, top: int = 15) -> List[dict]:
+        """Самые затратные запросы по суммарному времени"""
+        rows = [
+            {
+                'name': name,
+                'calls': int(calls),
+                'total_ms': total * 1000,
+                'avg_ms': total * 1000 / calls if calls else 0.0,
+                'max_ms': max_time * 1000,
+            }
+            for name, (calls, total, max_time) in self._stats.items()
+        ]
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+        return rows[:top]
+
+    def reset(self):
+        self._stats.clear()
+        self.started_at = time.time()
+
+
+# Глобальная статистика запросов
+query_stats = QueryStats()
@@ -0,0 +1,124 @@
+"""
+🟤 Хранилище FSM в PostgreSQL
+=============================
+Замена MemoryStorage: состояния и данные сценариев (/rate_change, /worktime, /bank_new,
+/report_vsep, order_change) лежат в "VSEPExchanger"."fsm_state", поэтому переживают
+перезапуск дайно и видны всем процессам бота на одном токене.
+Чтение идёт через локальный кэш на FSM_CACHE_TTL секунд: за одно обновление aiogram
+обращается к состоянию несколько раз, а у большинства сообщений состояния нет вовсе.
+Запись — сразу в БД и в кэш. Записи живут FSM_STATE_TTL секунд с последнего изменения,
+просроченные удаляет фоновая очистка.
+"""
+import asyncio
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from db import db
+from logger import log_system, log_error
+
+FSM_STATE_TTL = 24 * 60 * 60      # срок жизни незавершённого сценария, сек
+FSM_CACHE_TTL = 3                 # сколько читать запись из локального кэша, сек
+FSM_CLEANUP_INTERVAL = 60 * 60    # период удаления просроченных записей, сек
+FSM_CACHE_MAX_SIZE = 1000         # при таком размере кэша из него вычищаются устаревшие записи
+
+
+def build_fsm_key(key: StorageKey) -> str:
+    """Строковый ключ записи: бот:чат:пользователь:тред:business:destiny"""
+    parts = [
+        key.bot_id,
+        key.chat_id,
+        key.user_id,
+        key.thread_id or '',
+        getattr(key, 'business_connection_id', None) or '',
+        key.destiny,
+    ]
+    return ':'.join(str(part) for part in parts)
+
+
+class PostgresStorage(BaseStorage):
+
+    def __init__(self, state_ttl: int = FSM_STATE_TTL, cache_ttl: float = FSM_CACHE_TTL):
+        self.state_ttl = state_ttl
+        self.cache_ttl = cache_ttl
+        # {ключ: (момент загрузки, состояние, данные)}
+        self._cache: Dict[str, Tuple[float, Optional[str], Dict[str, Any]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    # --- Локальный кэш ---
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+            return cached[1], cached[2]
+        if len(self._cache) > FSM_CACHE_MAX_SIZE:
+            self._prune_cache()
+        return self._remember(key, await db.get_fsm_record(key))
+
+    def _remember(self, key: str, record: Optional[dict]) -> Tuple[Optional[str], Dict[str, Any]]:
+        state, data = (record['state'], record['data']) if record else (None, {})
+        self._cache[key] = (time.monotonic(), state, data)
+        return state, data
+
+    def _prune_cache(self):
+        now = time.monotonic()
+        for key in [key for key, cached in self._cache.items() if now - cached[0] >= self.cache_ttl]:
+            del self._cache[key]
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        fsm_key = build_fsm_key(key)
+        value = state.state if isinstance(state, State) else state
+        record = await db.set_fsm_state(fsm_key, value, self.state_ttl)
+        self._remember(fsm_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(build_fsm_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        fsm_key = build_fsm_key(key)
+        record = await db.set_fsm_data(fsm_key, dict(data), self.state_ttl)
+        self._remember(fsm_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(build_fsm_key(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        await self.stop()
+        self._cache.clear()
+
+    # --- Очистка просроченных записей ---
+    async def _loop(self):
+        while self._running:
+            try:
+                deleted = await db.delete_expired_fsm_states()
+                if deleted:
+                    log_system(f"FSMStorage: удалено просроченных FSM-состояний: {deleted}")
+            except Exception as e:
+                log_error(f"FSMStorage: ошибка очистки FSM-состояний: {e}")
+            self._prune_cache()
+            await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+
+    def start(self):
+        if self._task is None:
+            self._running = True
+            self._task = asyncio.create_task(self._loop())
+            log_system("FSMStorage: FSM-состояния хранятся в PostgreSQL")
+
+    async def stop(self):
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Глобальное хранилище FSM
+fsm_storage = PostgresStorage()
@@ -6,19 +6,24 @@
 """
 import gspread_asyncio
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import RefreshError
 import pandas as pd
 import gspread
 from gspread_dataframe import set_with_dataframe
 import asyncio
+import threading
 from typing import List, Dict, Any, Optional, Tuple
 import json
 import logging
 import os
+import re
+import time
 from datetime import datetime
 from decimal import Decimal
 from config import system_settings, config
 from logger import logger, log_system, log_func, log_db, log_warning, log_error
 from db import db
+from chat_profiles import chat_profiles
 from aiogram import Bot
 from config import config
 from collections import defaultdict
@@ -44,32 +49,108 @@ def get_chat_table_map():
         gs_logger.error(f"Ошибка при загрузке маппинга чатов: {e}")
         return {}
 
+# --- Долгоживущий клиент gspread: авторизация и открытие таблицы один раз, листы кэшируются по имени ---
+SPREADSHEET_NAME = "VSEP_EXCHANGER_PARTNERS"
+GSHEET_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/drive.file"
+]
+_gs_lock = threading.Lock()
+_gs_client = None
+_gs_spreadsheet = None
+_gs_worksheets: Dict[str, Any] = {}
+
+def get_gspread_client():
+    """Ленивая авторизация gspread по GOOGLE_TABLE_CREDS; токен обновляется самим google-auth"""
+    global _gs_client
+    with _gs_lock:
+        if _gs_client is None:
+            creds_json = os.getenv("GOOGLE_TABLE_CREDS")
+            if not creds_json:
+                raise ValueError("GOOGLE_TABLE_CREDS не задана в env!")
+            creds_dict = json.loads(creds_json)
+            gs_logger.info(f"[GSheets] Авторизация через from_service_account_info (без файлов)")
+            creds = Credentials.from_service_account_info(creds_dict, scopes=GSHEET_SCOPES)
+            _gs_client = gspread.authorize(creds)
+        return _gs_client
+
+def get_spreadsheet():
+    """Таблица VSEP_EXCHANGER_PARTNERS (открывается один раз)"""
+    global _gs_spreadsheet
+    client = get_gspread_client()
+    with _gs_lock:
+        if _gs_spreadsheet is None:
+            gs_logger.info(f"[GSheets] Открываю таблицу по имени: {SPREADSHEET_NAME}")
+            _gs_spreadsheet = client.open(SPREADSHEET_NAME)
+        return _gs_spreadsheet
+
+def get_worksheet(worksheet_name: str):
+    """Лист таблицы по имени из кэша"""
+    sh = get_spreadsheet()
+    with _gs_lock:
+        ws = _gs_worksheets.get(worksheet_name)
+        if ws is None:
+            gs_logger.info(f"[GSheets] Открываю лист: {worksheet_name}")
+            ws = sh.worksheet(worksheet_name)
+            _gs_worksheets[worksheet_name] = ws
+        return ws
+
+def reset_gspread_cache():
+    """Сбрасывает клиент и листы — следующая запись авторизуется заново"""
+    global _gs_client, _gs_spreadsheet
+    with _gs_lock:
+        _gs_client = None
+        _gs_spreadsheet = None
+        _gs_worksheets.clear()
+
+# Ответы Google, при которых запрос отклонён до выполнения (авторизация, нет листа/диапазона)
+GSHEET_REJECTED_STATUSES = (400, 401, 403, 404)
+
+def _rejected_before_write(error: Exception) -> bool:
+    """Ошибка гарантированно означает, что запрос не выполнен: повтор записи не создаст дубль"""
+    if isinstance(error, RefreshError):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None) in GSHEET_REJECTED_STATUSES
+    return False
+
+def _with_worksheet(worksheet_name: str, action, idempotent: bool = True):
+    """
+    Выполняет action(ws). Ошибка открытия листа (авторизация, лист не найден) — один повтор
+    со сброшенным кэшем. Ошибка самой action повторяется так же, только если action идемпотентна
+    (чтение) или Google отклонил запрос до выполнения: неидемпотентный append_rows после таймаута
+    мог уже записаться, поэтому такая ошибка уходит наверх — повтор делает очередь gsheet_outbox.
+    """
+    try:
+        ws = get_worksheet(worksheet_name)
+    except Exception as e:
+        gs_logger.warning(f"[GSheets] Не удалось открыть лист {worksheet_name}, повтор с новой авторизацией: {e}")
+        reset_gspread_cache()
+        ws = get_worksheet(worksheet_name)
+    try:
+        return action(ws)
+    except Exception as e:
+        if not idempotent and not _rejected_before_write(e):
+            raise
+        gs_logger.warning(f"[GSheets] Ошибка при работе с листом {worksheet_name}, повтор с новой авторизацией: {e}")
+        reset_gspread_cache()
+        return action(get_worksheet(worksheet_name))
+
 async def get_worksheet_name_by_chat_id(chat_id: str) -> Optional[str]:
-    """Асинхронно получить имя worksheet по chat_id через nickneim пользователя с rang='group'"""
-    user = None
+    """Асинхронно получить имя worksheet по chat_id через профиль чата (nickneim группы с rang='group')"""
     try:
-        if db.pool is None:
-            gs_logger.error(f"[GSheets] Нет подключения к базе данных (pool=None) при поиске пользователя по chat_id {chat_id}")
-            logger.error(f"[GSheets] Нет подключения к базе данных (pool=None) при поиске пользователя по chat_id {chat_id}")
-            print(f"[GSheets] Нет подключения к базе данных (pool=None) при поиске пользователя по chat_id {chat_id}")
-            return None
-        async with db.pool.acquire() as conn:
-            user = await conn.fetchrow('''
-                SELECT nickneim FROM "VSEPExchanger"."user" WHERE id = $1 AND rang = 'group'
-            ''', int(chat_id))
+        profile = await chat_profiles.get(int(chat_id))
     except Exception as e:
-        gs_logger.error(f"[GSheets] Ошибка при поиске пользователя по chat_id {chat_id}: {e}")
-        logger.error(f"[GSheets] Ошибка при поиске пользователя по chat_id {chat_id}: {e}")
-        print(f"[GSheets] Ошибка при поиске пользователя по chat_id {chat_id}: {e}")
+        gs_logger.error(f"[GSheets] Ошибка при поиске профиля чата {chat_id}: {e}")
+        logger.error(f"[GSheets] Ошибка при поиске профиля чата {chat_id}: {e}")
         return None
-    if not user or not user['nickneim']:
+    if not profile:
         gs_logger.error(f"[GSheets] Не найден пользователь с chat_id {chat_id} и rang='group'")
         logger.error(f"[GSheets] Не найден пользователь с chat_id {chat_id} и rang='group'")
         print(f"[GSheets] Не найден пользователь с chat_id {chat_id} и rang='group'")
         return None
-    prefix = user['nickneim'].split('_')[0]
-    worksheet = f"VSEP_{prefix}"
-    return worksheet
+    return profile.worksheet_name
 
 class GSheetWriteResult:
     def __init__(self):
@@ -159,14 +240,23 @@ async def write_multiple_to_google_sheet(
     worksheet_name: Optional[str] = None
 ):
     """
-    Записывает несколько строк в Google Sheet и отправляет одно итоговое уведомление
+    Записывает несколько строк в Google Sheet одним append_rows и отправляет одно итоговое уведомление
     """
     write_result = GSheetWriteResult()
-    for row_data in rows_data:
+    if worksheet_name is None:
+        worksheet_name = await get_worksheet_name_by_chat_id(chat_id)
+    if not worksheet_name:
+        gs_logger.error(f"[GSheets] Не удалось определить worksheet для chat_id {chat_id}")
+        write_result.add_error("Не удалось определить лист таблицы")
+    elif rows_data:
         try:
-            await write_to_google_sheet_async(chat_id, row_data, worksheet_name, write_result)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, write_rows_to_google_sheet_sync, rows_data, worksheet_name)
+            for _ in rows_data:
+                write_result.add_success()
         except Exception as e:
-            continue
+            for _ in rows_data:
+                write_result.add_error(str(e))
     # Отправляем итоговое уведомление
     await send_gsheet_summary(chat_id, write_result)
     # Если были успешные записи — отправляем финальное сообщение
@@ -262,98 +352,153 @@ def write_to_google_sheet_sync(
     :param row_data: список значений для записи
     :param worksheet_name: имя листа (обязательно)
     """
+    write_rows_to_google_sheet_sync([row_data], worksheet_name)
+
+def build_gsheet_row(row_data: list) -> list:
+    """Готовая строка для Google Sheets: Decimal/datetime приводятся к простым типам, столбцы — по ТЗ"""
+    return prepare_row_for_gsheet([format_value_for_gsheet(item) for item in row_data])
+
+def write_rows_to_google_sheet_sync(rows_data: list, worksheet_name: str):
+    """
+    Синхронно добавляет строки на лист worksheet_name одним вызовом append_rows.
+    Клиент и лист берутся из кэша, авторизация выполняется только при первом обращении.
+    """
+    append_gsheet_rows_sync([build_gsheet_row(row_data) for row_data in rows_data], worksheet_name)
+
+def append_gsheet_rows_sync(gsheet_rows: list, worksheet_name: str):
+    """Синхронно добавляет уже подготовленные строки (build_gsheet_row) на лист одним append_rows"""
     try:
-        creds_json = os.getenv("GOOGLE_TABLE_CREDS")
-        if not creds_json:
-            raise ValueError("GOOGLE_TABLE_CREDS не задана в env!")
-        creds_dict = json.loads(creds_json)
-        gs_logger.info(f"[GSheets] Авторизация через from_service_account_info (без файлов)")
-        creds = Credentials.from_service_account_info(
-            creds_dict,
-            scopes=[
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive",
-                "https://www.googleapis.com/auth/drive.file"
-            ]
+        gs_logger.info(f"[GSheets] Пытаюсь записать строк: {len(gsheet_rows)} на лист {worksheet_name}")
+        _with_worksheet(
+            worksheet_name,
+            lambda ws: ws.append_rows(gsheet_rows, value_input_option="USER_ENTERED"),  # type: ignore
+            idempotent=False
         )
-        gc = gspread.authorize(creds)
-        spreadsheet_name = "VSEP_EXCHANGER_PARTNERS"
-        gs_logger.info(f"[GSheets] Открываю таблицу по имени: {spreadsheet_name}")
-        sh = gc.open(spreadsheet_name)
-        gs_logger.info(f"[GSheets] Открываю лист: {worksheet_name}")
-        ws = sh.worksheet(worksheet_name)
-        # Преобразуем все Decimal в float перед записью
-        row_data = [format_value_for_gsheet(item) for item in row_data]
-        # Формируем строку для Google Sheets по ТЗ
-        gsheet_row = prepare_row_for_gsheet(row_data)
-        gs_logger.info(f"[GSheets] Пытаюсь записать строку: {gsheet_row}")
-        ws.append_row(gsheet_row, value_input_option="USER_ENTERED")  # type: ignore
-        gs_logger.info(f"[GSheets] Успешно записано: {gsheet_row}")
+        gs_logger.info(f"[GSheets] Успешно записано строк: {len(gsheet_rows)}: {gsheet_rows}")
     except Exception as e:
         gs_logger.error(f"[GSheets] Ошибка при записи в Google Sheets: {e}")
         logger.error(f"[GSheets] Ошибка при записи в Google Sheets: {e}")
         print(f"[GSheets] Ошибка при записи в Google Sheets: {e}")
         raise 
 
+# Столбец J листа партнёра — номер транзакции (см. prepare_row_for_gsheet)
+GSHEET_TX_COLUMN = 10
+
+def _gsheet_tx_key(value) -> str:
+    """Номер транзакции из ячейки J без апострофов-маркеров текста"""
+    return str(value or '').strip().strip("'")
+
+def append_new_gsheet_rows_sync(gsheet_rows: list, worksheet_name: str) -> int:
+    """
+    Как append_gsheet_rows_sync, но пропускает строки, номер транзакции которых уже есть в столбце J листа.
+    Повторная доставка из очереди (сбой после append, перезахват строки другим процессом) не создаёт дублей.
+    Возвращает число добавленных строк.
+    """
+    existing = {
+        _gsheet_tx_key(value)
+        for value in _with_worksheet(worksheet_name, lambda ws: ws.col_values(GSHEET_TX_COLUMN))
+    }
+    new_rows = [row for row in gsheet_rows if _gsheet_tx_key(row[GSHEET_TX_COLUMN - 1]) not in existing]
+    skipped = len(gsheet_rows) - len(new_rows)
+    if skipped:
+        gs_logger.info(f"[GSheets] Уже есть на листе {worksheet_name}, пропущено строк: {skipped}")
+    if new_rows:
+        append_gsheet_rows_sync(new_rows, worksheet_name)
+    return len(new_rows)
+
+# --- Лист SUM_ALL: индекс "месяц -> столбцы" и чтение только нужных диапазонов ---
+SUM_ALL_SHEET = "SUM_ALL"
+SUM_ALL_MONTH_ROW = 2          # строка с подписями месяцев ('июн..2025')
+# Строки блока проекта (номера строк листа)
+SUM_ALL_ROWS = {
+    'project': 3,
+    'count': 4,
+    'commission_percent': 37,
+    'turnover': 42,
+    'commission': 43,
+}
+# Смежные строки читаются одним диапазоном
+SUM_ALL_ROW_RANGES = [(3, 4), (37, 37), (42, 43)]
+SUM_ALL_INDEX_TTL = 600        # индекс месяцев, сек (лист прирастает раз в месяц)
+SUM_ALL_REPORT_TTL = 120       # данные месяца, сек (повторный отчёт с другим курсом)
+CURRENCY_RE = re.compile(r'([\d\s,.]+)\s*([A-Z]+)')
+
+_sum_all_lock = threading.Lock()
+_sum_all_index: Dict[str, List[int]] = {}
+_sum_all_index_loaded_at = 0.0
+_sum_all_reports: Dict[str, Tuple[float, list]] = {}
+
+def _get_sum_all_month_columns(month_label: str) -> List[int]:
+    """Номера столбцов (с 1) блоков месяца; индекс строится по строке 2 и перечитывается по TTL или при промахе"""
+    global _sum_all_index, _sum_all_index_loaded_at
+    with _sum_all_lock:
+        fresh = time.monotonic() - _sum_all_index_loaded_at < SUM_ALL_INDEX_TTL
+        if fresh and month_label in _sum_all_index:
+            return _sum_all_index[month_label]
+    month_row = _with_worksheet(SUM_ALL_SHEET, lambda ws: ws.row_values(SUM_ALL_MONTH_ROW))
+    index = defaultdict(list)
+    for col, value in enumerate(month_row, start=1):
+        if value.strip():
+            index[value.strip()].append(col)
+    with _sum_all_lock:
+        _sum_all_index = dict(index)
+        _sum_all_index_loaded_at = time.monotonic()
+    gs_logger.info(f"[GSheets] Индекс месяцев SUM_ALL обновлён: {len(index)} месяцев")
+    return _sum_all_index.get(month_label, [])
+
+def _column_letter(col: int) -> str:
+    return gspread.utils.rowcol_to_a1(1, col).rstrip('0123456789')
+
+def _range_cell(block: list, row: int, col: int) -> str:
+    """Значение из ответа batch_get; пустые хвосты строк Google не возвращает"""
+    if row < len(block) and col < len(block[row]):
+        return str(block[row][col]).strip()
+    return ''
+
 def read_sum_all_report(month_label: str) -> list:
     """
     Читает данные с листа SUM_ALL по заданному месяцу (например, 'июн..2025').
     Возвращает список словарей по всем найденным проектам.
+    Читаются только столбцы месяца и нужные строки; результат кэшируется на SUM_ALL_REPORT_TTL.
     """
-    creds_json = os.getenv("GOOGLE_TABLE_CREDS")
-    if not creds_json:
-        print("[DEBUG] GOOGLE_TABLE_CREDS не задана в env!")
-        raise ValueError("GOOGLE_TABLE_CREDS не задана в env!")
-    creds_dict = json.loads(creds_json)
-    creds = Credentials.from_service_account_info(
-        creds_dict,
-        scopes=[
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-            "https://www.googleapis.com/auth/drive.file"
-        ]
-    )
-    gc = gspread.authorize(creds)
-    spreadsheet_name = "VSEP_EXCHANGER_PARTNERS"
-    print(f"[DEBUG] Открываю таблицу: {spreadsheet_name}")
-    sh = gc.open(spreadsheet_name)
-    ws = sh.worksheet("SUM_ALL")
-    print(f"[DEBUG] Открыл лист: SUM_ALL")
-    data = ws.get_all_values()
-    print(f"[DEBUG] Строка 2 (месяцы): {data[1]}")
-    # Поиск всех столбцов с нужным месяцем
-    month_cols = [i for i, v in enumerate(data[1]) if v.strip() == month_label.strip()]
-    print(f"[DEBUG] Найденные индексы столбцов для '{month_label}': {month_cols}")
+    label = month_label.strip()
+    with _sum_all_lock:
+        cached = _sum_all_reports.get(label)
+        if cached and time.monotonic() - cached[0] < SUM_ALL_REPORT_TTL:
+            return cached[1]
+
+    month_cols = _get_sum_all_month_columns(label)
+    gs_logger.info(f"[GSheets] SUM_ALL: столбцы месяца '{label}': {month_cols}")
+    if not month_cols:
+        return []
+    first_col, last_col = min(month_cols), max(month_cols)
+    ranges = [
+        f"{_column_letter(first_col)}{top}:{_column_letter(last_col)}{bottom}"
+        for top, bottom in SUM_ALL_ROW_RANGES
+    ]
+    blocks = _with_worksheet(SUM_ALL_SHEET, lambda ws: ws.batch_get(ranges))
+
+    # Номер строки листа -> (блок ответа, смещение строки внутри блока)
+    row_locations = {}
+    for block, (top, bottom) in zip(blocks, SUM_ALL_ROW_RANGES):
+        for row in range(top, bottom + 1):
+            row_locations[row] = (block, row - top)
+
     result = []
     for col in month_cols:
-        try:
-            project = data[2][col].strip()
-            count = data[3][col].strip()
-            commission_percent = data[36][col].strip()
-            turnover = data[41][col].strip()
-            commission = data[42][col].strip()
-            print(f"[DEBUG] col={col} | project={project} | count={count} | %={commission_percent} | turnover={turnover} | commission={commission}")
-            # Определяем валюту оборота и комиссии (по строке оборота)
-            currency = ''
-            commission_currency = ''
-            import re
-            m = re.search(r'([\d\s,.]+)\s*([A-Z]+)', turnover)
-            if m:
-                currency = m.group(2)
-            m2 = re.search(r'([\d\s,.]+)\s*([A-Z]+)', commission)
-            if m2:
-                commission_currency = m2.group(2)
-            result.append({
-                'project': project,
-                'count': count,
-                'commission_percent': commission_percent,
-                'turnover': turnover,
-                'commission': commission,
-                'currency': currency,
-                'commission_currency': commission_currency
-            })
-        except Exception as e:
-            print(f"[DEBUG] Ошибка парсинга столбца {col}: {e}")
-            continue
-    print(f"[DEBUG] Итоговый результат: {result}")
-    return result 
\ No newline at end of file
+        offset = col - first_col
+        values = {
+            key: _range_cell(*row_locations[row], offset)
+            for key, row in SUM_ALL_ROWS.items()
+        }
+        # Определяем валюту оборота и комиссии (по строке оборота)
+        m = CURRENCY_RE.search(values['turnover'])
+        m2 = CURRENCY_RE.search(values['commission'])
+        values['currency'] = m.group(2) if m else ''
+        values['commission_currency'] = m2.group(2) if m2 else ''
+        result.append(values)
+    gs_logger.info(f"[GSheets] SUM_ALL: прочитано проектов за '{label}': {len(result)}")
+
+    with _sum_all_lock:
+        _sum_all_reports[label] = (time.monotonic(), result)
+    return result
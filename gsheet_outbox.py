@@ -0,0 +1,143 @@
+"""
+🟤 Очередь записи в Google Sheets
+=================================
+/transfer ставит строки в таблицу "VSEPExchanger"."gsheet_outbox" и сразу отвечает в чат.
+Фоновый воркер забирает очередь пачками, пишет их одним append_rows на лист
+и при ошибках откладывает повтор с экспоненциальной задержкой. Состояние очереди — /gsheet_queue.
+Воркер работает в каждом процессе бота: строки захватываются атомарно (db.claim_gsheet_rows),
+а заявки, номер которых уже есть на листе, повторно не дописываются.
+"""
+import asyncio
+from collections import defaultdict
+from typing import List, Optional
+
+from db import db
+from google_sync import append_new_gsheet_rows_sync, build_gsheet_row, get_worksheet_name_by_chat_id, gs_logger
+from logger import log_system, log_error, log_warning
+from messages import send_to_admin_group_safe
+
+GSHEET_OUTBOX_INTERVAL = 10      # как часто проверять очередь, сек
+GSHEET_OUTBOX_BATCH = 200        # строк за один проход
+GSHEET_RETRY_BASE_DELAY = 30     # первая задержка повтора, сек (далее x2)
+GSHEET_RETRY_MAX_DELAY = 3600    # максимальная задержка повтора, сек
+GSHEET_MAX_ATTEMPTS = 10         # после стольких неудач строка получает статус failed
+GSHEET_CLAIM_LEASE = 300         # на сколько воркер захватывает строки, сек (потом их заберёт другой процесс)
+
+
+async def enqueue_google_sheet_rows(chat_id: str, rows_data: list, conn=None):
+    """
+    Ставит строки /transfer в очередь записи в Google Sheets.
+    rows_data — список строк вида [номер заявки, ник, сумма IDR, сумма RUB, курс, статус, примечание,
+    реквизиты, история, чат-источник, дата создания, дата перевода]; в таблицу каждая строка
+    попадает через build_gsheet_row.
+    conn — открытая транзакция вызывающего (db.transaction()): строки очереди фиксируются вместе
+    со сменой статуса заявок; воркер в этом случае будит сам вызывающий — после commit.
+    """
+    worksheet_name = await get_worksheet_name_by_chat_id(chat_id)
+    await db.enqueue_gsheet_rows([
+        (str(row_data[0]), chat_id, worksheet_name, build_gsheet_row(row_data))
+        for row_data in rows_data
+    ], conn=conn)
+    gs_logger.info(f"[GSheets] В очередь поставлено строк: {len(rows_data)} (чат {chat_id}, лист {worksheet_name})")
+    if conn is None:
+        gsheet_outbox.wakeup()
+
+
+class GSheetOutboxWorker:
+
+    def __init__(self):
+        self.bot = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    def wakeup(self):
+        """Разбудить воркер сразу после постановки строк в очередь"""
+        self._wakeup.set()
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._running = True
+            self._task = asyncio.create_task(self._loop())
+            log_system("GSheetOutbox: воркер очереди Google Sheets запущен")
+
+    async def stop(self):
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while self._running:
+            try:
+                await self.process_batch()
+            except Exception as e:
+                log_error(f"GSheetOutbox: ошибка обработки очереди: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=GSHEET_OUTBOX_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_batch(self) -> int:
+        """Отправляет одну пачку готовых к записи строк; возвращает количество записанных"""
+        rows = await db.claim_gsheet_rows(GSHEET_OUTBOX_BATCH, GSHEET_CLAIM_LEASE)
+        if not rows:
+            return 0
+        # Группируем по листу и чату: одна запись append_rows на лист, одно уведомление на чат
+        groups = defaultdict(list)
+        for row in rows:
+            worksheet_name = row['worksheet_name'] or await get_worksheet_name_by_chat_id(row['chat_id'])
+            groups[(worksheet_name, row['chat_id'])].append(row)
+
+        written = 0
+        loop = asyncio.get_running_loop()
+        for (worksheet_name, chat_id), items in groups.items():
+            ids = [item['id'] for item in items]
+            if not worksheet_name:
+                await self._retry(ids, items, "Не удалось определить лист таблицы")
+                continue
+            try:
+                appended = await loop.run_in_executor(
+                    None, append_new_gsheet_rows_sync, [item['row_data'] for item in items], worksheet_name
+                )
+            except Exception as e:
+                await self._retry(ids, items, str(e))
+                continue
+            await db.mark_gsheet_rows_done(ids)
+            written += appended
+            if appended:
+                await self._notify_chat(chat_id)
+        return written
+
+    async def _retry(self, ids: List[int], items: list, error: str):
+        log_warning(f"GSheetOutbox: не удалось записать {len(ids)} строк, повтор позже: {error}")
+        await db.mark_gsheet_rows_retry(ids, error, GSHEET_RETRY_BASE_DELAY, GSHEET_RETRY_MAX_DELAY, GSHEET_MAX_ATTEMPTS)
+        failed = [item['transaction_number'] for item in items if item['attempts'] + 1 >= GSHEET_MAX_ATTEMPTS]
+        if failed and self.bot:
+            await send_to_admin_group_safe(
+                self.bot,
+                f"🟤 Google Sheets: не удалось записать заявки после {GSHEET_MAX_ATTEMPTS} попыток: "
+                f"{', '.join(failed)}\nОшибка: {error}\nСм. /gsheet_queue",
+                parse_mode=None
+            )
+
+    async def _notify_chat(self, chat_id: str):
+        if not self.bot:
+            return
+        try:
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text="🟤 Заявки с произведённым расчётом добавлены в таблицу партнера"
+            )
+        except Exception as e:
+            log_error(f"GSheetOutbox: не удалось отправить уведомление в чат {chat_id}: {e}")
+
+
+# Глобальный воркер очереди Google Sheets
+gsheet_outbox = GSheetOutboxWorker()
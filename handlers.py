@@ -17,16 +17,19 @@ from aiogram.utils.markdown import code
 import sys
 import logging
 import re
+import html
 from db import db
+from transactions import format_history_lines, history_to_legacy, encode_tx_id
+from rank_cache import rank_cache
 from logger import logger, log_system, log_user, log_func, log_db, log_warning, log_error
 from db import db
+from rate_cache import rate_cache
 from procedures.bank_handlers import bank_router
 from procedures.shift_handlers import force_open_callback, force_close_callback
 from procedures.rate_handlers import rate_change_confirm, rate_change_cancel
 from permissions import is_admin_or_superadmin, is_operator_or_admin
 from help_menu import build_pretty_help_text, get_bot_commands_for_status
 from messages import (
-    get_bali_and_msk_time_list,
     get_control_usage_message,
     get_control_notify_message,
     # get_control_success_message,
@@ -37,10 +40,18 @@ from messages import (
     send_to_admin_group_safe
 )
 from chat_logger import log_message
+from time_utils import clock
 from procedures.input_sum import handle_input_sum
-from scheduler import init_scheduler, scheduler, night_shift
+from scheduler import init_scheduler, get_scheduler
+from shift_state import shift_state
 from config import config, system_settings
-from google_sync import write_to_google_sheet_async, write_multiple_to_google_sheet, read_sum_all_report
+from google_sync import write_to_google_sheet_async, read_sum_all_report
+from report_engine import build_vsep_report
+from gsheet_outbox import gsheet_outbox, enqueue_google_sheet_rows
+from chat_lanes import chat_lanes
+from db_queries import query_stats
+from order_locks import order_locks, answer_already_processed, ALREADY_IN_PROGRESS_TEXT
+from broadcast import broadcaster, report_broadcast
 from utils import fmt_0, fmt_2, fmt_delta
 from commands.accept import router as accept_router
 from commands.joke import router as joke_router
@@ -57,6 +68,7 @@ from joke_parser import get_joke, get_joke_with_source
 from commands.joke import router as joke_router
 from bybit_api import get_idr_usdt_rate
 from bybit_p2p import get_p2p_idr_usdt_avg_rate
+from rate_feed import rate_feed, RATE_FEED_REPORT_WINDOW
 
 # Создаем роутер для всех обработчиков
 router = Router()
@@ -79,6 +91,8 @@ BALI_TZ = timezone(timedelta(hours=8))
 
 # Глобальный dict: для каждого чата только один актуальный control message_id
 active_control_message = defaultdict(lambda: None)
+# Задачи устаревания кнопок /control: {(chat_id, message_id кнопок): asyncio.Task}; в FSM не хранятся — не сериализуются
+control_expire_tasks = {}
 
 # Кастомный календарь для выбора месяца/года
 class MonthYearCalendar:
@@ -203,9 +217,10 @@ async def cmd_in_development(message: Message, command_name: str, description: s
 async def force_open_callback(call: CallbackQuery, data: dict):
     print("DATA IN force_open_callback:", data)
     if call.data == "force_open_yes":
+        scheduler = get_scheduler()
+        await shift_state.force_open()
         await scheduler.send_shift_start()
-        scheduler.sent_start_today = True
-        scheduler.sent_end_today = False
+        await scheduler.mark_fired_manually("shift_start")
         await call.message.edit_text("Смена принудительно открыта.")
     else:
         await call.message.edit_text("Операция отменена.")
@@ -213,8 +228,10 @@ async def force_open_callback(call: CallbackQuery, data: dict):
 async def force_close_callback(call: CallbackQuery, data: dict):
     print("DATA IN force_close_callback:", data)
     if call.data == "force_close_yes":
+        scheduler = get_scheduler()
+        await shift_state.force_close()
         await scheduler.send_shift_end()
-        scheduler.sent_end_today = True
+        await scheduler.mark_fired_manually("shift_end")
         await call.message.edit_text("Смена принудительно закрыта.")
     else:
         await call.message.edit_text("Операция отменена.")
@@ -256,17 +273,12 @@ async def rate_change_confirm(call: CallbackQuery, state: FSMContext):
     old_rate_special = old_rate_row['rate_special'] if old_rate_row else None
     rate_special = old_rate_special
     
-    # Проверяем, что пул базы данных доступен
-    if not db.pool:
+    # Снятие старого и вставка нового курса — одной транзакцией, затем подменяем снимок в кэше
+    if not await db.set_actual_rate(new_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, call.from_user.id):
         await call.message.edit_text("❌ Ошибка: база данных недоступна. Попробуйте позже.")
         await state.clear()
         return
-    
-    await db.pool.execute('UPDATE "VSEPExchanger"."rate" SET is_actual=FALSE WHERE is_actual=TRUE')
-    await db.pool.execute('''
-        INSERT INTO "VSEPExchanger"."rate" (main_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, created_by, created_at, is_actual)
-        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW(), TRUE)
-    ''', new_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, call.from_user.id)
+    await rate_cache.refresh()
     await call.message.edit_text("Курсы изменены!")
     await cmd_rate_show(call.message)
     await state.clear()
@@ -314,13 +326,9 @@ async def process_control_request(message: Message, crm_number: str):
             return
         log_func(f"Получен список операторов: {len(operators)}")
         
-        # Счетчик контроля для текущего чата
-        counter = await db.get_control_counter(chat_id)
-        if counter is None:
-            counter = 0
-        new_counter = counter + 1
-        await db.set_control_counter(chat_id, new_counter)
-        log_func(f"Счетчик контроля для чата {chat_id} увеличен: {counter} -> {new_counter}")
+        # Счетчик контроля для текущего чата (атомарное увеличение)
+        new_counter = await db.increment_control_counter(chat_id)
+        log_func(f"Счетчик контроля для чата {chat_id} увеличен: -> {new_counter}")
         
         # Получаем все счетчики контроля по всем чатам
         all_counters = await db.get_all_control_counters()
@@ -418,13 +426,9 @@ async def process_control_request_with_order(message: Message, crm_number: str,
             return
         log_func(f"Получен список операторов: {len(operators)}")
         
-        # Счетчик контроля для текущего чата
-        counter = await db.get_control_counter(chat_id)
-        if counter is None:
-            counter = 0
-        new_counter = counter + 1
-        await db.set_control_counter(chat_id, new_counter)
-        log_func(f"Счетчик контроля для чата {chat_id} увеличен: {counter} -> {new_counter}")
+        # Счетчик контроля для текущего чата (атомарное увеличение)
+        new_counter = await db.increment_control_counter(chat_id)
+        log_func(f"Счетчик контроля для чата {chat_id} увеличен: -> {new_counter}")
         
         # Получаем все счетчики контроля по всем чатам
         all_counters = await db.get_all_control_counters()
@@ -501,10 +505,110 @@ async def process_control_request_with_order(message: Message, crm_number: str,
         log_error(f"Ошибка при отправке уведомления: {e}")
         await message.reply("❌ Произошла ошибка при отправке уведомления операторам.")
 
+async def _control_order(call: CallbackQuery, state: FSMContext, transaction_number: str, crm_number: str) -> bool:
+    """Перевод выбранной заявки created → control (выполняется под замком заявки); False — обработка прервана"""
+    try:
+        # Проверяем, что заявка существует и имеет статус "создана"
+        order = await db.get_chat_transaction(transaction_number, call.message.chat.id)
+        
+        if not order:
+            await call.answer("❌ Заявка не найдена.", show_alert=True)
+            return False
+        
+        if order['status'] == 'control':
+            order_locks.mark_done(call)
+            await answer_already_processed(call, "control")
+            return False
+        
+        if order['status'] != 'created':
+            await call.answer(f"❌ Заявка уже имеет статус: {order['status']}", show_alert=True)
+            return False
+        
+        now_utc = datetime.utcnow().replace(microsecond=0)
+        user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
+        
+        # Формируем ссылку на сообщение
+        if call.message.chat.username:
+            link = f"https://t.me/{call.message.chat.username}/{call.message.message_id}"
+        else:
+            chat_id_num = str(call.message.chat.id)
+            if chat_id_num.startswith('-100'):
+                chat_id_num = chat_id_num[4:]
+            elif chat_id_num.startswith('-'):
+                chat_id_num = chat_id_num[1:]
+            link = f"https://t.me/c/{chat_id_num}/{call.message.message_id}"
+        
+        # Статус "на контроле", примечание и событие в истории — только если заявка всё ещё created
+        updated = await db.transition_transaction(
+            transaction_number, "created", "control", now_utc, user_nick, "контроль", link, note=crm_number
+        )
+        if updated is None:
+            order_locks.mark_done(call)
+            await answer_already_processed(call)
+            return False
+        order_locks.mark_done(call)
+        
+        log_func(f"Статус заявки {transaction_number} изменен: created -> control, note: '{crm_number}'")
+        
+        # Удаляем сообщение с кнопками
+        await call.message.delete()
+        
+        # Отменяем задачу истечения кнопок
+        expire_task = control_expire_tasks.pop((call.message.chat.id, call.message.message_id), None)
+        if expire_task and not expire_task.done():
+            expire_task.cancel()
+            log_func("Задача истечения кнопок отменена при выборе заявки")
+        # Очищаем message_id
+        active_control_message[call.message.chat.id] = None
+        
+        # Отправляем сообщение о том, что заявка отправлена на контроль
+        rub_amount = int(order['rub_amount']) if order['rub_amount'] else 0
+        idr_amount = int(order['idr_amount']) if order['idr_amount'] else 0
+        rub_formatted = f"{rub_amount:,}".replace(",", " ")
+        idr_formatted = f"{idr_amount:,}".replace(",", " ")
+        
+        control_message = (
+            f"🟡 Заявка отправлена на контроль!\n\n"
+            f"• Номер заявки: <code>{transaction_number}</code>\n"
+            f"• Сумма: {rub_formatted} RUB | {idr_formatted} IDR\n"
+            f"• Примечание: {crm_number}\n"
+            f"🟡 Статус заявки: <b>НА КОНТРОЛЕ</b>\n\n"
+            f"Операторы уведомлены.\nОжидайте подтверждения получения транзакции."
+        )
+        # Добавляем кнопку "Принять" для операторов/админов/суперадминов
+        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+        accept_keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="✅ Подтвердить транзакцию (accept)", callback_data=f"accept_order_{transaction_number}")]
+            ]
+        )
+        control_msg = await call.message.answer(control_message, reply_markup=accept_keyboard)
+        log_func("Отправлено сообщение о заявке на контроле с кнопкой Принять")
+        
+        # Сохраняем ID сообщения с кнопкой в состоянии для использования в accept callback
+        await state.update_data(control_message_id=control_msg.message_id)
+        
+        # Отправляем уведомление операторам
+        await process_control_request_with_order(call.message, crm_number, transaction_number, order, call.from_user)
+        
+        # Сбрасываем состояние
+        await state.clear()
+        
+    except Exception as e:
+        log_error(f"Ошибка при обновлении статуса заявки {transaction_number}: {e}")
+        await call.answer("❌ Произошла ошибка при обработке заявки.", show_alert=True)
+        return False
+    return True
+
 async def control_callback_handler(call: CallbackQuery, state: FSMContext):
     """Обработчик callback-кнопок команды control"""
     log_user(f"Получен callback {call.data} от пользователя {call.from_user.id}")
     
+    # Повторное нажатие уже выполненной кнопки выбора заявки — ответ без запросов к БД
+    if order_locks.is_done(call):
+        await answer_already_processed(call)
+        return
+    
     # Проверяем права доступа (владелец или суперадмин)
     state_data = await state.get_data()
     owner_id = state_data.get('owner_id')
@@ -526,7 +630,7 @@ async def control_callback_handler(call: CallbackQuery, state: FSMContext):
         
         # Отменяем задачу истечения кнопок
         state_data = await state.get_data()
-        expire_task = state_data.get('expire_task')
+        expire_task = control_expire_tasks.pop((call.message.chat.id, call.message.message_id), None)
         base_text = state_data.get('base_text', '')
         if expire_task and not expire_task.done():
             expire_task.cancel()
@@ -562,116 +666,12 @@ async def control_callback_handler(call: CallbackQuery, state: FSMContext):
                 await call.answer("❌ Ошибка: база данных недоступна.", show_alert=True)
                 return
             
-            try:
-                async with db.pool.acquire() as conn:
-                    # Проверяем, что заявка существует и имеет статус "создана"
-                    order = await conn.fetchrow('''
-                        SELECT transaction_number, rub_amount, idr_amount, status
-                        FROM "VSEPExchanger"."transactions"
-                        WHERE transaction_number = $1 AND source_chat = $2
-                    ''', transaction_number, str(call.message.chat.id))
-                    
-                    if not order:
-                        await call.answer("❌ Заявка не найдена.", show_alert=True)
-                        return
-                    
-                    if order['status'] != 'created':
-                        await call.answer(f"❌ Заявка уже имеет статус: {order['status']}", show_alert=True)
-                        return
-                    
-                    # Обновляем статус на "на контроле" и сохраняем примечание
-                    await conn.execute('''
-                        UPDATE "VSEPExchanger"."transactions"
-                        SET status = 'control', status_changed_at = NOW(), note = $2
-                        WHERE transaction_number = $1
-                    ''', transaction_number, crm_number)
-                    
-                    # Записываем в историю
-                    now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                    user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
-                    
-                    # Формируем ссылку на сообщение
-                    if call.message.chat.username:
-                        link = f"https://t.me/{call.message.chat.username}/{call.message.message_id}"
-                    else:
-                        chat_id_num = str(call.message.chat.id)
-                        if chat_id_num.startswith('-100'):
-                            chat_id_num = chat_id_num[4:]
-                        elif chat_id_num.startswith('-'):
-                            chat_id_num = chat_id_num[1:]
-                        link = f"https://t.me/c/{chat_id_num}/{call.message.message_id}"
-                    
-                    control_entry = f"{now_str}${user_nick}$контроль${link}"
-                    
-                    # Получаем старую историю и добавляем новую запись
-                    old_history = await conn.fetchval('''
-                        SELECT history FROM "VSEPExchanger"."transactions"
-                        WHERE transaction_number = $1
-                    ''', transaction_number)
-                    
-                    if old_history:
-                        history = old_history + "%%%" + control_entry
-                    else:
-                        history = control_entry
-                    
-                    # Обновляем историю
-                    await conn.execute('''
-                        UPDATE "VSEPExchanger"."transactions"
-                        SET history = $2
-                        WHERE transaction_number = $1
-                    ''', transaction_number, history)
-                    
-                    log_func(f"Статус заявки {transaction_number} изменен: created -> control, note: '{crm_number}'")
-                
-                # Удаляем сообщение с кнопками
-                await call.message.delete()
-                
-                # Отменяем задачу истечения кнопок
-                state_data = await state.get_data()
-                expire_task = state_data.get('expire_task')
-                if expire_task and not expire_task.done():
-                    expire_task.cancel()
-                    log_func("Задача истечения кнопок отменена при выборе заявки")
-                # Очищаем message_id
-                active_control_message[call.message.chat.id] = None
-                
-                # Отправляем сообщение о том, что заявка отправлена на контроль
-                rub_amount = int(order['rub_amount']) if order['rub_amount'] else 0
-                idr_amount = int(order['idr_amount']) if order['idr_amount'] else 0
-                rub_formatted = f"{rub_amount:,}".replace(",", " ")
-                idr_formatted = f"{idr_amount:,}".replace(",", " ")
-                
-                control_message = (
-                    f"🟡 Заявка отправлена на контроль!\n\n"
-                    f"• Номер заявки: <code>{transaction_number}</code>\n"
-                    f"• Сумма: {rub_formatted} RUB | {idr_formatted} IDR\n"
-                    f"• Примечание: {crm_number}\n"
-                    f"🟡 Статус заявки: <b>НА КОНТРОЛЕ</b>\n\n"
-                    f"Операторы уведомлены.\nОжидайте подтверждения получения транзакции."
-                )
-                # Добавляем кнопку "Принять" для операторов/админов/суперадминов
-                from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-                accept_keyboard = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(text="✅ Подтвердить транзакцию (accept)", callback_data=f"accept_order_{transaction_number}")]
-                    ]
-                )
-                control_msg = await call.message.answer(control_message, reply_markup=accept_keyboard)
-                log_func("Отправлено сообщение о заявке на контроле с кнопкой Принять")
-                
-                # Сохраняем ID сообщения с кнопкой в состоянии для использования в accept callback
-                await state.update_data(control_message_id=control_msg.message_id)
-                
-                # Отправляем уведомление операторам
-                await process_control_request_with_order(call.message, crm_number, transaction_number, order, call.from_user)
-                
-                # Сбрасываем состояние
-                await state.clear()
-                
-            except Exception as e:
-                log_error(f"Ошибка при обновлении статуса заявки {transaction_number}: {e}")
-                await call.answer("❌ Произошла ошибка при обработке заявки.", show_alert=True)
-                return
+            async with order_locks.claim(transaction_number) as claimed:
+                if not claimed:
+                    await call.answer(ALREADY_IN_PROGRESS_TEXT, show_alert=True)
+                    return
+                if not await _control_order(call, state, transaction_number, crm_number):
+                    return
     
     # Сбрасываем состояние
     await state.clear()
@@ -716,7 +716,6 @@ async def report_callback_handler(call: CallbackQuery):
          now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
          user = call.from_user
          user_nick = f"@{user.username}" if user.username else user.full_name
-         now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
          
          # Формируем ссылку на сообщение
          msg_id = call.message.message_id
@@ -734,13 +733,7 @@ async def report_callback_handler(call: CallbackQuery):
          if not db.pool:
              await call.answer("Ошибка: база данных недоступна.", show_alert=True)
              return
-         async with db.pool.acquire() as conn:
-             rows = await conn.fetch('''
-                 SELECT transaction_number, rub_amount, idr_amount
-                 FROM "VSEPExchanger"."transactions"
-                 WHERE source_chat = $1 AND status = 'accept'
-                 ORDER BY status_changed_at
-             ''', str(chat_id))
+         rows = (await db.get_open_orders_by_chat(chat_id, statuses=('accept',)))['accept']
          
          if not rows:
             try:
@@ -752,22 +745,14 @@ async def report_callback_handler(call: CallbackQuery):
                      raise
             return
 
-         # Обновляем статус и историю для каждого ордера
-         total_idr = 0
-         for row in rows:
-             transaction_number = row['transaction_number']
-             idr = int(row['idr_amount']) if row['idr_amount'] else 0
-             total_idr += idr
-             
-             # Получаем текущую историю
-             transaction = await db.get_transaction_by_number(transaction_number)
-             old_history = transaction.get('history', '') if transaction else ''
-             new_entry = f"{now_str}&{user_nick}&bill&{link}"
-             history = old_history + "%%%" + new_entry if old_history else new_entry
-             
-             # Обновляем статус и историю
-             await db.update_transaction_status(transaction_number, "bill", now_utc)
-             await db.update_transaction_history(transaction_number, history)
+         # Переводим все ордера в bill одной транзакцией (статус + история)
+         rows = await db.transition_transactions(
+             [row['transaction_number'] for row in rows], "bill", now_utc, user_nick, link, expected_status="accept"
+         )
+         if not rows:
+             await call.answer("Нет заявок для формирования нового счета.", show_alert=True)
+             return
+         total_idr = sum(int(row['idr_amount']) if row['idr_amount'] else 0 for row in rows)
          
          # Формируем новое сообщение
          col1 = 15
@@ -821,13 +806,12 @@ async def cmd_sos(message: Message):
         link = f"https://t.me/c/{chat_id_num}/{msg_id}"
     user = message.from_user
     user_name = user.full_name
-    times = get_bali_and_msk_time_list()
     user_username = f"@{user.username}" if user.username else ""
     alert_text = (
         f"🚨 <b>ВНИМАНИЕ!</b>\n\n"
         f"<b>НАЖАТА КНОПКА 🆘!</b>\n\n"
         f"от {user_username} в чате <b>{chat_title}</b>\n"
-        f"🕒: {times[6]} (Bali) / {times[5]} (MSK)\n\n"
+        f"🕒: {clock.bali_msk_str()}\n\n"
         f"<b>S⭕️S - СРОЧНО ОТКРОЙТЕ СООБЩЕНИЕ!</b>\n\n"
 
         f"Ссылка на сообщение:\n{link}"
@@ -843,16 +827,16 @@ async def cmd_sos(message: Message):
     if not admins:
         admins = []
     superadmins = [u for u in admins if u.get('rang') == 'superadmin']
-    user_ids = set()
-    for u in operators + admins:
-        user_ids.add(u['id'])
-    for u in superadmins:
-        user_ids.add(u['id'])
-    for uid in user_ids:
-        try:
-            await message.bot.send_message(uid, alert_text, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"Не удалось отправить SOS пользователю {uid}: {e}")
+    recipients = {}
+    for u in operators + admins + superadmins:
+        recipients[u['id']] = f"@{u['nickneim']}" if u.get('nickneim') else str(u['id'])
+    # Личные сообщения всем операторам и админам — параллельно, в пределах лимитов Telegram
+    results = await broadcaster.broadcast(
+        "SOS",
+        recipients.items(),
+        lambda uid: message.bot.send_message(uid, alert_text, parse_mode="HTML")
+    )
+    await report_broadcast(message.bot, "SOS", results)
     await message.reply("SOS отправлен!")
 
 # Обработчики команд для оператора сервиса
@@ -1002,7 +986,7 @@ async def cmd_rate_show(message: Message):
 
 # Обработчики команд для супер админа
 async def is_superadmin(user_id: int) -> bool:
-    rank = await db.get_user_rank(user_id)
+    rank = await rank_cache.get(user_id)
     return rank in ("superadmin", "суперадмин")
 
 """🟡 Команда admin_show"""
@@ -1041,7 +1025,7 @@ async def cmd_admin_add(message: Message):
     username = user.username or user.full_name or f"id{user.id}"
     initiator_id = message.from_user.id
     # --- Добавить в базу, если нет ---
-    user_rank = await db.get_user_rank(user.id)
+    user_rank = await rank_cache.get(user.id)
     if not user_rank:
         await db.add_user_if_not_exists(user.id, username)
         await db.set_user_rank(user.id, "admin")
@@ -1179,7 +1163,7 @@ async def cmd_operator_add(message: Message):
     username = user.username or user.full_name or f"id{user.id}"
     initiator_id = message.from_user.id
     # --- Добавить в базу, если нет ---
-    user_rank = await db.get_user_rank(user.id)
+    user_rank = await rank_cache.get(user.id)
     if not user_rank:
         await db.add_user_if_not_exists(user.id, username)
         await db.set_user_rank(user.id, "operator")
@@ -1319,7 +1303,7 @@ async def cmd_operator_show(message: Message):
 async def cmd_help(message: Message):
     print(f"=== CMD_HELP CALLED by {message.from_user.id} ===")
     log_system(f"CMD_HELP CALLED by {message.from_user.id}")
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     logger.info(f"[MSG] chat_id={message.chat.id}; user_id={message.from_user.id}; username={message.from_user.username}; rank={user_rank}; action=received; text={message.text}")
     help_text = build_pretty_help_text(user_rank)
     await message.reply(help_text)
@@ -1328,7 +1312,7 @@ async def cmd_help(message: Message):
 """🟡 Команда start"""
 @router.message(CommandStart())
 async def cmd_start(message: Message):
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     logger.info(f"[MSG] chat_id={message.chat.id}; user_id={message.from_user.id}; username={message.from_user.username}; rank={user_rank}; action=received; text={message.text}")
     await message.answer("Привет! Я VSEP бот. Используйте /help для просмотра доступных команд.")
     logger.info(f"[BOT_MSG] chat_id={message.chat.id}; to_user={message.from_user.id}; action=bot_send; text=Привет! Я VSEP бот. Используйте /help для просмотра доступных команд.")
@@ -1336,7 +1320,7 @@ async def cmd_start(message: Message):
 """🟡 Команда check"""
 @router.message(Command("check"))
 async def cmd_check(message: Message):
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     logger.info(f"[MSG] chat_id={message.chat.id}; user_id={message.from_user.id}; username={message.from_user.username}; rank={user_rank}; action=received; text={message.text}")
     try:
         chat = message.chat
@@ -1408,13 +1392,15 @@ async def cmd_order_show(message: Message):
     if not transaction:
         await message.reply("Заявка с таким номером не найдена.")
         return
+    # Номер мог быть введён коротким кодом (T2N9) — дальше работаем с полным номером
+    order_number = transaction['transaction_number']
     # Определяем возврат или обычная заявка
     is_refund = int(transaction.get('idr_amount', 0)) < 0 or int(transaction.get('rub_amount', 0)) < 0
     idr = abs(int(transaction.get('idr_amount', 0)))
     rub = abs(int(transaction.get('rub_amount', 0)))
     # Формируем заголовок
     lines = []
-    lines.append(f"<b>Карточка заявки № <code>{order_number}</code></b>")
+    lines.append(f"<b>Карточка заявки № <code>{order_number}</code></b> (<code>{encode_tx_id(transaction.get('tx_id'))}</code>)")
     if is_refund:
         lines.append(f"\n<b>Сумма возврата:</b> {fmt_0(rub)} RUB ⏮ {fmt_0(idr)} IDR")
     else:
@@ -1426,56 +1412,8 @@ async def cmd_order_show(message: Message):
         note = '-'
     lines.append(f"<b>Note:</b> {note}")
     # История статусов
-    history = transaction.get('history', '')
-    hist_lines = []
-    if history:
-        events = history.split('%%%')
-        prev_time = None
-        for idx, ev in enumerate(events):
-            # Поддержка $ и & как разделителей
-            if '$' in ev:
-                parts = ev.split('$', 3)
-            else:
-                parts = ev.split('&', 3)
-            if len(parts) < 4:
-                if idx == 0 and ev.strip():
-                    hist_lines.append(f"{ev.strip()} (создано)")
-                continue
-            dt_str, user, status, link = [p.strip() for p in parts]
-            try:
-                dt = datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
-                dt_bali = dt.replace(tzinfo=timezone.utc).astimezone(BALI_TZ)
-            except Exception:
-                dt = None
-                dt_bali = None
-            status_map = {
-                'night': 'night',
-                'control': 'control',
-                'accept': 'accept',
-                'accounted': 'accounted',
-                'created': 'created',
-                'создан': 'создан',
-                'cancel': 'cancel',
-            }
-            status_disp = status_map.get(status, status)
-            time_str = dt_bali.strftime("%H:%M") if dt_bali else "--:--"
-            if idx == 0:
-                # Первая строка — дата дд.мм.гг
-                date_str = dt_bali.strftime("%d.%m.%y") if dt_bali else "--.--.--"
-                hist_lines.append(f"{date_str} {status_disp}: {time_str} {user} (<a href='{link}'>link</a>)")
-            else:
-                # Разница во времени с предыдущим статусом
-                if prev_time and dt:
-                    delta = dt - prev_time
-                    total_seconds = int(delta.total_seconds())
-                    hours = total_seconds // 3600
-                    minutes = (total_seconds % 3600) // 60
-                    seconds = total_seconds % 60
-                    delta_str = f"+{hours:02}:{minutes:02}:{seconds:02}"
-                else:
-                    delta_str = "+--:--:--"
-                hist_lines.append(f"{delta_str} {status_disp}: {time_str} {user} (<a href='{link}'>link</a>)")
-            prev_time = dt
+    events = await db.get_transaction_events(transaction['transaction_number'])
+    hist_lines = format_history_lines(events)
     if hist_lines:
         lines.append("\n<b>Хронология:</b>")
         lines.extend(hist_lines)
@@ -1530,14 +1468,7 @@ async def cmd_transfer(message: Message):
     if not db.pool:
         await progress_msg.edit_text("Ошибка: база данных недоступна.")
         return
-    async with db.pool.acquire() as conn:
-        rows = await conn.fetch('''
-            SELECT transaction_number, rub_amount, idr_amount, status
-            FROM "VSEPExchanger"."transactions"
-            WHERE source_chat = $1 
-            AND status = 'bill'
-            ORDER BY status_changed_at
-        ''', str(chat_id))
+    rows = (await db.get_open_orders_by_chat(chat_id, statuses=('bill',)))['bill']
 
     if not rows:
         await progress_msg.edit_text("Не найдено ордеров со статусом 'bill'.")
@@ -1563,7 +1494,6 @@ async def cmd_transfer(message: Message):
     now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
     user = message.from_user
     user_nick = f"@{user.username}" if user.username else user.full_name
-    now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
     chat_id = message.chat.id
     msg_id = message.message_id
@@ -1577,50 +1507,129 @@ async def cmd_transfer(message: Message):
             chat_id_num = chat_id_num[1:]
         link = f"https://t.me/c/{chat_id_num}/{msg_id}"
 
-    # Список данных для записи в Google Sheets
-    gsheet_rows = []
-
-    for row in rows:
-        transaction_number = row['transaction_number']
-        transaction = await db.get_transaction_by_number(transaction_number)
-        if not transaction:
-            continue  # если транзакция не найдена, пропускаем
-        old_history = transaction.get('history', '') if transaction else ''
-        new_entry = f"{now_str}&{user_nick}&accounted&{link}"
-        history = old_history + "%%%" + new_entry if old_history else new_entry
-        
-        # Обновляем статус и историю в базе данных
-        await db.update_transaction_status(transaction_number, "accounted", now_utc)
-        await db.update_transaction_history(transaction_number, history)
-        
-        # Подготавливаем данные для Google Sheets
-        # Формат: [transaction_number, user_nick, idr_amount, rub_amount, rate_used, status, note, account_info, history, source_chat, now_str, transfer_dt]
-        gsheet_row = [
-            transaction_number,
-            user_nick,
-            row['idr_amount'],
-            row['rub_amount'],
-            transaction.get('rate_used', 0) if transaction else 0,
-            'accounted',
-            transaction.get('note', '') if transaction else '',
-            transaction.get('account_info', '') if transaction else '',
-            history,
-            str(chat_id),
-            transaction.get('created_at', now_utc) if transaction else now_utc,
-            now_utc  # дата выполнения /transfer
-        ]
-        gsheet_rows.append(gsheet_row)
-
-    # Записываем все ордера в Google Sheets
+    # Переводим все ордера в accounted и ставим их в очередь Google Sheets одной транзакцией БД
+    # (статус + история + строки очереди): ордер не может стать accounted без строки для таблицы
     try:
-        await write_multiple_to_google_sheet(str(chat_id), gsheet_rows)
-        log_func(f"Успешно записано {len(gsheet_rows)} ордеров в Google Sheets")
+        async with db.transaction() as conn:
+            updated = await db.transition_transactions(
+                [row['transaction_number'] for row in rows], "accounted", now_utc, user_nick, link,
+                expected_status="bill", conn=conn
+            )
+            if updated:
+                histories = await db.get_transaction_events_bulk([t['transaction_number'] for t in updated], conn=conn)
+
+                # Список данных для записи в Google Sheets
+                # Формат: [transaction_number, user_nick, idr_amount, rub_amount, rate_used, status, note, account_info, history, source_chat, now_str, transfer_dt]
+                gsheet_rows = [
+                    [
+                        transaction['transaction_number'],
+                        user_nick,
+                        transaction['idr_amount'],
+                        transaction['rub_amount'],
+                        transaction.get('rate_used', 0),
+                        'accounted',
+                        transaction.get('note', ''),
+                        transaction.get('account_info', ''),
+                        history_to_legacy(histories.get(transaction['transaction_number'], [])),
+                        str(chat_id),
+                        transaction.get('created_at', now_utc),
+                        now_utc  # дата выполнения /transfer
+                    ]
+                    for transaction in updated
+                ]
+                await enqueue_google_sheet_rows(str(chat_id), gsheet_rows, conn=conn)
     except Exception as e:
-        log_error(f"Ошибка при записи в Google Sheets: {e}")
-        # Продолжаем выполнение, даже если Google Sheets недоступен
+        log_error(f"Ошибка при подтверждении трансфера (статусы ордеров не изменены): {e}")
+        await progress_msg.edit_text(
+            "🚫 НЕ ВЫПОЛНЕНО!\n\nПРИЧИНА: не удалось сохранить трансфер, статусы ордеров не изменены. Повторите команду."
+        )
+        return
+    if not updated:
+        await progress_msg.edit_text("Не найдено ордеров со статусом 'bill'.")
+        return
+    # Запись в таблицу выполнит фоновый воркер — будим его уже после commit
+    gsheet_outbox.wakeup()
+    log_func(f"В очередь Google Sheets поставлено {len(updated)} ордеров")
+    order_count = len(updated)
+    total_idr = sum(t['idr_amount'] for t in updated)
 
     await progress_msg.edit_text(f"🟢 ТРАНСФЕР ВЫПОЛНЕН!\n\nПодтверждена выплата {order_count} ордеров на сумму {fmt_0(total_idr)} IDR", parse_mode="HTML")
 
+@router.message(Command("gsheet_queue"))
+async def cmd_gsheet_queue(message: Message):
+    """🟡 Команда gsheet_queue: состояние очереди записи в Google Sheets (retry — вернуть failed в очередь)"""
+    if not await is_admin_or_superadmin(message.from_user.id):
+        await message.reply("Команда доступна только администраторам и супер-админам.")
+        return
+    args = (message.text or "").split()
+    if len(args) > 1 and args[1].lower() == "retry":
+        count = await db.retry_failed_gsheet_rows()
+        gsheet_outbox.wakeup()
+        await message.reply(f"🔄 Возвращено в очередь строк: {count}")
+        return
+    queue = await db.get_gsheet_queue()
+    if queue is None:
+        await message.reply("Ошибка: база данных недоступна.")
+        return
+    counts = queue['counts']
+    lines = [
+        "<b>🟤 Очередь Google Sheets</b>\n",
+        f"⏳ В очереди: {counts.get('pending', 0)}",
+        f"❌ Ошибка (failed): {counts.get('failed', 0)}",
+        f"✅ Записано: {counts.get('done', 0)}",
+    ]
+    if queue['rows']:
+        lines.append("\n<b>Незаписанные заявки:</b>")
+        for row in queue['rows']:
+            error = html.escape((row['last_error'] or '-')[:100])
+            lines.append(
+                f"<code>{row['transaction_number']}</code> | {row['worksheet_name'] or '-'} | {row['status']} | "
+                f"попыток: {row['attempts']} | {error}"
+            )
+    if counts.get('failed'):
+        lines.append("\n💡 <code>/gsheet_queue retry</code> — повторить строки со статусом failed")
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
+@router.message(Command("lanes"))
+async def cmd_lanes(message: Message):
+    """🟡 Команда lanes: очереди обработки обновлений по чатам"""
+    if not await is_admin_or_superadmin(message.from_user.id):
+        await message.reply("Команда доступна только администраторам и супер-админам.")
+        return
+    stats = chat_lanes.snapshot()
+    lines = [
+        "<b>🟤 Очереди обработки по чатам</b>\n",
+        f"⚙️ Выполняется: {stats['in_flight']} из {stats['max_concurrency']}",
+        f"⏳ Ожидают: {stats['queued']} (активных очередей: {stats['lanes']})",
+        f"✅ Обработано: {stats['processed']}",
+        f"📈 Макс. глубина очереди: {stats['max_depth']}, макс. ожидание: {stats['max_wait']} с",
+    ]
+    if stats['busiest']:
+        lines.append("\n<b>Самые длинные очереди:</b>")
+        for chat_id, depth in stats['busiest']:
+            title = html.escape(await db.get_chat_title(chat_id) or str(chat_id))
+            lines.append(f"{title} (<code>{chat_id}</code>): {depth}")
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
+@router.message(Command("db_stats"))
+async def cmd_db_stats(message: Message):
+    """🟡 Команда db_stats: время выполнения запросов реестра db_queries"""
+    if not await is_admin_or_superadmin(message.from_user.id):
+        await message.reply("Команда доступна только администраторам и супер-админам.")
+        return
+    rows = query_stats.snapshot()
+    if not rows:
+        await message.reply("Запросов к БД пока не было.")
+        return
+    since = datetime.fromtimestamp(query_stats.started_at).strftime('%d.%m.%Y %H:%M')
+    lines = [f"<b>🟤 Запросы к БД с {since}</b>\n"]
+    for row in rows:
+        lines.append(
+            f"<code>{row['name']}</code>: {row['calls']} шт., "
+            f"всего {row['total_ms']:.0f} мс, сред. {row['avg_ms']:.1f} мс, макс. {row['max_ms']:.1f} мс"
+        )
+    await message.reply("\n".join(lines), parse_mode="HTML")
+
 @router.message(Command("rate_change"))
 async def cmd_rate_change(message: Message, state: FSMContext):
     """🟡 Команда rate_change"""
@@ -1777,6 +1786,12 @@ async def process_shift_time(message: Message, state: FSMContext):
         from config import system_settings
         system_settings.shift_start_time = start_time
         system_settings.shift_end_time = end_time
+        shift_state.configure(start_time, end_time)
+
+        # Пересобираем расписание открытия/закрытия смены
+        scheduler = get_scheduler()
+        if scheduler:
+            await scheduler.reschedule()
         
         response = (
             f"✅ <b>Время смены успешно изменено!</b>\n\n"
@@ -1961,27 +1976,10 @@ async def cmd_status(message: Message):
         if not db.pool:
             await message.reply("Ошибка: база данных недоступна.")
             return
-        async with db.pool.acquire() as conn:
-            created_rows = await conn.fetch('''
-                SELECT transaction_number, rub_amount, idr_amount
-                FROM "VSEPExchanger"."transactions"
-                WHERE source_chat = $1 AND status = 'created'
-                ORDER BY status_changed_at
-            ''', str(chat_id))
-            
-            accept_rows = await conn.fetch('''
-                SELECT transaction_number, rub_amount, idr_amount
-                FROM "VSEPExchanger"."transactions"
-                WHERE source_chat = $1 AND status = 'accept'
-                ORDER BY status_changed_at
-            ''', str(chat_id))
-            
-            bill_rows = await conn.fetch('''
-                SELECT transaction_number, rub_amount, idr_amount
-                FROM "VSEPExchanger"."transactions"
-                WHERE source_chat = $1 AND status = 'bill'
-                ORDER BY status_changed_at
-            ''', str(chat_id))
+        open_orders = await db.get_open_orders_by_chat(chat_id)
+        created_rows = open_orders['created']
+        accept_rows = open_orders['accept']
+        bill_rows = open_orders['bill']
 
         if not created_rows and not accept_rows and not bill_rows:
             logger.info(f"[STATUS] В чате {chat_id} нет открытых заявок")
@@ -2133,13 +2131,7 @@ async def cmd_control(message: Message, state: FSMContext = None):
     except Exception as e:
         log_func(f"Ошибка при обработке старых сообщений: {e}")
     
-    async with db.pool.acquire() as conn:
-        created_orders = await conn.fetch('''
-            SELECT transaction_number, rub_amount, idr_amount
-            FROM "VSEPExchanger"."transactions"
-            WHERE source_chat = $1 AND status = 'created'
-            ORDER BY status_changed_at
-        ''', str(chat.id))
+    created_orders = (await db.get_open_orders_by_chat(chat.id, statuses=('created',)))['created']
     
     if not created_orders:
         text = f'''❌ Нет активных заявок для контроля. Сначала создайте заявку.
@@ -2204,8 +2196,10 @@ async def cmd_control(message: Message, state: FSMContext = None):
     # Запускаем задачу для автоматического устаревания кнопок через 1 минуту
     task = asyncio.create_task(expire_control_buttons(message.bot, message.chat.id, message.message_id + 1, 120, base_text=base_text))  # +1 потому что reply
     
-    # Сохраняем задачу в состоянии для возможности отмены
-    await state.update_data(expire_task=task)
+    # Запоминаем задачу для возможности отмены
+    task_key = (message.chat.id, msg.message_id)
+    control_expire_tasks[task_key] = task
+    task.add_done_callback(lambda _: control_expire_tasks.pop(task_key, None))
 
 @router.message(Command("report"))
 async def cmd_report(message: Message):
@@ -2220,34 +2214,16 @@ async def cmd_report(message: Message):
     if not db.pool:
         await message.reply("Ошибка: база данных недоступна.")
         return
-    async with db.pool.acquire() as conn:
-        created_rows = await conn.fetch('''
-            SELECT transaction_number, rub_amount, idr_amount
-            FROM "VSEPExchanger"."transactions"
-            WHERE source_chat = $1 AND status = 'created'
-            ORDER BY status_changed_at
-        ''', str(chat_id))
-        
-        accept_rows = await conn.fetch('''
-            SELECT transaction_number, rub_amount, idr_amount
-            FROM "VSEPExchanger"."transactions"
-            WHERE source_chat = $1 AND status = 'accept'
-            ORDER BY status_changed_at
-        ''', str(chat_id))
-        
-        bill_rows = await conn.fetch('''
-            SELECT transaction_number, rub_amount, idr_amount
-            FROM "VSEPExchanger"."transactions"
-            WHERE source_chat = $1 AND status = 'bill'
-            ORDER BY status_changed_at
-        ''', str(chat_id))
+    open_orders = await db.get_open_orders_by_chat(chat_id)
+    created_rows = open_orders['created']
+    accept_rows = open_orders['accept']
+    bill_rows = open_orders['bill']
 
     col1 = 15
     col2 = 12
     col3 = 12
     # Время
-    times = get_bali_and_msk_time_list()
-    dt_line = f"REPORT from🕒 {times[6]} (Bali) / {times[5]} (MSK)"
+    dt_line = f"REPORT from🕒 {clock.bali_msk_str()}"
     
     # Формируем отчет
     report_parts = []
@@ -2419,82 +2395,12 @@ async def report_vsep_rate_input(message: Message, state: FSMContext):
     await message.reply(f"⏳ Формирую отчёт за <b>{month}</b> по курсу <b>{rate}</b>...", parse_mode="HTML")
     try:
         report_data = await asyncio.get_event_loop().run_in_executor(None, read_sum_all_report, month)
-        print(f"[DEBUG] report_data: {report_data}")
         if not report_data:
             await message.reply(f"❌ Нет данных за {month} на листе SUM_ALL.")
             await state.clear()
             return
-        # Формируем отчёт по проектам
-        lines = []
-        total_turnover = {}
-        total_commission = {}
-        import re
-        def parse_num(val, currency):
-            if not val:
-                return 0.0
-            # Сначала заменяем запятые на точки (для десятичных чисел)
-            val = re.sub(r",", ".", str(val))
-            # Затем удаляем все пробелы (включая неразрывные)
-            val = re.sub(r"\s", "", val)
-            if currency:
-                val = val.replace(currency, "")
-            try:
-                return float(val)
-            except Exception:
-                # Пробуем найти любое число в строке
-                m = re.search(r"([\d.]+)", val)
-                return float(m.group(1)) if m else 0.0
-        for row in report_data:
-            name = row['project']
-            count = row['count']
-            turnover = row['turnover']
-            commission = row['commission']
-            percent = row['commission_percent']
-            currency = row['currency']
-            comm_currency = row['commission_currency']
-            # Если валюта не найдена, определяем по названию проекта
-            if not currency:
-                if 'SAL' in name.upper():
-                    currency = 'USDT'
-                else:
-                    currency = 'IDR'
-            if not comm_currency:
-                comm_currency = currency
-            tval = parse_num(turnover, currency)
-            cval = parse_num(commission, comm_currency)
-            print(f"[DEBUG] {name}: оборот={tval} {currency}, комиссия={cval} {comm_currency}")
-            total_turnover[currency] = total_turnover.get(currency, 0) + tval
-            total_commission[comm_currency] = total_commission.get(comm_currency, 0) + cval
-            # Формат блока по проекту
-            lines.append(f"<b>{name}</b>\nКол-во сделок: <b>{count}</b>\nОборот: <b>{turnover}</b>\nУчастие: <b>{commission}</b> (<code>{percent}</code>)\n")
-        print(f"[DEBUG] total_turnover: {total_turnover}")
-        print(f"[DEBUG] total_commission: {total_commission}")
-        # Итоги по валютам
-        lines.append("<b>Итог: Оборот</b>")
-        for cur, val in total_turnover.items():
-            # Форматируем в европейском стиле: пробелы как разделители тысяч, запятые как десятичные
-            formatted = f"{val:,.2f}".replace(",", " ").replace(".", ",")
-            lines.append(f"<b>{formatted} {cur}</b>")
-        lines.append("\n<b>Итог: Участие</b>")
-        for cur, val in total_commission.items():
-            # Форматируем в европейском стиле: пробелы как разделители тысяч, запятые как десятичные
-            formatted = f"{val:,.2f}".replace(",", " ").replace(".", ",")
-            lines.append(f"<b>{formatted} {cur}</b>")
-        # Пересчёт в USDT
-        idr_total = total_turnover.get('IDR', 0)
-        idr_comm = total_commission.get('IDR', 0)
-        usdt_total = total_turnover.get('USDT', 0)
-        usdt_comm = total_commission.get('USDT', 0)
-        usdt_total_sum = usdt_total + (idr_total / rate if rate else 0)
-        usdt_comm_sum = usdt_comm + (idr_comm / rate if rate else 0)
-        lines.append(f"\n<b>Пересчёт по курсу {rate:,.2f}:</b>")
-        # Форматируем в европейском стиле
-        usdt_total_formatted = f"{usdt_total_sum:,.2f}".replace(",", " ").replace(".", ",")
-        usdt_comm_formatted = f"{usdt_comm_sum:,.2f}".replace(",", " ").replace(".", ",")
-        lines.append(f"Оборот в USDT: <b>{usdt_total_formatted}</b>")
-        lines.append(f"Участие в USDT: <b>{usdt_comm_formatted}</b>")
-        report_text = '\n'.join(lines)
-        await message.reply(report_text, parse_mode="HTML")
+        report = build_vsep_report(month, report_data)
+        await message.reply(report.render(rate_text), parse_mode="HTML")
     except Exception as e:
         await message.reply(f"❌ Ошибка при формировании отчёта: {e}")
     await state.clear()
@@ -2513,78 +2419,17 @@ async def report_vsep_bybit_rate_choice(call: CallbackQuery, state: FSMContext):
     month = data.get("selected_month")
     if call.data.startswith("use_bybit_rate_"):
         # Пользователь выбрал использовать курс Bybit
-        rate = float(call.data.split("_")[-1])
+        rate_text = call.data.split("_")[-1]
+        rate = float(rate_text)
         await call.message.edit_text(f"⏳ Формирую отчёт за <b>{month}</b> по курсу <b>{rate:,.2f}</b>...", parse_mode="HTML")
-        # Дублируем логику из report_vsep_rate_input
         try:
             report_data = await asyncio.get_event_loop().run_in_executor(None, read_sum_all_report, month)
-            print(f"[DEBUG] report_data: {report_data}")
             if not report_data:
                 await call.message.reply(f"❌ Нет данных за {month} на листе SUM_ALL.")
                 await state.clear()
                 return
-            # ... (оставить остальной код формирования отчёта без изменений)
-            # --- КОПИРУЕМ БЛОК ФОРМИРОВАНИЯ ОТЧЁТА из report_vsep_rate_input ---
-            lines = []
-            total_turnover = {}
-            total_commission = {}
-            import re
-            def parse_num(val, currency):
-                if not val:
-                    return 0.0
-                val = re.sub(r",", ".", str(val))
-                val = re.sub(r"\s", "", val)
-                if currency:
-                    val = val.replace(currency, "")
-                try:
-                    return float(val)
-                except Exception:
-                    m = re.search(r"([\d.]+)", val)
-                    return float(m.group(1)) if m else 0.0
-            for row in report_data:
-                name = row['project']
-                count = row['count']
-                turnover = row['turnover']
-                commission = row['commission']
-                percent = row['commission_percent']
-                currency = row['currency']
-                comm_currency = row['commission_currency']
-                if not currency:
-                    if 'SAL' in name.upper():
-                        currency = 'USDT'
-                    else:
-                        currency = 'IDR'
-                if not comm_currency:
-                    comm_currency = currency
-                tval = parse_num(turnover, currency)
-                cval = parse_num(commission, comm_currency)
-                print(f"[DEBUG] {name}: оборот={tval} {currency}, комиссия={cval} {comm_currency}")
-                total_turnover[currency] = total_turnover.get(currency, 0) + tval
-                total_commission[comm_currency] = total_commission.get(comm_currency, 0) + cval
-                lines.append(f"<b>{name}</b>\nКол-во сделок: <b>{count}</b>\nОборот: <b>{turnover}</b>\nУчастие: <b>{commission}</b> (<code>{percent}</code>)\n")
-            print(f"[DEBUG] total_turnover: {total_turnover}")
-            print(f"[DEBUG] total_commission: {total_commission}")
-            lines.append("<b>Итог: Оборот</b>")
-            for cur, val in total_turnover.items():
-                formatted = f"{val:,.2f}".replace(",", " ").replace(".", ",")
-                lines.append(f"<b>{formatted} {cur}</b>")
-            lines.append("\n<b>Итог: Участие</b>")
-            for cur, val in total_commission.items():
-                formatted = f"{val:,.2f}".replace(",", " ").replace(".", ",")
-                lines.append(f"<b>{formatted} {cur}</b>")
-            idr_total = total_turnover.get('IDR', 0)
-            idr_comm = total_commission.get('IDR', 0)
-            usdt_total = total_turnover.get('USDT', 0)
-            usdt_comm = total_commission.get('USDT', 0)
-            usdt_total_sum = usdt_total + (idr_total / rate if rate else 0)
-            usdt_comm_sum = usdt_comm + (idr_comm / rate if rate else 0)
-            lines.append(f"\n<b>Пересчёт по курсу {rate:,.2f}:</b>")
-            usdt_total_formatted = f"{usdt_total_sum:,.2f}".replace(",", " ").replace(".", ",")
-            usdt_comm_formatted = f"{usdt_comm_sum:,.2f}".replace(",", " ").replace(".", ",")
-            lines.append(f"Итог оборот в USDT: <b>{usdt_total_formatted}</b>")
-            lines.append(f"Итог участие в USDT: <b>{usdt_comm_formatted}</b>")
-            report_text = '\n'.join(lines)
-            await call.message.reply(report_text, parse_mode="HTML")
+            report = build_vsep_report(month, report_data)
+            await call.message.reply(report.render(rate_text), parse_mode="HTML")
         except Exception as e:
             await call.message.reply(f"❌ Ошибка при формировании отчёта: {e}")
         await state.clear()
@@ -2748,24 +2593,39 @@ async def expire_control_buttons(bot: Bot, chat_id: int, message_id: int, delay_
 @router.callback_query(lambda c: c.data.startswith("accept_order_"))
 async def accept_order_callback(call: CallbackQuery, state: FSMContext):
     transaction_number = call.data.split("_")[-1]
+    # Повторное нажатие уже выполненной кнопки — ответ без запросов к БД
+    if order_locks.is_done(call):
+        await answer_already_processed(call)
+        return
     user_id = call.from_user.id
     # Проверка прав
-    user_rank = await db.get_user_rank(user_id)
+    user_rank = await rank_cache.get(user_id)
     if user_rank not in ("operator", "admin", "superadmin"):
         await call.answer("Только оператор и админ Сервиса могут подтвердить!", show_alert=True)
         return
+    async with order_locks.claim(transaction_number) as claimed:
+        if not claimed:
+            await call.answer(ALREADY_IN_PROGRESS_TEXT, show_alert=True)
+            return
+        await _accept_order(call, transaction_number)
+
+async def _accept_order(call: CallbackQuery, transaction_number: str):
+    """Подтверждение заявки control → accept (выполняется под замком заявки)"""
     # Получаем заявку
     transaction = await db.get_transaction_by_number(transaction_number)
     if not transaction:
         await call.answer("Заявка не найдена.", show_alert=True)
         return
+    if transaction.get('status') == "accept":
+        order_locks.mark_done(call)
+        await answer_already_processed(call, "accept")
+        return
     if transaction.get('status') != "control":
         await call.answer(f"Заявка не на контроле (статус: {transaction.get('status')})", show_alert=True)
         return
     # Обновляем статус и историю
     from datetime import datetime, timezone
     now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
-    await db.update_transaction_status(transaction_number, "accept", now_utc)
     # Формируем запись в history
     now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
     user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
@@ -2781,19 +2641,19 @@ async def accept_order_callback(call: CallbackQuery, state: FSMContext):
         elif chat_id_num.startswith('-'):
             chat_id_num = chat_id_num[1:]
         link_accept = f"https://t.me/c/{chat_id_num}/{msg_id}"
-    accept_entry = f"{now_str}${user_nick}$accept${link_accept}"
-    old_history = transaction.get('history', '')
-    history = old_history + "%%%" + accept_entry if old_history else accept_entry
-    await db.update_transaction_history(transaction_number, history)
+    # Статус меняется, только если заявка всё ещё на контроле (иначе её уже подтвердили)
+    updated = await db.transition_transaction(
+        transaction_number, "control", "accept", now_utc, user_nick, "accept", link_accept
+    )
+    if updated is None:
+        order_locks.mark_done(call)
+        await answer_already_processed(call)
+        return
     
     # --- Уменьшаем счетчик контроля ---
-    counter = await db.get_control_counter(chat_id)
-    if counter > 0:
-        await db.set_control_counter(chat_id, counter - 1)
-        from logger import log_func, log_db
-        key = f"{chat_id}_control_counter"
-        log_func(f"Счетчик контроля для чата {chat_id} (ключ: {key}) уменьшен: {counter} -> {counter-1}")
-        log_db(f"[DB] set_system_setting: {key} = {counter-1}")
+    new_counter = await db.decrement_control_counter(chat_id)
+    if new_counter is not None:
+        log_func(f"Счетчик контроля для чата {chat_id} уменьшен: -> {new_counter}")
     
     # Удаляем кнопку и подписываем сообщение с активной ссылкой
     operator_name = call.from_user.full_name
@@ -2834,6 +2694,7 @@ async def accept_order_callback(call: CallbackQuery, state: FSMContext):
     active_link_text = f"✅ <a href=\"{link_to_notification}\">Заявка была акцептована</a>"
     
     new_text = call.message.text + f"\n\n{active_link_text}"
+    order_locks.mark_done(call)
     await call.message.edit_text(new_text, reply_markup=None, parse_mode="HTML")
     await call.answer("Заявка акцептована!")
 
@@ -2856,7 +2717,7 @@ async def cmd_zombie(message: Message, state: FSMContext):
     transaction_number = args[1].strip()
     
     # Проверка прав доступа
-    user_rank = await db.get_user_rank(message.from_user.id)
+    user_rank = await rank_cache.get(message.from_user.id)
     if user_rank not in ("operator", "admin", "superadmin"):
         await message.reply("🚫 Не выполнено.\nПРИЧИНА: команда доступна только оператору, админу и суперадмину.")
         return
@@ -2869,6 +2730,8 @@ async def cmd_zombie(message: Message, state: FSMContext):
             "ПРИЧИНА: заявка с таким номером не найдена."
         )
         return
+    # Номер мог быть введён коротким кодом (T2N9) — дальше работаем с полным номером
+    transaction_number = transaction['transaction_number']
     
     # Проверяем статус заявки
     if transaction.get('status') != "timeout":
@@ -2927,7 +2790,7 @@ async def zombie_callback_handler(call: CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
     
     # Проверка прав доступа
-    user_rank = await db.get_user_rank(user_id)
+    user_rank = await rank_cache.get(user_id)
     if user_rank not in ("operator", "admin", "superadmin"):
         await call.answer("🚫 Не ваша кнопка!", show_alert=True)
         return
@@ -2955,70 +2818,90 @@ async def zombie_callback_handler(call: CallbackQuery, state: FSMContext):
         
         transaction_number = data_parts[2]
         
-        # Получаем заявку
-        transaction = await db.get_transaction_by_number(transaction_number)
-        if not transaction:
-            await call.answer("❌ Заявка не найдена!", show_alert=True)
+        # Повторное нажатие уже выполненной кнопки — ответ без запросов к БД
+        if order_locks.is_done(call):
+            await answer_already_processed(call)
             return
-        
-        if transaction.get('status') != "timeout":
-            await call.answer("❌ Статус заявки изменился!", show_alert=True)
+        async with order_locks.claim(transaction_number) as claimed:
+            if not claimed:
+                await call.answer(ALREADY_IN_PROGRESS_TEXT, show_alert=True)
+                return
+            await _zombie_confirm(call, transaction_number)
+
+async def _zombie_confirm(call: CallbackQuery, transaction_number: str):
+    """Реанимация заявки timeout → created (выполняется под замком заявки)"""
+    user_id = call.from_user.id
+    # Получаем заявку
+    transaction = await db.get_transaction_by_number(transaction_number)
+    if not transaction:
+        await call.answer("❌ Заявка не найдена!", show_alert=True)
+        return
+    
+    if transaction.get('status') == "created":
+        order_locks.mark_done(call)
+        await answer_already_processed(call, "created")
+        return
+    if transaction.get('status') != "timeout":
+        await call.answer("❌ Статус заявки изменился!", show_alert=True)
+        return
+    
+    try:
+        # Обновляем статус заявки
+        from datetime import datetime, timezone
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        
+        # Добавляем запись в историю
+        now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
+        chat_id = call.message.chat.id
+        msg_id = call.message.message_id
+        
+        # Формируем ссылку на сообщение
+        if call.message.chat.username:
+            link = f"https://t.me/{call.message.chat.username}/{msg_id}"
+        else:
+            chat_id_num = str(chat_id)
+            if chat_id_num.startswith('-100'):
+                chat_id_num = chat_id_num[4:]
+            elif chat_id_num.startswith('-'):
+                chat_id_num = chat_id_num[1:]
+            link = f"https://t.me/c/{chat_id_num}/{msg_id}"
+        
+        # Статус и запись в историю — только если заявка всё ещё в timeout (иначе её уже оживили)
+        updated = await db.transition_transaction(
+            transaction_number, "timeout", "created", now_utc, user_nick, "реанимация", link
+        )
+        if updated is None:
+            order_locks.mark_done(call)
+            await answer_already_processed(call)
             return
         
-        try:
-            # Обновляем статус заявки
-            from datetime import datetime, timezone
-            now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
-            await db.update_transaction_status(transaction_number, "created", now_utc)
-            
-            # Добавляем запись в историю
-            now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            user_nick = f"@{call.from_user.username}" if call.from_user.username else call.from_user.full_name
-            chat_id = call.message.chat.id
-            msg_id = call.message.message_id
-            
-            # Формируем ссылку на сообщение
-            if call.message.chat.username:
-                link = f"https://t.me/{call.message.chat.username}/{msg_id}"
-            else:
-                chat_id_num = str(chat_id)
-                if chat_id_num.startswith('-100'):
-                    chat_id_num = chat_id_num[4:]
-                elif chat_id_num.startswith('-'):
-                    chat_id_num = chat_id_num[1:]
-                link = f"https://t.me/c/{chat_id_num}/{msg_id}"
-            
-            # Добавляем запись в историю
-            zombie_entry = f"{now_str}${user_nick}$реанимация${link}"
-            old_history = transaction.get('history', '')
-            history = old_history + "%%%" + zombie_entry if old_history else zombie_entry
-            await db.update_transaction_history(transaction_number, history)
-            
-            # Форматируем данные для сообщения
-            rub_amount = int(transaction['rub_amount']) if transaction['rub_amount'] else 0
-            idr_amount = int(transaction['idr_amount']) if transaction['idr_amount'] else 0
-            rub_formatted = f"{rub_amount:,}".replace(",", " ")
-            idr_formatted = f"{idr_amount:,}".replace(",", " ")
-            
-            # Обновляем сообщение
-            success_text = (
-                f"👻 <b>ЗАЯВКА ОЖИВЛЕНА!</b>\n\n"
-                f"📋 <b></b> <code>{transaction_number}</code>\n"
-                f"💰 <b>Сумма:</b> {rub_formatted} RUB ({idr_formatted} IDR)\n"
-                f"👤 <b>Оживил:</b> {user_nick}\n"
-                f"🕐 <b>Время:</b> {now_str}\n\n"
-                f"🔄 <b>Статус заявки изменен:</b> ⚫<i>timeout</i> → ⚪<b>created</b>"
-            )
-            
-            await call.message.edit_text(success_text, parse_mode="HTML")
-            await call.answer("👻 Заявка успешно оживлена!")
-            
-            log_func(f"Заявка {transaction_number} оживлена пользователем {user_id} ({user_nick})")
-            
-        except Exception as e:
-            log_error(f"Ошибка при оживлении заявки {transaction_number}: {e}")
-            await call.answer("❌ Произошла ошибка при оживлении!", show_alert=True)
-            return
+        # Форматируем данные для сообщения
+        rub_amount = int(transaction['rub_amount']) if transaction['rub_amount'] else 0
+        idr_amount = int(transaction['idr_amount']) if transaction['idr_amount'] else 0
+        rub_formatted = f"{rub_amount:,}".replace(",", " ")
+        idr_formatted = f"{idr_amount:,}".replace(",", " ")
+        
+        # Обновляем сообщение
+        success_text = (
+            f"👻 <b>ЗАЯВКА ОЖИВЛЕНА!</b>\n\n"
+            f"📋 <b></b> <code>{transaction_number}</code>\n"
+            f"💰 <b>Сумма:</b> {rub_formatted} RUB ({idr_formatted} IDR)\n"
+            f"👤 <b>Оживил:</b> {user_nick}\n"
+            f"🕐 <b>Время:</b> {now_str}\n\n"
+            f"🔄 <b>Статус заявки изменен:</b> ⚫<i>timeout</i> → ⚪<b>created</b>"
+        )
+        
+        order_locks.mark_done(call)
+        await call.message.edit_text(success_text, parse_mode="HTML")
+        await call.answer("👻 Заявка успешно оживлена!")
+        
+        log_func(f"Заявка {transaction_number} оживлена пользователем {user_id} ({user_nick})")
+        
+    except Exception as e:
+        log_error(f"Ошибка при оживлении заявки {transaction_number}: {e}")
+        await call.answer("❌ Произошла ошибка при оживлении!", show_alert=True)
+        return
 
 # === КОМАНДА АНЕКДОТОВ ===
 @router.message(Command("joke"))
@@ -3098,14 +2981,18 @@ async def month_year_calendar_callback(call: CallbackQuery, state: FSMContext):
         month_name = months_short[month - 1]
         month_str = f"{month_name}{year}"
         await state.update_data(selected_month=month_str)
-        # Пробуем получить курс с Bybit P2P
+        # Курс Bybit P2P из фонового сборщика (медиана за окно); если замеров нет — запрос напрямую
         try:
-            rate = await get_p2p_idr_usdt_avg_rate()
+            rate = rate_feed.median("p2p", RATE_FEED_REPORT_WINDOW)
+            rate_note = f"медиана за {RATE_FEED_REPORT_WINDOW // 60} мин"
+            if not rate:
+                rate = await get_p2p_idr_usdt_avg_rate()
+                rate_note = "текущий"
             if rate and rate > 0:
                 rate_str = f"{rate:,.2f}".replace(",", " ").replace(".", ",")
                 text = (
                     f"📅 Выбран: <b>{calendar.months['ru_RU'][month-1]} {year}</b>\n\n"
-                    f"💱 Курс IDR→USDT с Bybit P2P: <b>{rate_str}</b>\n\n"
+                    f"💱 Курс IDR→USDT с Bybit P2P ({rate_note}): <b>{rate_str}</b>\n\n"
                     f"Использовать этот курс?"
                 )
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -50,7 +50,10 @@ HELP_COMMANDS = {
         ("/meme", "Получить случайный мем"),
         ("/order_show", "Показать информацию о заявке"),
         ("/order_change", "Изменить статус заявки"),
-        ("/transfer", "Подтвердить перевод средств")
+        ("/transfer", "Подтвердить перевод средств"),
+        ("/gsheet_queue", "Очередь записи в Google Sheets"),
+        ("/lanes", "Очереди обработки по чатам"),
+        ("/db_stats", "Время запросов к БД")
     ],
     "superadmin": [
         ("/start", "Запустить бота"),
@@ -222,7 +225,10 @@ def build_pretty_help_text(status):
                      "✦ <code>/check_control</code> - отчет по количеству запросов на контроле\n"
                      "✦ <code>/zombie [order_number]</code> - оживить заявку из архива (timeout → created)\n"),
         ("admin", "<u><b>👨🏻‍💼 + для админа Cервиса:</b></u>\n"
-                  "✦ <code>/transfer [сумма]</code> - подтверждение оплаты ордеров из отчета (с вложением)\n\n"
+                  "✦ <code>/transfer [сумма]</code> - подтверждение оплаты ордеров из отчета (с вложением)\n"
+                  "✦ <code>/gsheet_queue</code> - очередь записи ордеров в Google Sheets\n"
+                  "✦ <code>/lanes</code> - очереди обработки сообщений по чатам\n"
+                  "✦ <code>/db_stats</code> - самые затратные запросы к БД\n\n"
                   "✦ <code>/bank_remove</code> - удалить реквизиты навсегда\n"
                   "✦ <code>/operator_show</code> - показать всех операторов\n"
                   "✦ <code>/operator_add</code> - назначить оператора сервиса\n"
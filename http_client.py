@@ -0,0 +1,80 @@
+"""
+🟤 Общие HTTP-сессии
+====================
+Реестр aiohttp.ClientSession на всё приложение: одна сессия на профиль (bybit, web),
+соединения переиспользуются (keep-alive), число соединений к одному хосту ограничено,
+таймауты заданы по умолчанию. Сессии открываются в main.py и закрываются при остановке бота.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import aiohttp
+
+from logger import log_system
+
+WEB_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+
+@dataclass(frozen=True)
+class HttpProfile:
+    """Настройки одной сессии"""
+    total_timeout: float = 10
+    connect_timeout: float = 5
+    limit_per_host: int = 4
+    keepalive_timeout: float = 30
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+HTTP_PROFILES: Dict[str, HttpProfile] = {
+    # API Bybit: курсы для /report_vsep, /bybit и т.п.
+    "bybit": HttpProfile(total_timeout=10, connect_timeout=5, limit_per_host=4),
+    # Мемы и анекдоты
+    "web": HttpProfile(total_timeout=10, connect_timeout=5, limit_per_host=2, headers={'User-Agent': WEB_USER_AGENT}),
+}
+
+
+class HttpClients:
+
+    def __init__(self, profiles: Dict[str, HttpProfile]):
+        self.profiles = profiles
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    def _create(self, name: str) -> aiohttp.ClientSession:
+        profile = self.profiles[name]
+        connector = aiohttp.TCPConnector(
+            limit_per_host=profile.limit_per_host,
+            keepalive_timeout=profile.keepalive_timeout,
+            ttl_dns_cache=300,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=profile.total_timeout, connect=profile.connect_timeout),
+            headers=profile.headers,
+        )
+
+    def open(self):
+        """Создаёт сессии всех профилей (вызывается из main.py внутри event loop)"""
+        for name in self.profiles:
+            self.get(name)
+        log_system(f"HttpClients: открыты HTTP-сессии {', '.join(self.profiles)}")
+
+    def get(self, name: str) -> aiohttp.ClientSession:
+        """Сессия профиля; создаётся при первом обращении или после закрытия"""
+        session: Optional[aiohttp.ClientSession] = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._create(name)
+            self._sessions[name] = session
+        return session
+
+    async def close(self):
+        """Закрывает все сессии (при остановке бота)"""
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            if not session.closed:
+                await session.close()
+        if sessions:
+            log_system("HttpClients: HTTP-сессии закрыты")
+
+
+# Глобальный реестр HTTP-сессий
+http_clients = HttpClients(HTTP_PROFILES)
@@ -8,6 +8,7 @@ import asyncio
 import random
 from typing import Optional, List, Dict, Any
 from logger import logger, log_func, log_error
+from http_client import http_clients
 import re
 from bs4 import BeautifulSoup
 import json
@@ -22,19 +23,13 @@ class JokeParser:
         self.cache_size = 50
         
     async def __aenter__(self):
-        """Асинхронный контекстный менеджер - вход"""
-        self.session = aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=10),
-            headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-        )
+        """Асинхронный контекстный менеджер - вход: берём общую сессию "web" (таймаут и User-Agent заданы в ней)"""
+        self.session = http_clients.get("web")
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        """Асинхронный контекстный менеджер - выход"""
-        if self.session:
-            await self.session.close()
+        """Асинхронный контекстный менеджер - выход: общая сессия не закрывается"""
+        self.session = None
     
     async def get_joke_from_anekdot_ru(self) -> Optional[str]:
         """Получить анекдот с anekdot.ru"""
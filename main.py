@@ -7,7 +7,6 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
 from aiogram.types import Message
 import logging
-from aiogram.fsm.storage.memory import MemoryStorage
 import traceback
 
 from config import config, system_settings
@@ -16,7 +15,18 @@ from scheduler import Scheduler, init_scheduler
 from handlers import register_handlers, set_commands, cmd_help, cmd_start, cmd_check
 from messages import send_startup_message
 from db import db
+from rate_cache import rate_cache
+from chat_profiles import chat_profiles
+from rank_cache import rank_cache
+from user_buffer import user_buffer
+from http_client import http_clients
+from rate_feed import rate_feed
+from gsheet_outbox import gsheet_outbox
+from fsm_storage import fsm_storage
+from webhook_server import WebhookServer
+from chat_lanes import chat_lanes
 from middlewares import UserSaveMiddleware, ChatLoggerMiddleware
+from chat_logger import stop_chat_logger
 from callback_guard import CallbackInitiatorGuard
 
 async def main():
@@ -26,6 +36,8 @@ async def main():
     # Явным образом загружаем переменные окружения
     if not config.BOT_TOKEN:
         raise ValueError("Необходимо установить BOT_TOKEN в .env файле")
+    if config.BOT_MODE == "webhook" and not config.WEBHOOK_BASE_URL:
+        raise ValueError("Для режима webhook необходимо установить VSEP_WEBHOOK_BASE_URL")
 
     await db.connect()
     logger.info("База данных подключена")
@@ -43,8 +55,12 @@ async def main():
             raise RuntimeError("Не удалось загрузить системные настройки.")
 
     bot = Bot(token=str(config.BOT_TOKEN), default=DefaultBotProperties(parse_mode="HTML"))
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
+    # FSM-состояния в PostgreSQL: переживают перезапуск и общие для всех процессов бота.
+    # FSM-middleware подключается вручную после chat_lanes, чтобы состояние читалось в порядке очереди чата
+    fsm_storage.start()
+    dp = Dispatcher(storage=fsm_storage, disable_fsm=True)
+    dp.update.outer_middleware(chat_lanes)
+    dp.update.outer_middleware(dp.fsm)
     
     # Проверяем существование таблицы system_settings
     if not await db.check_system_settings_table():
@@ -58,6 +74,24 @@ async def main():
     # Загружаем системные настройки
     await system_settings.load()
 
+    # Загружаем снимок курсов в память
+    await rate_cache.refresh()
+
+    # Загружаем профили рабочих чатов (группы MBT/LGI/TCT)
+    await chat_profiles.load()
+
+    # Загружаем ранги персонала для проверок прав без запросов к БД
+    await rank_cache.load()
+
+    # Фоновое пакетное сохранение пользователей из UserSaveMiddleware
+    user_buffer.start()
+
+    # Общие HTTP-сессии (Bybit, мемы, анекдоты)
+    http_clients.open()
+
+    # Фоновый сбор курсов Bybit (спот и P2P)
+    rate_feed.start()
+
     # Подключаем middleware
     dp.message.middleware(ChatLoggerMiddleware())  # Сначала логирование
     dp.message.middleware(UserSaveMiddleware())   # Потом сохранение пользователя
@@ -67,6 +101,9 @@ async def main():
     
     scheduler = init_scheduler(bot)
 
+    # Фоновая запись очереди Google Sheets
+    gsheet_outbox.start(bot)
+
     # Регистрация обработчиков
     register_handlers(dp)
     log_system("Обработчики команд зарегистрированы")
@@ -88,16 +125,29 @@ async def main():
 
     # Запуск бота
     log_system("Бот запускается...")
-    log_system("Запуск polling...")
     try:
-        await asyncio.gather(dp.start_polling(bot, scheduler=scheduler), scheduler_task)
+        if config.BOT_MODE == "webhook":
+            log_system("Запуск webhook...")
+            server = WebhookServer(dp, bot, pending_limit=config.WEBHOOK_PENDING_LIMIT, scheduler=scheduler)
+            await asyncio.gather(server.run(), scheduler_task)
+        else:
+            log_system("Запуск polling...")
+            await bot.delete_webhook()
+            await asyncio.gather(dp.start_polling(bot, scheduler=scheduler), scheduler_task)
     except Exception as e:
-        log_system(f"Ошибка при запуске polling: {e}", level=logging.CRITICAL)
+        log_system(f"Ошибка при запуске бота ({config.BOT_MODE}): {e}", level=logging.CRITICAL)
         print(traceback.format_exc())
         raise
     finally:
+        scheduler.stop()
+        await gsheet_outbox.stop()
+        await user_buffer.stop()
+        await rate_feed.stop()
+        await fsm_storage.close()
+        await http_clients.close()
         await db.close()
         logger.info("База данных отключена")
+        stop_chat_logger()
         logger.info("Бот остановлен")
 
 async def on_startup():
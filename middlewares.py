@@ -1,17 +1,17 @@
 from aiogram import BaseMiddleware
 from aiogram.types import Message
-from db import db
 from logger import logger, log_system, log_user, log_func, log_warning, log_error
 from typing import Callable, Dict, Any, Awaitable
 from aiogram.types import CallbackQuery, ChatMemberUpdated
 from chat_logger import log_message
+from user_buffer import user_buffer
 
 class UserSaveMiddleware(BaseMiddleware):
     async def __call__(self, handler, event, data):
         if isinstance(event, Message) and event.from_user:
             user = event.from_user
             # log_func(f"Проверка пользователя: id={user.id}, username={user.username}")
-            await db.add_user_if_not_exists(user.id, user.username or user.full_name or "unknown")
+            user_buffer.add(user.id, user.username or user.full_name or "unknown")
         return await handler(event, data)
 
 class ChatLoggerMiddleware(BaseMiddleware):
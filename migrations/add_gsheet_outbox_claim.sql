@@ -0,0 +1,18 @@
+-- Миграция: захват строк очереди Google Sheets воркером
+-- Выполнить в схеме VSEPExchanger
+-- Воркер очереди запущен в каждом процессе бота: строки забираются UPDATE ... FOR UPDATE SKIP LOCKED
+-- со статусом 'sending' и сроком захвата locked_until. Строки упавшего воркера по истечении срока
+-- забирает другой процесс (повторная отправка пропускает заявки, уже записанные на лист)
+
+ALTER TABLE "VSEPExchanger"."gsheet_outbox"
+    ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP;
+
+-- Поиск просроченных захватов
+CREATE INDEX IF NOT EXISTS gsheet_outbox_sending_idx
+    ON "VSEPExchanger"."gsheet_outbox" (locked_until)
+    WHERE status = 'sending';
+
+-- Проверка результатов
+SELECT status, count(*), min(locked_until), max(locked_until)
+FROM "VSEPExchanger"."gsheet_outbox"
+GROUP BY status;
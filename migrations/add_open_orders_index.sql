@@ -0,0 +1,11 @@
+-- Миграция: частичный индекс для выборки открытых заявок чата (/status, /report, /control, /transfer)
+-- Выполнить в схеме VSEPExchanger
+
+-- CONCURRENTLY — без блокировки записи в transactions (выполнять вне транзакции)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_open_orders_idx
+    ON "VSEPExchanger"."transactions" (source_chat, status, status_changed_at)
+    WHERE status IN ('created', 'accept', 'bill');
+
+-- Проверка результатов
+SELECT indexname, indexdef FROM pg_indexes
+WHERE schemaname = 'VSEPExchanger' AND indexname = 'transactions_open_orders_idx';
@@ -0,0 +1,35 @@
+-- Миграция: компактный числовой идентификатор заявки tx_id из последовательности
+-- Выполнить в схеме VSEPExchanger
+-- Человекочитаемый transaction_number остаётся; tx_id уникален для всех чатов
+-- и показывается пользователям как код "T" + base36 (например, T2N9)
+
+CREATE SEQUENCE IF NOT EXISTS "VSEPExchanger"."transactions_tx_id_seq";
+
+ALTER TABLE "VSEPExchanger"."transactions"
+    ADD COLUMN IF NOT EXISTS tx_id BIGINT;
+
+-- Нумерация существующих заявок в порядке создания
+UPDATE "VSEPExchanger"."transactions" t
+SET tx_id = n.tx_id
+FROM (
+    SELECT transaction_number, nextval('"VSEPExchanger"."transactions_tx_id_seq"') AS tx_id
+    FROM (
+        SELECT transaction_number FROM "VSEPExchanger"."transactions"
+        WHERE tx_id IS NULL
+        ORDER BY created_at, transaction_number
+    ) ordered
+) n
+WHERE t.transaction_number = n.transaction_number;
+
+ALTER TABLE "VSEPExchanger"."transactions"
+    ALTER COLUMN tx_id SET DEFAULT nextval('"VSEPExchanger"."transactions_tx_id_seq"'),
+    ALTER COLUMN tx_id SET NOT NULL;
+
+ALTER SEQUENCE "VSEPExchanger"."transactions_tx_id_seq" OWNED BY "VSEPExchanger"."transactions".tx_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_tx_id_idx
+    ON "VSEPExchanger"."transactions" (tx_id);
+
+-- Проверка результатов
+SELECT count(*) AS transactions, min(tx_id), max(tx_id), count(DISTINCT tx_id) AS distinct_ids
+FROM "VSEPExchanger"."transactions";
@@ -0,0 +1,22 @@
+-- Миграция: счётчики контроля в отдельной таблице вместо ключей "{chat_id}_control_counter" в system_settings
+-- Выполнить в схеме VSEPExchanger
+
+CREATE TABLE IF NOT EXISTS "VSEPExchanger"."control_counter" (
+    chat_id BIGINT PRIMARY KEY,
+    counter INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Перенос текущих значений из system_settings
+INSERT INTO "VSEPExchanger"."control_counter" (chat_id, counter)
+SELECT replace(key, '_control_counter', '')::bigint, COALESCE(NULLIF(value, ''), '0')::integer
+FROM "VSEPExchanger"."system_settings"
+WHERE key ~ '^-?\d+_control_counter$'
+ON CONFLICT (chat_id) DO NOTHING;
+
+-- Старые ключи больше не используются
+DELETE FROM "VSEPExchanger"."system_settings"
+WHERE key ~ '^-?\d+_control_counter$';
+
+-- Проверка результатов
+SELECT chat_id, counter FROM "VSEPExchanger"."control_counter" ORDER BY counter DESC;
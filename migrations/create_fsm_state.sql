@@ -0,0 +1,19 @@
+-- Миграция: хранилище FSM-состояний aiogram (диалоги /rate_change, /worktime, /bank_new, /report_vsep, order_change)
+-- Выполнить в схеме VSEPExchanger
+
+-- Одна строка на ключ FSM (бот:чат:пользователь:тред:destiny)
+CREATE TABLE IF NOT EXISTS "VSEPExchanger"."fsm_state" (
+    key TEXT PRIMARY KEY,
+    state TEXT,                                   -- имя состояния (NULL — вне сценария)
+    data JSONB NOT NULL DEFAULT '{}'::jsonb,      -- данные сценария (state.update_data)
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMP NOT NULL                 -- после этого момента запись считается пустой и удаляется
+);
+
+-- Периодическая очистка просроченных записей
+CREATE INDEX IF NOT EXISTS fsm_state_expires_idx
+    ON "VSEPExchanger"."fsm_state" (expires_at);
+
+-- Проверка результатов
+SELECT count(*) AS total, count(*) FILTER (WHERE expires_at <= NOW()) AS expired
+FROM "VSEPExchanger"."fsm_state";
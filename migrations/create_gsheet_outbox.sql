@@ -0,0 +1,25 @@
+-- Миграция: очередь (outbox) записей в Google Sheets
+-- Выполнить в схеме VSEPExchanger
+
+-- Одна строка на заявку: повторная постановка той же заявки игнорируется (идемпотентность по transaction_number)
+CREATE TABLE IF NOT EXISTS "VSEPExchanger"."gsheet_outbox" (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_number TEXT NOT NULL UNIQUE,
+    chat_id TEXT NOT NULL,
+    worksheet_name TEXT,                          -- лист VSEP_MBT / VSEP_LGI / VSEP_TCT (NULL — определить при отправке)
+    row_data JSONB NOT NULL,                      -- готовая строка для append_rows
+    status TEXT NOT NULL DEFAULT 'pending',       -- pending / done / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+-- Выборка очереди воркером
+CREATE INDEX IF NOT EXISTS gsheet_outbox_pending_idx
+    ON "VSEPExchanger"."gsheet_outbox" (next_attempt_at, id)
+    WHERE status = 'pending';
+
+-- Проверка результатов
+SELECT status, count(*) FROM "VSEPExchanger"."gsheet_outbox" GROUP BY status;
@@ -0,0 +1,18 @@
+-- Миграция: история курсов Bybit, которую собирает фоновый сборщик rate_feed
+-- Выполнить в схеме VSEPExchanger
+
+CREATE TABLE IF NOT EXISTS "VSEPExchanger"."rate_sample" (
+    id BIGSERIAL PRIMARY KEY,
+    source TEXT NOT NULL,                 -- spot (последняя сделка USDT/IDR) / p2p (средняя цена офферов 3-10)
+    rate DOUBLE PRECISION NOT NULL,       -- IDR за 1 USDT
+    sampled_at TIMESTAMP NOT NULL         -- время замера (UTC, без зоны)
+);
+
+-- Прогрев буфера при старте и выборки истории за период
+CREATE INDEX IF NOT EXISTS rate_sample_source_time_idx
+    ON "VSEPExchanger"."rate_sample" (source, sampled_at);
+
+-- Проверка результатов
+SELECT source, count(*), min(sampled_at), max(sampled_at)
+FROM "VSEPExchanger"."rate_sample"
+GROUP BY source;
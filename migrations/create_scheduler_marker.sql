@@ -0,0 +1,12 @@
+-- Миграция: отметки последнего срабатывания задач планировщика (открытие/закрытие смены)
+-- Выполнить в схеме VSEPExchanger
+
+-- Одна строка на задачу: за какой плановый момент рассылка уже выполнена
+CREATE TABLE IF NOT EXISTS "VSEPExchanger"."scheduler_marker" (
+    job TEXT PRIMARY KEY,                         -- shift_start / shift_end
+    fired_for TIMESTAMP NOT NULL,                 -- плановый момент срабатывания (UTC, без зоны)
+    fired_at TIMESTAMP NOT NULL DEFAULT NOW()     -- когда фактически выполнено
+);
+
+-- Проверка результатов
+SELECT job, fired_for, fired_at FROM "VSEPExchanger"."scheduler_marker" ORDER BY job;
@@ -0,0 +1,49 @@
+-- Миграция: история заявок в отдельной таблице transaction_event вместо строки history с разделителями "%%%"
+-- Выполнить в схеме VSEPExchanger
+
+-- Таблица событий: только добавление, одна строка на событие
+CREATE TABLE IF NOT EXISTS "VSEPExchanger"."transaction_event" (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_number TEXT NOT NULL,
+    event_at TIMESTAMP,            -- время события (UTC, без зоны)
+    actor TEXT,                    -- @username или имя того, кто выполнил действие
+    status TEXT,                   -- создан / night / контроль / accept / bill / accounted / ...
+    link TEXT,                     -- ссылка на сообщение в Telegram
+    raw TEXT                       -- исходная строка старого формата, если её не удалось разобрать
+);
+
+CREATE INDEX IF NOT EXISTS transaction_event_number_idx
+    ON "VSEPExchanger"."transaction_event" (transaction_number, id);
+
+-- Перенос существующей истории: каждая запись "dt$user$status$link" (или через "&") — отдельная строка.
+-- Порядок событий сохраняется за счёт ORDER BY по позиции записи в строке.
+INSERT INTO "VSEPExchanger"."transaction_event" (transaction_number, event_at, actor, status, link, raw)
+SELECT
+    e.transaction_number,
+    CASE WHEN split_part(e.entry, e.sep, 1) ~ '^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$'
+         THEN split_part(e.entry, e.sep, 1)::timestamp END,
+    CASE WHEN e.parsed THEN trim(split_part(e.entry, e.sep, 2)) END,
+    CASE WHEN e.parsed THEN trim(split_part(e.entry, e.sep, 3)) END,
+    CASE WHEN e.parsed THEN trim(substring(e.entry FROM length(split_part(e.entry, e.sep, 1)) + length(split_part(e.entry, e.sep, 2)) + length(split_part(e.entry, e.sep, 3)) + 4)) END,
+    CASE WHEN e.parsed THEN NULL ELSE trim(e.entry) END
+FROM (
+    SELECT
+        t.transaction_number,
+        h.entry,
+        h.pos,
+        CASE WHEN h.entry LIKE '%$%' THEN '$' ELSE '&' END AS sep,
+        (array_length(string_to_array(h.entry, CASE WHEN h.entry LIKE '%$%' THEN '$' ELSE '&' END), 1) >= 4) AS parsed
+    FROM "VSEPExchanger"."transactions" t
+    CROSS JOIN LATERAL regexp_split_to_table(t.history, '%%%') WITH ORDINALITY AS h(entry, pos)
+    WHERE t.history IS NOT NULL AND t.history <> ''
+      AND NOT EXISTS (
+          SELECT 1 FROM "VSEPExchanger"."transaction_event" ev WHERE ev.transaction_number = t.transaction_number
+      )
+) e
+WHERE trim(e.entry) <> ''
+ORDER BY e.transaction_number, e.pos;
+
+-- Колонка history больше не пишется ботом и остаётся только для отката
+-- Проверка результатов
+SELECT count(*) AS events, count(DISTINCT transaction_number) AS transactions
+FROM "VSEPExchanger"."transaction_event";
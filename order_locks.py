@@ -0,0 +1,75 @@
+"""
+🟤 Защита смены статуса заявки от повторных нажатий
+===================================================
+Кнопки accept, control, zombie и order_change меняют статус заявки. Двойное нажатие
+или два оператора одновременно не должны давать двух смен статуса, двух записей в истории
+и двойного уменьшения счётчика контроля:
+- claim(номер) — замок на заявку в процессе бота; пока заявка обрабатывается,
+  повторное нажатие сразу получает ответ "уже обрабатывается", не дожидаясь замка;
+- is_done / mark_done — память об уже выполненных нажатиях: повтор отвечается без запросов к БД;
+- в БД статус меняется только из ожидаемого (db.transition_transaction), это защищает
+  и от параллельной обработки в другом процессе бота.
+"""
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, Set, Tuple
+
+from aiogram.types import CallbackQuery
+
+ORDER_DONE_TTL = 10 * 60     # сколько помнить выполненные нажатия, сек
+
+ALREADY_IN_PROGRESS_TEXT = "⏳ Заявка уже обрабатывается, подождите."
+ALREADY_PROCESSED_TEXT = "ℹ️ Заявка уже обработана."
+
+
+class OrderLocks:
+
+    def __init__(self, done_ttl: float = ORDER_DONE_TTL):
+        self.done_ttl = done_ttl
+        self._in_flight: Set[str] = set()
+        # {(чат, сообщение, callback_data): момент истечения}
+        self._done: Dict[Tuple[Hashable, ...], float] = {}
+
+    @staticmethod
+    def _callback_key(call: CallbackQuery) -> Tuple[Hashable, ...]:
+        if call.message is None:
+            return (call.inline_message_id, call.data)
+        return (call.message.chat.id, call.message.message_id, call.data)
+
+    def is_done(self, call: CallbackQuery) -> bool:
+        """Это нажатие уже выполнено раньше"""
+        expires = self._done.get(self._callback_key(call))
+        return expires is not None and expires > time.monotonic()
+
+    def mark_done(self, call: CallbackQuery):
+        now = time.monotonic()
+        if len(self._done) > 1000:
+            self._done = {key: expires for key, expires in self._done.items() if expires > now}
+        self._done[self._callback_key(call)] = now + self.done_ttl
+
+    @asynccontextmanager
+    async def claim(self, transaction_number: str) -> AsyncIterator[bool]:
+        """
+        Захват заявки без ожидания: True — заявка наша до выхода из блока,
+        False — её уже обрабатывает другое нажатие.
+        """
+        if transaction_number in self._in_flight:
+            yield False
+            return
+        self._in_flight.add(transaction_number)
+        try:
+            yield True
+        finally:
+            self._in_flight.discard(transaction_number)
+
+
+async def answer_already_processed(call: CallbackQuery, status: str | None = None):
+    """Ответ на повторное нажатие: всплывающее уведомление с текущим статусом заявки"""
+    text = ALREADY_PROCESSED_TEXT
+    if status:
+        text += f" Текущий статус: {status}"
+    await call.answer(text, show_alert=True)
+
+
+# Глобальные замки смены статуса заявок
+order_locks = OrderLocks()
@@ -1,13 +1,13 @@
-from db import db
+from rank_cache import rank_cache
 
 async def is_admin_or_superadmin(user_id: int) -> bool:
-    rank = await db.get_user_rank(user_id)
+    rank = await rank_cache.get(user_id)
     return rank in ("admin", "админ", "superadmin", "суперадмин")
 
 async def is_operator_or_admin(user_id: int) -> bool:
-    rank = await db.get_user_rank(user_id)
+    rank = await rank_cache.get(user_id)
     return rank in ("operator", "оператор", "admin", "админ", "superadmin", "суперадмин")
 
 async def is_superadmin(user_id: int) -> bool:
-    rank = await db.get_user_rank(user_id)
+    rank = await rank_cache.get(user_id)
     return rank in ("superadmin", "суперадмин") 
\ No newline at end of file
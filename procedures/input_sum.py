@@ -1,11 +1,16 @@
 import logging
 from datetime import datetime, timezone, time
-import pytz
 from aiogram.types import Message as TgMessage
 from aiogram import Bot
 from config import config, system_settings
-from messages import send_message, get_bali_and_msk_time_list
+from messages import send_message
+from time_utils import clock
 from db import db
+from transactions import TransactionEvent, encode_tx_id
+from rank_cache import rank_cache
+from rate_cache import rate_cache
+from chat_profiles import chat_profiles
+from shift_state import shift_state
 from logger import logger, log_system, log_user, log_func, log_db, log_warning, log_error
 from google_sync import write_to_google_sheet_async
 from utils import safe_send_media_with_caption
@@ -54,19 +59,13 @@ async def handle_input_sum(message: TgMessage):
     selected_media = None
     chat_type_for_media = None
     
-    # --- Получаем nickneim из базы данных ---
-    nickneim = await db.get_chat_nickneim(chat.id)
-    if nickneim:
-        nickneim_upper = nickneim.upper()
-        if nickneim_upper.startswith("MBT"):
-            selected_media = system_settings.media_mbt
-            chat_type_for_media = "MBT"
-        elif nickneim_upper.startswith("LGI"):
-            selected_media = system_settings.media_lgi
-            chat_type_for_media = "LGI"
-        elif nickneim_upper.startswith("TCT"):
-            selected_media = system_settings.media_tct
-            chat_type_for_media = "TCT"
+    # --- Получаем профиль чата из кэша (nickneim, тип, компания) ---
+    profile = await chat_profiles.get(chat.id)
+    nickneim = profile.nickneim if profile else None
+    nick3 = profile.nick3 if profile else "NON"
+    if profile and profile.media_slot:
+        selected_media = profile.media
+        chat_type_for_media = profile.nick3
     # ---
     
     log_system(f"[MEDIA_CHECK] Проверка медиа для чата '{chat_title}' (id: {chat.id}). nickneim: '{nickneim}', chat_type_for_media: '{chat_type_for_media}'")
@@ -109,26 +108,23 @@ async def handle_input_sum(message: TgMessage):
         return
 
     # --- Проверка ночного времени: если ночь, сразу обрабатываем ночную заявку и return ---
-    if is_night_shift():
-        rate = await db.get_actual_rate()
+    if await shift_state.is_night():
+        snapshot = await rate_cache.get()
+        rate = snapshot.actual if snapshot else None
         if not rate:
             await message.reply("Курсы не заданы. Обратитесь к оператору.")
             return
         idr_amount = value
         used_rate = float(rate['main_rate']) if value > 0 else float(rate['rate_back'])
         rub_amount = round(abs(idr_amount) / used_rate)
-        times = get_bali_and_msk_time_list()
-        bali_time = times[6]  # Полная дата и время по Бали
+        bali_time = clock.bali_datetime()  # Полная дата и время по Бали
         
-        now = datetime.now(pytz.timezone("Asia/Makassar"))
+        now = clock.now_bali()
         naive_now = now.replace(tzinfo=None)
         day = now.strftime('%d')
         month = now.strftime('%m')
         hour = now.strftime('%H')
         minute = now.strftime('%M')
-        # Получаем никнейм чата для формирования номера заявки
-        nickneim = await db.get_chat_nickneim(chat.id)
-        nick3 = (nickneim[:3].upper() if nickneim else "NON")
         transaction_number = f"{day}{month}{hour}{minute}{nick3}{message.message_id}"
         created_at = naive_now
         status = "night"
@@ -136,7 +132,7 @@ async def handle_input_sum(message: TgMessage):
         note = ""
         acc_info = "ночной запрос"
         log = ""
-        now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        event_at = datetime.utcnow().replace(microsecond=0)
         user_nick = f"@{user.username}" if user.username else user.full_name
         chat_id = message.chat.id
         msg_id = message.message_id
@@ -149,7 +145,7 @@ async def handle_input_sum(message: TgMessage):
             elif chat_id_num.startswith('-'):
                 chat_id_num = chat_id_num[1:]
             link = f"https://t.me/c/{chat_id_num}/{msg_id}"
-        history = f"{now_str}&{user_nick}&night&{link}"
+        event = TransactionEvent(transaction_number, event_at, user_nick, "night", link)
         source_chat = str(chat_id)
         await db.add_transaction(
             transaction_number=transaction_number,
@@ -163,7 +159,7 @@ async def handle_input_sum(message: TgMessage):
             status=status,
             status_changed_at=status_changed_at,
             log=log,
-            history=history,
+            event=event,
             source_chat=source_chat
         )
         
@@ -171,18 +167,8 @@ async def handle_input_sum(message: TgMessage):
         if value < 0:
             msg = await get_night_shift_message(bali_time)
         else:
-            # Получаем время смены из system_settings
-            shift_start = system_settings.shift_start_time
-            shift_end = system_settings.shift_end_time
-            # Преобразуем в строку формата HH:MM
-            if isinstance(shift_start, str):
-                shift_start_str = shift_start[:5]
-            else:
-                shift_start_str = shift_start.strftime('%H:%M')
-            if isinstance(shift_end, str):
-                shift_end_str = shift_end[:5]
-            else:
-                shift_end_str = shift_end.strftime('%H:%M')
+            # Время смены в формате HH:MM
+            shift_start_str, shift_end_str = shift_state.hours()
             msg = f"""
 Для оплаты заказа на:
                         🇮🇩 <b>{abs(idr_amount):,} IDR</b>
@@ -226,9 +212,10 @@ async def handle_input_sum(message: TgMessage):
         log_func("Пользователю отправлено сообщение о сумме (ночная смена)")
         return
 
-    # --- Получаем курсы и лимиты ---
-    rate = await db.get_actual_rate()
-    limits = await db.get_rate_limits()
+    # --- Получаем курсы и лимиты (из снимка в памяти, без похода в БД) ---
+    snapshot = await rate_cache.get()
+    rate = snapshot.actual if snapshot else None
+    limits = snapshot.limits if snapshot else None
     if not rate or not limits:
         await message.reply("Курсы или лимиты не заданы. Обратитесь к оператору.")
         return
@@ -239,7 +226,7 @@ async def handle_input_sum(message: TgMessage):
         speclimit = None
     
     if value > 0 or value < 0:
-        user_rank = await db.get_user_rank(message.from_user.id)
+        user_rank = await rank_cache.get(message.from_user.id)
         logger.info(f"[MSG] chat_id={message.chat.id}; user_id={message.from_user.id}; username={message.from_user.username}; rank={user_rank}; action=received; text={message.text}")
         idr_amount = value
         limits_list = [float(limits['main_rate']), float(limits['rate1']), float(limits['rate2']), float(limits['rate3'])]
@@ -263,16 +250,12 @@ async def handle_input_sum(message: TgMessage):
             spec_text = "" # Для возврата нет спец. реквизитов
             
             # --- Генерация номера заявки (возврат) ---
-            times = get_bali_and_msk_time_list()
-            now = datetime.now(pytz.timezone("Asia/Makassar"))
+            now = clock.now_bali()
             naive_now = now.replace(tzinfo=None)
             day = now.strftime('%d')
             month = now.strftime('%m')
             hour = now.strftime('%H')
             minute = now.strftime('%M')
-            # Получаем никнейм чата для формирования номера заявки
-            nickneim = await db.get_chat_nickneim(chat.id)
-            nick3 = (nickneim[:3].upper() if nickneim else "NON")
             transaction_number = f"{day}{month}.{hour}{minute}.{nick3}.{message.message_id}"
             created_at = naive_now
             status = "created"
@@ -280,7 +263,7 @@ async def handle_input_sum(message: TgMessage):
             note = ""
             acc_info = "обратный перевод"
             log = ""
-            now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            event_at = datetime.utcnow().replace(microsecond=0)
             user_nick = f"@{user.username}" if user.username else user.full_name
             chat_id = message.chat.id
             msg_id = message.message_id
@@ -293,9 +276,9 @@ async def handle_input_sum(message: TgMessage):
                 elif chat_id_num.startswith('-'):
                     chat_id_num = chat_id_num[1:]
                 link = f"https://t.me/c/{chat_id_num}/{msg_id}"
-            history = f"{now_str}-{user_nick}-создан-{link}"
+            event = TransactionEvent(transaction_number, event_at, user_nick, "создан", link)
             source_chat = str(chat_id)
-            await db.add_transaction(
+            tx_id = await db.add_transaction(
                 transaction_number=transaction_number,
                 user_id=user.id,
                 created_at=created_at,
@@ -307,7 +290,7 @@ async def handle_input_sum(message: TgMessage):
                 status=status,
                 status_changed_at=status_changed_at,
                 log=log,
-                history=history,
+                event=event,
                 source_chat=source_chat
             )
             
@@ -326,7 +309,7 @@ async def handle_input_sum(message: TgMessage):
             msg += "❗️ЭТО ВАЖНО*❗️(◕‿◕)\n\n"
             msg += "<blockquote>При оплате заказов с использованием иностранной валюты нам помогают партнеры из Программы Верифицированных Сервисов БалиФорума (https://t.me/balichatexchange/55612) - безопасность при обмене валют и оплате услуг на Бали и в Тайланде.</blockquote>\n"
             msg += "────⋆⋅☆⋅⋆────\n"
-            msg += f"⚪ <b><code>{transaction_number}</code></b> {times[3]} (Bali)"
+            msg += f"⚪ <b><code>{transaction_number}</code></b> (<code>{encode_tx_id(tx_id)}</code>) {clock.bali_time()} (Bali)"
 
             # --- Проверка медиа для возврата ---
             final_media_return = selected_media
@@ -363,7 +346,7 @@ async def handle_input_sum(message: TgMessage):
                 f"Курс возврата: {used_rate:.2f}\n"
                 f"Сумма: {abs(idr_amount):,} IDR = {rub_amount:,} RUB\n"
                 f"Реквизиты: {acc_info}\n"
-                f"🟡 ЗАЯВКА №{transaction_number} занесена в базу в {times[3]} (Bali)"
+                f"🟡 ЗАЯВКА №{transaction_number} занесена в базу в {clock.bali_time()} (Bali)"
             )
             admin_msg = admin_msg.replace(",", " ")
             await message.bot.send_message(config.ADMIN_GROUP, admin_msg)
@@ -404,16 +387,12 @@ async def handle_input_sum(message: TgMessage):
         ])
         
         # --- Генерация номера заявки (прямой перевод) ---
-        times = get_bali_and_msk_time_list()
-        now = datetime.now(pytz.timezone("Asia/Makassar"))
+        now = clock.now_bali()
         naive_now = now.replace(tzinfo=None)
         day = now.strftime('%d')
         month = now.strftime('%m')
         hour = now.strftime('%H')
         minute = now.strftime('%M')
-        # Получаем никнейм чата для формирования номера заявки
-        nickneim = await db.get_chat_nickneim(chat.id)
-        nick3 = (nickneim[:3].upper() if nickneim else "NON")
         transaction_number = f"{day}{month}.{hour}{minute}.{nick3}.{message.message_id}"
         created_at = naive_now
         status = "created"
@@ -430,7 +409,7 @@ async def handle_input_sum(message: TgMessage):
         log = ""
         
         # --- Запись в базу ---
-        now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        event_at = datetime.utcnow().replace(microsecond=0)
         user_nick = f"@{user.username}" if user.username else user.full_name
         chat_id = message.chat.id
         msg_id = message.message_id
@@ -443,9 +422,9 @@ async def handle_input_sum(message: TgMessage):
             elif chat_id_num.startswith('-'):
                 chat_id_num = chat_id_num[1:]
             link = f"https://t.me/c/{chat_id_num}/{msg_id}"
-        history = f"{now_str}${user_nick}$создан${link}"
+        event = TransactionEvent(transaction_number, event_at, user_nick, "создан", link)
         source_chat = str(chat_id)
-        await db.add_transaction(
+        tx_id = await db.add_transaction(
             transaction_number=transaction_number,
             user_id=user.id,
             created_at=created_at,
@@ -457,7 +436,7 @@ async def handle_input_sum(message: TgMessage):
             status=status,
             status_changed_at=status_changed_at,
             log=log,
-            history=history,
+            event=event,
             source_chat=source_chat
         )
         
@@ -481,7 +460,7 @@ async def handle_input_sum(message: TgMessage):
         msg += "🚨 При оплате по неправильным или просроченным реквизитами, на другой банк или с карты третьего лица, деньги могут быть утеряны и не подлежат возврату!\n"
         msg += "<blockquote>При оплате заказов с использованием иностранной валюты нам помогают партнеры из Программы Верифицированных Сервисов БалиФорума (https://t.me/balichatexchange/55612) - безопасность при обмене валют и оплате услуг на Бали и в Тайланде.</blockquote>\n"
         msg += "────⋆⋅☆⋅⋆────\n"
-        msg += f"⚪ <b><code>{transaction_number}</code></b> {times[3]} (Bali)"
+        msg += f"⚪ <b><code>{transaction_number}</code></b> (<code>{encode_tx_id(tx_id)}</code>) {clock.bali_time()} (Bali)"
 
         # --- Проверка медиа для основного сообщения ---
         final_media = selected_media
@@ -515,25 +494,8 @@ async def handle_input_sum(message: TgMessage):
         log_func("Пользователю отправлено сообщение о сумме")
         
         # --- Информационное сообщение ---
-        company_name = ""
-        try:
-            if db.pool is not None:
-                group_row = await db.pool.fetchrow(
-                    'SELECT nickneim FROM "VSEPExchanger"."user" WHERE rang = $1 AND id = $2',
-                    'group', message.chat.id
-                )
-                if group_row and group_row['nickneim']:
-                    nick = group_row['nickneim']
-                    logger.info(f"[COMPANY_NAME] Original nick: {nick}")
-                    if '_' in nick:
-                        parts = nick.split('_', 1)
-                        company_name = parts[1].strip() if len(parts) > 1 else nick.strip()
-                    else:
-                        company_name = nick.strip()
-                        logger.info(f"[COMPANY_NAME] No dash, company_name: {company_name}")
-        except Exception as e:
-            logger.error(f"[COMPANY_NAME] Error getting company name: {e}")
-            company_name = ""
+        company_name = profile.company_name if profile else ""
+        logger.info(f"[COMPANY_NAME] Original nick: {nickneim}, company_name: {company_name}")
             
         info_msg = (
             "<b>Уважаемые Клиенты !!!</b>\n\n"
@@ -568,92 +530,16 @@ async def handle_input_sum(message: TgMessage):
 
     return
 
-def is_night_shift() -> bool:
-    """🔵 Проверка ночной смены"""
-    tz = pytz.timezone("Asia/Makassar")
-    now = datetime.now(tz).time()
-    
-    # Получаем время начала и конца смены из базы
-    shift_start = system_settings.shift_start_time
-    shift_end = system_settings.shift_end_time
-    
-    # Убеждаемся, что у нас объекты time
-    if isinstance(shift_start, str):
-        try:
-            start_time = datetime.strptime(shift_start, '%H:%M:%S').time()
-        except ValueError:
-            start_time = datetime.strptime(shift_start, '%H:%M').time()
-    else:
-        start_time = shift_start
-    
-    if isinstance(shift_end, str):
-        try:
-            end_time = datetime.strptime(shift_end, '%H:%M:%S').time()
-        except ValueError:
-            end_time = datetime.strptime(shift_end, '%H:%M').time()
-    else:
-        end_time = shift_end
-    
-    # Проверяем, находится ли текущее время в пределах смены
-    if start_time <= end_time:
-        return not (start_time <= now <= end_time)
-    else:
-        return end_time <= now <= start_time
-
 async def get_night_shift_message(bali_time: str) -> str:
     """🔵 Формирование сообщения о сумме (ночная смена)"""
-    shift_start = system_settings.shift_start_time
-    shift_end = system_settings.shift_end_time
-    
-    # Убеждаемся, что у нас объекты time
-    if isinstance(shift_start, str):
-        try:
-            start_time = datetime.strptime(shift_start, '%H:%M:%S').time()
-        except ValueError:
-            start_time = datetime.strptime(shift_start, '%H:%M').time()
-    else:
-        start_time = shift_start
-    
-    if isinstance(shift_end, str):
-        try:
-            end_time = datetime.strptime(shift_end, '%H:%M:%S').time()
-        except ValueError:
-            end_time = datetime.strptime(shift_end, '%H:%M').time()
-    else:
-        end_time = shift_end
-    
-    # Преобразуем объекты time в строки для отображения
-    shift_start_str = start_time.strftime('%H:%M')
-    shift_end_str = end_time.strftime('%H:%M')
+    shift_start_str, shift_end_str = shift_state.hours()
     msg = f"⚠️ Реквизиты для возврата принимаются с {shift_start_str} до {shift_end_str} по балийскому времени. Сейчас на Бали: {bali_time}\n"
     msg += f"⚠️ Реквизиты выдаются с {shift_start_str} до {shift_end_str} по балийскому времени. Сейчас на Бали: {bali_time}"
     return msg
 
 async def get_night_shift_message_with_sum(bali_time: str, sum_str: str) -> str:
     """🔵 Формирование сообщения о сумме с реквизитами (ночная смена)"""
-    shift_start = system_settings.shift_start_time
-    shift_end = system_settings.shift_end_time
-    
-    # Убеждаемся, что у нас объекты time
-    if isinstance(shift_start, str):
-        try:
-            start_time = datetime.strptime(shift_start, '%H:%M:%S').time()
-        except ValueError:
-            start_time = datetime.strptime(shift_start, '%H:%M').time()
-    else:
-        start_time = shift_start
-    
-    if isinstance(shift_end, str):
-        try:
-            end_time = datetime.strptime(shift_end, '%H:%M:%S').time()
-        except ValueError:
-            end_time = datetime.strptime(shift_end, '%H:%M').time()
-    else:
-        end_time = shift_end
-    
-    # Преобразуем объекты time в строки для отображения
-    shift_start_str = start_time.strftime('%H:%M')
-    shift_end_str = end_time.strftime('%H:%M')
+    shift_start_str, shift_end_str = shift_state.hours()
     msg = f"⚠️ Реквизиты выдаются с {shift_start_str} до {shift_end_str} по балийскому времени.\n"
     msg += f"Сумма: {sum_str}"
     return msg 
\ No newline at end of file
@@ -6,6 +6,7 @@ Callback handlers для изменения курсов валют с подт
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
 from db import db
+from rate_cache import rate_cache
 from logger import logger
 
 # === 🟣 CALLBACK HANDLERS ДЛЯ ИЗМЕНЕНИЯ КУРСОВ ===
@@ -59,8 +60,8 @@ async def rate_change_confirm(call: CallbackQuery, state: FSMContext):
     old_rate_special = old_rate_row['rate_special'] if old_rate_row else None
     rate_special = old_rate_special
     
-    # Проверяем, что пул базы данных доступен
-    if not db.pool:
+    # Снятие старого и вставка нового курса — одной транзакцией, затем подменяем снимок в кэше
+    if not await db.set_actual_rate(new_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, call.from_user.id):
         try:
             if call.message:
                 await call.message.edit_text("❌ Ошибка: база данных недоступна. Попробуйте позже.")  # type: ignore
@@ -68,12 +69,7 @@ async def rate_change_confirm(call: CallbackQuery, state: FSMContext):
             pass
         await state.clear()
         return
-    
-    await db.pool.execute('UPDATE "VSEPExchanger"."rate" SET is_actual=FALSE WHERE is_actual=TRUE')
-    await db.pool.execute('''
-        INSERT INTO "VSEPExchanger"."rate" (main_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, created_by, created_at, is_actual)
-        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, NOW(), TRUE)
-    ''', new_rate, rate1, rate2, rate3, rate4, rate_back, rate_special, call.from_user.id)
+    await rate_cache.refresh()
     try:
         if call.message:
             await call.message.edit_text("Курсы изменены!")  # type: ignore
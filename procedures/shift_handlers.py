@@ -4,7 +4,8 @@
 Callback handlers для принудительного открытия/закрытия смен
 """
 from aiogram.types import CallbackQuery
-from scheduler import scheduler
+from scheduler import get_scheduler
+from shift_state import shift_state
 from logger import logger
 
 # === 🟣 CALLBACK HANDLERS ДЛЯ СМЕН ===
@@ -16,9 +17,10 @@ async def force_open_callback(call: CallbackQuery, data: dict):
     """
     print("DATA IN force_open_callback:", data)
     if call.data == "force_open_yes":
+        scheduler = get_scheduler()
+        await shift_state.force_open()
         await scheduler.send_shift_start()
-        scheduler.sent_start_today = True
-        scheduler.sent_end_today = False
+        await scheduler.mark_fired_manually("shift_start")
         try:
             if call.message:
                 await call.message.edit_text("Смена принудительно открыта.")  # type: ignore
@@ -38,8 +40,10 @@ async def force_close_callback(call: CallbackQuery, data: dict):
     """
     print("DATA IN force_close_callback:", data)
     if call.data == "force_close_yes":
+        scheduler = get_scheduler()
+        await shift_state.force_close()
         await scheduler.send_shift_end()
-        scheduler.sent_end_today = True
+        await scheduler.mark_fired_manually("shift_end")
         try:
             if call.message:
                 await call.message.edit_text("Смена принудительно закрыта.")  # type: ignore
@@ -0,0 +1,106 @@
+"""
+🔵 Кэш рангов пользователей
+===========================
+Ранги персонала (operator/admin/superadmin и группы) загружаются из БД одним запросом при старте
+и перечитываются раз в RANK_CACHE_TTL секунд — так понижение или повышение, сделанное в другом
+процессе бота или прямо в БД, начинает действовать без перезапуска. Ранги обычных пользователей
+подгружаются по требованию в ограниченный LRU-кэш. db.set_user_rank сбрасывает запись сразу
+после записи в БД (в своём процессе).
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from db import db
+from logger import log_system, log_error
+
+# Максимум обычных пользователей в LRU-части кэша
+RANK_CACHE_MAX_USERS = 5000
+# Период перечитывания рангов персонала из БД, сек
+RANK_CACHE_TTL = 60
+
+
+class RankCache:
+
+    def __init__(self, max_users: int = RANK_CACHE_MAX_USERS, ttl: float = RANK_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        # Персонал и группы — не вытесняются, перечитываются целиком раз в ttl
+        self._staff: Dict[int, str] = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        # Обычные пользователи — LRU
+        self._users: "OrderedDict[int, str]" = OrderedDict()
+
+    async def load(self) -> bool:
+        """Загружает все ранги, отличные от 'user', одним запросом"""
+        async with self._lock:
+            loaded = await self._load()
+        if loaded:
+            log_system(f"RankCache: загружено рангов персонала и групп: {len(self._staff)}")
+        return loaded
+
+    async def _load(self) -> bool:
+        try:
+            rows = await db.get_privileged_ranks()
+        except Exception as e:
+            log_error(f"RankCache: ошибка загрузки рангов персонала: {e}")
+            return False
+        if rows is None:
+            return False
+        self._staff = {row['id']: row['rang'] for row in rows}
+        # Пользователи, повышенные в другом процессе, не должны читаться из LRU как 'user'
+        for user_id in self._staff:
+            self._users.pop(user_id, None)
+        self._loaded_at = time.monotonic()
+        return True
+
+    async def _refresh_staff(self):
+        if time.monotonic() - self._loaded_at <= self.ttl:
+            return
+        async with self._lock:
+            if time.monotonic() - self._loaded_at > self.ttl:
+                if not await self._load():
+                    # БД недоступна — работаем на старом наборе и не долбим БД на каждом сообщении
+                    self._loaded_at = time.monotonic()
+
+    def _remember(self, user_id: int, rank: str):
+        if rank == 'user':
+            self._staff.pop(user_id, None)
+            self._users[user_id] = rank
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.pop(user_id, None)
+            self._staff[user_id] = rank
+
+    async def get(self, user_id: int) -> Optional[str]:
+        """Ранг пользователя; при промахе — один запрос в БД с сохранением результата"""
+        await self._refresh_staff()
+        rank = self._staff.get(user_id)
+        if rank is not None:
+            return rank
+        rank = self._users.get(user_id)
+        if rank is not None:
+            self._users.move_to_end(user_id)
+            return rank
+        try:
+            rank = await db.get_user_rank(user_id)
+        except Exception as e:
+            log_error(f"RankCache: ошибка получения ранга {user_id}: {e}")
+            return None
+        # Отсутствие записи не кэшируем: пользователя вот-вот сохранит UserSaveMiddleware
+        if rank is not None:
+            self._remember(user_id, rank)
+        return rank
+
+    def invalidate(self, user_id: int):
+        """Удаляет ранг пользователя из кэша — следующий get() прочитает его из БД"""
+        self._staff.pop(user_id, None)
+        self._users.pop(user_id, None)
+
+
+# Глобальный экземпляр кэша рангов
+rank_cache = RankCache()
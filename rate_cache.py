@@ -0,0 +1,92 @@
+"""
+🟣 Кэш курсов валют
+===================
+Версионированный снимок актуального курса, лимитов и коэффициентов в памяти процесса.
+Загружается при старте, подменяется целиком после /rate_change и обновляется по TTL,
+чтобы обработка сумм не ходила в БД на каждое сообщение.
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from db import db
+from logger import log_system, log_error
+
+# Через сколько секунд снимок считается устаревшим и перечитывается из БД
+RATE_CACHE_TTL = 60
+
+
+@dataclass(frozen=True)
+class RateSnapshot:
+    """Неизменяемый снимок курсов: актуальный курс (is_actual), коэффициенты (id=1) и лимиты (id=2)"""
+    version: int
+    actual: Optional[dict]
+    coefs: Optional[dict]
+    limits: Optional[dict]
+    loaded_at: float
+
+    def is_expired(self, ttl: float = RATE_CACHE_TTL) -> bool:
+        return time.monotonic() - self.loaded_at > ttl
+
+
+class RateCache:
+    """
+    Держит последний снимок курсов. Снимок заменяется одной операцией присваивания,
+    поэтому читатели всегда видят согласованный набор actual/coefs/limits.
+    """
+
+    def __init__(self, ttl: float = RATE_CACHE_TTL):
+        self.ttl = ttl
+        self._snapshot: Optional[RateSnapshot] = None
+        self._version = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    async def refresh(self) -> Optional[RateSnapshot]:
+        """Перечитывает курсы из БД и атомарно подменяет снимок"""
+        async with self._lock:
+            return await self._load()
+
+    async def _load(self) -> Optional[RateSnapshot]:
+        try:
+            actual = await db.get_actual_rate()
+            coefs = await db.get_rate_coefficients()
+            limits = await db.get_rate_limits()
+        except Exception as e:
+            log_error(f"RateCache: не удалось загрузить курсы из БД: {e}")
+            # Если БД недоступна — продолжаем отдавать последний известный снимок
+            return self._snapshot
+        self._version += 1
+        self._snapshot = RateSnapshot(
+            version=self._version,
+            actual=actual,
+            coefs=coefs,
+            limits=limits,
+            loaded_at=time.monotonic(),
+        )
+        log_system(f"RateCache: загружен снимок курсов v{self._version}")
+        return self._snapshot
+
+    async def get(self) -> Optional[RateSnapshot]:
+        """Возвращает текущий снимок, перечитывая его, если он отсутствует или устарел по TTL"""
+        snapshot = self._snapshot
+        if snapshot is not None and not snapshot.is_expired(self.ttl):
+            return snapshot
+        async with self._lock:
+            # Пока ждали блокировку, снимок мог обновить другой обработчик
+            snapshot = self._snapshot
+            if snapshot is not None and not snapshot.is_expired(self.ttl):
+                return snapshot
+            return await self._load()
+
+    def invalidate(self):
+        """Помечает снимок устаревшим — следующий get() перечитает курсы из БД"""
+        self._snapshot = None
+
+
+# Глобальный экземпляр кэша курсов
+rate_cache = RateCache()
@@ -0,0 +1,180 @@
+"""
+🟤 Фоновый сбор курсов Bybit
+============================
+Раз в RATE_FEED_INTERVAL секунд опрашивает спот-тикер USDT/IDR и стакан P2P,
+складывает замеры в кольцевой буфер в памяти и пишет их в "VSEPExchanger"."rate_sample".
+Обработчики читают последнее значение, TWAP или медиану за окно без обращения к Bybit.
+При старте буфер прогревается из БД.
+Сборщик запущен в каждом процессе бота, но Bybit за один интервал опрашивает только процесс,
+забравший интервал в БД (отметка RATE_FEED_JOB в scheduler_marker); остальные подтягивают
+его замеры из rate_sample — в истории одна запись на источник за интервал.
+Он же раз в RATE_SAMPLE_PRUNE_INTERVAL удаляет из rate_sample замеры старше RATE_SAMPLE_RETENTION.
+"""
+import asyncio
+import statistics
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+from bybit_api import get_usdt_idr_price
+from bybit_p2p import get_p2p_idr_usdt_avg_rate
+from db import db
+from logger import log_system, log_error, log_warning
+
+RATE_FEED_INTERVAL = 60              # период опроса Bybit, сек
+RATE_FEED_HISTORY = 24 * 60 * 60     # глубина буфера в памяти, сек
+RATE_FEED_REPORT_WINDOW = 15 * 60    # окно медианы для /report_vsep, сек
+RATE_FEED_JOB = "rate_feed"          # отметка интервала сбора в scheduler_marker
+RATE_SAMPLE_RETENTION = 30 * 24 * 60 * 60   # сколько хранить замеры в rate_sample для сверок, сек
+RATE_SAMPLE_PRUNE_INTERVAL = 60 * 60        # как часто удалять устаревшие замеры, сек
+
+# Источники: spot — последняя сделка USDT/IDR, p2p — средняя цена офферов 3-10. Оба в IDR за 1 USDT
+RATE_SOURCES = {
+    "spot": get_usdt_idr_price,
+    "p2p": get_p2p_idr_usdt_avg_rate,
+}
+
+
+class RateFeed:
+
+    def __init__(self, interval: float = RATE_FEED_INTERVAL, history: float = RATE_FEED_HISTORY):
+        self.interval = interval
+        capacity = int(history // interval) + 1
+        # {source: deque[(unix time, rate)]}
+        self._samples: Dict[str, Deque[Tuple[float, float]]] = {
+            source: deque(maxlen=capacity) for source in RATE_SOURCES
+        }
+        self.history = history
+        self._pruned_at = float('-inf')
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    # --- Чтение ---
+    def last(self, source: str, max_age: Optional[float] = None) -> Optional[float]:
+        """Последний замер; None, если замеров нет или он старше max_age секунд"""
+        samples = self._samples[source]
+        if not samples:
+            return None
+        ts, rate = samples[-1]
+        if max_age is not None and time.time() - ts > max_age:
+            return None
+        return rate
+
+    def _window(self, source: str, window: float) -> List[Tuple[float, float]]:
+        since = time.time() - window
+        return [sample for sample in self._samples[source] if sample[0] >= since]
+
+    def twap(self, source: str, window: float) -> Optional[float]:
+        """Средний курс за окно, взвешенный по времени действия каждого замера"""
+        samples = self._window(source, window)
+        if not samples:
+            return None
+        now = time.time()
+        total = weighted = 0.0
+        for i, (ts, rate) in enumerate(samples):
+            until = samples[i + 1][0] if i + 1 < len(samples) else now
+            duration = max(until - ts, 0.0)
+            total += duration
+            weighted += rate * duration
+        return weighted / total if total else samples[-1][1]
+
+    def median(self, source: str, window: float) -> Optional[float]:
+        """Медиана замеров за окно"""
+        samples = self._window(source, window)
+        if not samples:
+            return None
+        return statistics.median(rate for _, rate in samples)
+
+    # --- Сбор ---
+    async def _load_new(self) -> int:
+        """
+        Добавляет в буфер замеры из БД, которых в нём ещё нет: по каждому источнику — новее его
+        последнего замера, но не глубже истории буфера (пустой или отставший источник не тянет лишнего)
+        """
+        oldest = time.time() - self.history
+        loaded = 0
+        for source, samples in self._samples.items():
+            since = max(samples[-1][0] if samples else 0.0, oldest)
+            rows = await db.get_rate_samples(source, datetime.fromtimestamp(since, timezone.utc).replace(tzinfo=None))
+            for row in rows:
+                samples.append((row['sampled_at'].replace(tzinfo=timezone.utc).timestamp(), float(row['rate'])))
+                loaded += 1
+        return loaded
+
+    async def warm_up(self):
+        """Заполняет буфер замерами из БД за глубину истории"""
+        loaded = await self._load_new()
+        log_system(f"RateFeed: из БД загружено замеров курса: {loaded}")
+
+    async def sync(self):
+        """Подтягивает из БД замеры, записанные процессом, который забрал интервал"""
+        await self._load_new()
+
+    async def prune(self):
+        """Удаляет из rate_sample замеры старше RATE_SAMPLE_RETENTION; не чаще раза в RATE_SAMPLE_PRUNE_INTERVAL"""
+        if time.monotonic() - self._pruned_at < RATE_SAMPLE_PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        before = datetime.fromtimestamp(time.time() - RATE_SAMPLE_RETENTION, timezone.utc).replace(tzinfo=None)
+        deleted = await db.delete_rate_samples_before(RATE_SOURCES, before)
+        if deleted:
+            log_system(f"RateFeed: удалено устаревших замеров курса: {deleted}")
+
+    async def _claim_interval(self) -> bool:
+        """Забирает текущий интервал сбора в БД: True — опрашивать Bybit должен этот процесс"""
+        slot = int(time.time() // self.interval) * self.interval
+        return await db.claim_scheduler_marker(
+            RATE_FEED_JOB, datetime.fromtimestamp(slot, timezone.utc).replace(tzinfo=None)
+        )
+
+    async def collect(self):
+        """Один замер по всем источникам: в буфер и в БД"""
+        sampled_at = datetime.now(timezone.utc)
+        results = await asyncio.gather(*(fetch() for fetch in RATE_SOURCES.values()), return_exceptions=True)
+        rows = []
+        for source, result in zip(RATE_SOURCES, results):
+            if isinstance(result, Exception) or not result:
+                log_warning(f"RateFeed: не удалось получить курс {source}: {result}")
+                continue
+            self._samples[source].append((sampled_at.timestamp(), float(result)))
+            rows.append((source, float(result), sampled_at.replace(tzinfo=None)))
+        if rows:
+            await db.add_rate_samples(rows)
+
+    async def _loop(self):
+        try:
+            await self.warm_up()
+        except Exception as e:
+            log_error(f"RateFeed: ошибка загрузки истории курсов: {e}")
+        while self._running:
+            started = time.monotonic()
+            try:
+                if await self._claim_interval():
+                    await self.collect()
+                    await self.prune()
+                else:
+                    await self.sync()
+            except Exception as e:
+                log_error(f"RateFeed: ошибка сбора курсов: {e}")
+            await asyncio.sleep(max(self.interval - (time.monotonic() - started), 1))
+
+    def start(self):
+        if self._task is None:
+            self._running = True
+            self._task = asyncio.create_task(self._loop())
+            log_system("RateFeed: фоновый сбор курсов Bybit запущен")
+
+    async def stop(self):
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Глобальный сборщик курсов Bybit
+rate_feed = RateFeed()
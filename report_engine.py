@@ -0,0 +1,113 @@
+"""
+🟤 Отчёт /report_vsep по листу SUM_ALL
+======================================
+Строки проектов из read_sum_all_report один раз разбираются в таблицу pandas
+с точными суммами Decimal. Итоги по валютам считаются группировкой,
+пересчёт в USDT — для любого количества курсов без повторного разбора.
+"""
+import re
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Dict, Iterable, List, Union
+
+import pandas as pd
+
+ZERO = Decimal("0")
+CENTS = Decimal("0.01")
+NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def parse_amount(value: str, currency: str = "") -> Decimal:
+    """
+    Сумма из ячейки вида "1 234 567,89 IDR" в Decimal.
+    Пробелы (в т.ч. неразрывные) и повторяющиеся разделители — разделители тысяч;
+    десятичный разделитель — последняя запятая или точка.
+    """
+    if not value:
+        return ZERO
+    text = str(value)
+    if currency:
+        text = text.replace(currency, "")
+    text = re.sub(r"[^\d,.\-]", "", text)
+    for sep in ",.":
+        # Повторяющийся разделитель — разделитель тысяч
+        if text.count(sep) > 1:
+            text = text.replace(sep, "")
+    if "," in text and "." in text:
+        # Разделитель тысяч — тот, что встречается раньше
+        thousands = "," if text.rfind(",") < text.rfind(".") else "."
+        text = text.replace(thousands, "")
+    text = text.replace(",", ".")
+    try:
+        return Decimal(text)
+    except InvalidOperation:
+        m = NUMBER_RE.search(text)
+        return Decimal(m.group(0)) if m else ZERO
+
+
+def fmt_amount(value: Decimal) -> str:
+    """Формат 1 234 567,89 (как fmt_2 в utils, но без перехода во float)"""
+    return f"{value.quantize(CENTS, rounding=ROUND_HALF_UP):,.2f}".replace(",", " ").replace(".", ",")
+
+
+def _default_currency(project: str) -> str:
+    # Если валюта не найдена в ячейке, определяем по названию проекта
+    return 'USDT' if 'SAL' in project.upper() else 'IDR'
+
+
+@dataclass
+class VsepReport:
+    month: str
+    projects: pd.DataFrame
+    turnover_totals: Dict[str, Decimal]
+    commission_totals: Dict[str, Decimal]
+
+    def usdt_totals(self, rates: Iterable[Union[Decimal, float, str]]) -> pd.DataFrame:
+        """Оборот и участие в USDT для каждого курса IDR→USDT: столбцы rate, turnover_usdt, commission_usdt"""
+        rate_series = pd.Series([Decimal(str(rate)) for rate in rates], dtype=object)
+
+        def to_usdt(totals: Dict[str, Decimal]) -> pd.Series:
+            idr, usdt = totals.get('IDR', ZERO), totals.get('USDT', ZERO)
+            return rate_series.map(lambda rate: usdt + (idr / rate if rate > 0 else ZERO))
+
+        return pd.DataFrame({
+            'rate': rate_series,
+            'turnover_usdt': to_usdt(self.turnover_totals),
+            'commission_usdt': to_usdt(self.commission_totals),
+        })
+
+    def render(self, rate: Union[Decimal, float, str]) -> str:
+        """HTML-текст отчёта с пересчётом по курсу rate"""
+        lines = [
+            f"<b>{row['project']}</b>\nКол-во сделок: <b>{row['count']}</b>\nОборот: <b>{row['turnover_raw']}</b>\n"
+            f"Участие: <b>{row['commission_raw']}</b> (<code>{row['commission_percent']}</code>)\n"
+            for row in self.projects.to_dict('records')
+        ]
+        lines.append("<b>Итог: Оборот</b>")
+        lines.extend(f"<b>{fmt_amount(val)} {cur}</b>" for cur, val in self.turnover_totals.items())
+        lines.append("\n<b>Итог: Участие</b>")
+        lines.extend(f"<b>{fmt_amount(val)} {cur}</b>" for cur, val in self.commission_totals.items())
+        converted = self.usdt_totals([rate]).iloc[0]
+        lines.append(f"\n<b>Пересчёт по курсу {fmt_amount(converted['rate'])}:</b>")
+        lines.append(f"Оборот в USDT: <b>{fmt_amount(converted['turnover_usdt'])}</b>")
+        lines.append(f"Участие в USDT: <b>{fmt_amount(converted['commission_usdt'])}</b>")
+        return '\n'.join(lines)
+
+
+def build_vsep_report(month: str, report_data: List[dict]) -> VsepReport:
+    """Разбирает строки read_sum_all_report в таблицу и считает итоги по валютам"""
+    df = pd.DataFrame(report_data, columns=[
+        'project', 'count', 'commission_percent', 'turnover', 'commission', 'currency', 'commission_currency'
+    ]).rename(columns={'turnover': 'turnover_raw', 'commission': 'commission_raw'})
+    if df.empty:
+        return VsepReport(month, df, {}, {})
+
+    df['currency'] = df['currency'].where(df['currency'] != '', df['project'].map(_default_currency))
+    df['commission_currency'] = df['commission_currency'].where(df['commission_currency'] != '', df['currency'])
+    df['turnover'] = [parse_amount(val, cur) for val, cur in zip(df['turnover_raw'], df['currency'])]
+    df['commission'] = [parse_amount(val, cur) for val, cur in zip(df['commission_raw'], df['commission_currency'])]
+
+    # Порядок валют — по первому появлению, как в таблице
+    turnover_totals = df.groupby('currency', sort=False)['turnover'].sum().to_dict()
+    commission_totals = df.groupby('commission_currency', sort=False)['commission'].sum().to_dict()
+    return VsepReport(month, df, turnover_totals, commission_totals)
@@ -1,17 +1,21 @@
 import asyncio
-from datetime import datetime, timedelta, time
+import heapq
+from datetime import date, datetime, timedelta, time
 import pytz
 from aiogram import Bot
 from config import config, system_settings
 from logger import log_system, log_info, log_error, log_warning
-from messages import get_bali_and_msk_time_list
+from time_utils import clock
 from db import db
 import logging
 import os
 from aiogram.types import FSInputFile
 from utils import safe_send_media_with_caption
+from broadcast import broadcaster, report_broadcast
+from shift_state import SHIFT_TZ, parse_shift_time, shift_state
 
-night_shift = False  # Глобальный флаг ночной смены
+SHIFT_JOBS = ("shift_start", "shift_end")
+SCHEDULER_MAX_SLEEP = 3600  # максимальный сон планировщика, сек
 
 class Scheduler:
     def __init__(self, bot: Bot):
@@ -19,14 +23,16 @@ class Scheduler:
         self.is_running = False
         self.shift_start = None
         self.shift_end = None
-        self.sent_start_today = False
-        self.sent_end_today = False
+        # Отметки последних срабатываний {job: плановый момент в UTC}, хранятся в БД
+        self._markers = {}
+        self._heap = []
+        self._reschedule = asyncio.Event()
+        self._task = None
 
     async def send_status_message(self):
         """Отправка сообщения о статусе бота"""
         try:
-            times = get_bali_and_msk_time_list()
-            message = f"🕐 {times[6]} (Bali) / {times[5]} (MSK)\nконтроль - ок✅, работает штатно"
+            message = f"🕐 {clock.bali_msk_str()}\nконтроль - ок✅, работает штатно"
             
             # Отправка сообщения в админскую группу
             await self.bot.send_message(
@@ -39,8 +45,6 @@ class Scheduler:
             log_system(f"Ошибка при отправке статусного сообщения: {e}", level=logging.ERROR)
 
     async def send_shift_end(self):
-        global night_shift
-        night_shift = True
         try:
             groups = await db.get_group_chats()
             admin_group = config.ADMIN_GROUP
@@ -89,13 +93,13 @@ class Scheduler:
             else:
                 log_system(f"[MEDIA_FOUND] Найдено медиа для конца смены: {system_settings.media_finish}")
 
-            # Отправляем в группы партнёров
-            for group in groups:
-                try:
-                    log_system(f"[SHIFT_END] Пробую отправить сообщение о закрытии смены в {group['id']}")
-                    await safe_send_media_with_caption(self.bot, group['id'], system_settings.media_finish, text)
-                except Exception as e:
-                    log_system(f"[SHIFT_END] Ошибка при отправке в группу {group['id']}: {e}", level=logging.ERROR)
+            # Отправляем в группы партнёров параллельно, в пределах лимитов Telegram
+            log_system(f"[SHIFT_END] Рассылка о закрытии смены в {len(groups or [])} групп")
+            results = await broadcaster.broadcast(
+                "Закрытие смены",
+                [(group['id'], group.get('nickneim') or str(group['id'])) for group in groups or []],
+                lambda chat_id: safe_send_media_with_caption(self.bot, chat_id, system_settings.media_finish, text)
+            )
 
             try:
                 log_system(f"[SHIFT_END] Пробую отправить сообщение о закрытии смены в админский чат {admin_group}")
@@ -103,6 +107,7 @@ class Scheduler:
             except Exception as e:
                 log_system(f"[SHIFT_END] Ошибка при отправке в админский чат {admin_group}: {e}", level=logging.ERROR)
 
+            await report_broadcast(self.bot, "Закрытие смены", results)
             log_system("[SHIFT_END] Рассылка об окончании смены отправлена")
         except Exception as e:
             log_system(f"[SHIFT_END] Ошибка при рассылке об окончании смены: {e}", level=logging.ERROR)
@@ -123,13 +128,10 @@ class Scheduler:
                 log_system("Нет подключенных групп для рассылки")
                 return
             
-            global night_shift
-            night_shift = False
             try:
                 # --- Обнуляем все заказы со статусом created во всех чатах ---
                 admin_group = config.ADMIN_GROUP
-                times = get_bali_and_msk_time_list()
-                today = times[6]  # дата и время по Бали
+                today = clock.bali_datetime()  # дата и время по Бали
 
                 # Формируем информацию о переведенных заявках
                 timeout_info = ""
@@ -166,12 +168,12 @@ class Scheduler:
                 else:
                     log_system(f"[MEDIA_FOUND] Найдено медиа для начала смены: {system_settings.media_start}")
 
-                for group in groups:
-                    try:
-                        log_system(f"[SHIFT_START] Пробую отправить сообщение о начале смены в {group['id']}")
-                        await safe_send_media_with_caption(self.bot, group['id'], system_settings.media_start, text)
-                    except Exception as e:
-                        log_system(f"[SHIFT_START] Ошибка при отправке в группу {group['id']}: {e}", level=logging.ERROR)
+                log_system(f"[SHIFT_START] Рассылка об открытии смены в {len(groups)} групп")
+                results = await broadcaster.broadcast(
+                    "Открытие смены",
+                    [(group['id'], group.get('nickneim') or str(group['id'])) for group in groups],
+                    lambda chat_id: safe_send_media_with_caption(self.bot, chat_id, system_settings.media_start, text)
+                )
 
                 try:
                     log_system(f"[SHIFT_START] Пробую отправить сообщение о начале смены в админский чат {admin_group}")
@@ -179,6 +181,7 @@ class Scheduler:
                 except Exception as e:
                     log_system(f"[SHIFT_START] Ошибка при отправке в админский чат {admin_group}: {e}", level=logging.ERROR)
 
+                await report_broadcast(self.bot, "Открытие смены", results)
                 log_system("[SHIFT_START] Рассылка об открытии смены отправлена")
             except Exception as e:
                 log_system(f"[SHIFT_START] Ошибка при рассылке об открытии смены: {e}", level=logging.ERROR)
@@ -193,18 +196,10 @@ class Scheduler:
             shift_start_datetime = datetime.combine(now.date(), self.shift_start)
             timeout_threshold = shift_start_datetime - timedelta(hours=12)
             
-            # Получаем все заказы со статусом created, созданные до порога времени
-            orders = await db.pool.fetch(
-                'SELECT transaction_number FROM "VSEPExchanger"."transactions" WHERE status = $1 AND created_at < $2',
-                'created', timeout_threshold
-            )
+            # Переводим в timeout все заказы со статусом created, созданные до порога времени (один UPDATE ... RETURNING)
+            orders = await db.timeout_created_orders(timeout_threshold, datetime.now())
             
             if orders:
-                # Обновляем статус на timeout
-                await db.pool.execute(
-                    'UPDATE "VSEPExchanger"."transactions" SET status = $1, status_changed_at = $2 WHERE status = $3 AND created_at < $4',
-                    'timeout', datetime.now(), 'created', timeout_threshold
-                )
                 log_system(f"[TIMEOUT] Переведено {len(orders)} заказов в статус timeout (созданных до {timeout_threshold.strftime('%d.%m.%Y %H:%M')})")
                 return len(orders), timeout_threshold.strftime('%d.%m.%Y %H:%M')
             else:
@@ -227,119 +222,183 @@ class Scheduler:
                 return False
                 
             # Парсим время из строки в объекты time
-            try:
-                # Пробуем сначала формат с секундами
-                self.shift_start = datetime.strptime(shift_start_str, '%H:%M:%S').time()
-                self.shift_end = datetime.strptime(shift_end_str, '%H:%M:%S').time()
-            except ValueError:
-                # Если не получилось, пробуем формат без секунд
-                self.shift_start = datetime.strptime(shift_start_str, '%H:%M').time()
-                self.shift_end = datetime.strptime(shift_end_str, '%H:%M').time()
-                
+            self.shift_start = parse_shift_time(shift_start_str)
+            self.shift_end = parse_shift_time(shift_end_str)
+            shift_state.configure(self.shift_start, self.shift_end)
+
             log_system(f"Время смены установлено: начало {self.shift_start}, конец {self.shift_end}")
             return True
         except Exception as e:
             log_system(f"Ошибка при обновлении времени смены: {e}", level=logging.ERROR)
             return False
 
-    def is_night_shift(self, current_time: datetime) -> bool:
-        """Проверяет, является ли текущее время ночной сменой"""
-        if not self.shift_start or not self.shift_end:
-            return False
-            
-        # Теперь shift_start и shift_end - это объекты time
-        start_time = self.shift_start
-        end_time = self.shift_end
-        current_time_only = current_time.time()
-        
-        # Проверяем, находится ли текущее время в пределах смены
-        if start_time <= end_time:
-            return not (start_time <= current_time_only <= end_time)
+    # === 🟤 ПЛАНИРОВАНИЕ ОТКРЫТИЯ/ЗАКРЫТИЯ СМЕНЫ ===
+
+    def _job_time(self, job: str) -> time:
+        return self.shift_start if job == "shift_start" else self.shift_end
+
+    def _occurrence(self, job: str, day: date) -> datetime:
+        """Плановый момент задачи в указанный балийский день (в UTC)"""
+        local = SHIFT_TZ.localize(datetime.combine(day, self._job_time(job)))
+        return local.astimezone(pytz.utc)
+
+    def _next_due(self, job: str, after: datetime) -> datetime:
+        """Ближайший плановый момент задачи строго после after"""
+        day = after.astimezone(SHIFT_TZ).date()
+        due = self._occurrence(job, day)
+        if due <= after:
+            due = self._occurrence(job, day + timedelta(days=1))
+        return due
+
+    def _last_due(self, job: str, now: datetime) -> datetime:
+        """Последний плановый момент задачи не позже now"""
+        day = now.astimezone(SHIFT_TZ).date()
+        due = self._occurrence(job, day)
+        if due > now:
+            due = self._occurrence(job, day - timedelta(days=1))
+        return due
+
+    def _is_fired(self, job: str, due: datetime) -> bool:
+        marker = self._markers.get(job)
+        return marker is not None and marker >= due.replace(tzinfo=None)
+
+    async def _mark_fired(self, job: str, due: datetime):
+        fired_for = due.astimezone(pytz.utc).replace(tzinfo=None)
+        marker = self._markers.get(job)
+        self._markers[job] = max(marker, fired_for) if marker else fired_for
+        await db.set_scheduler_marker(job, fired_for)
+
+    async def _claim(self, job: str, due: datetime) -> bool:
+        """Забирает срабатывание в БД; планировщик запущен в каждом процессе бота, рассылает только победитель"""
+        fired_for = due.astimezone(pytz.utc).replace(tzinfo=None)
+        claimed = await db.claim_scheduler_marker(job, fired_for)
+        marker = self._markers.get(job)
+        self._markers[job] = max(marker, fired_for) if marker else fired_for
+        return claimed
+
+    async def _fire(self, job: str, due: datetime):
+        due_local = due.astimezone(SHIFT_TZ).strftime('%d.%m.%Y %H:%M')
+        # /worktime мог выполниться в другом процессе: сверяем срабатывание с временем смены из БД,
+        # иначе процесс со старым расписанием разошлёт смену не вовремя
+        await self.update_shift_times()
+        if due != self._occurrence(job, due.astimezone(SHIFT_TZ).date()):
+            log_warning(f"[SCHEDULER] {job} за {due_local} (Bali) не совпадает с текущим временем смены, пересобираю расписание")
+            self._reschedule.set()
+            return
+        # Отметка ставится до рассылки: иначе несколько процессов разошлют одну смену.
+        # Цена — при падении посреди рассылки она не повторится после перезапуска
+        if not await self._claim(job, due):
+            log_system(f"[SCHEDULER] {job} за {due_local} (Bali) уже выполнен другим процессом, пропускаю")
+            return
+        log_system(f"[SCHEDULER] Выполняю {job} за {due_local} (Bali)")
+        if job == "shift_start":
+            await self.send_shift_start()
         else:
-            return end_time <= current_time_only <= start_time
+            await self.send_shift_end()
+
+    async def mark_fired_manually(self, job: str):
+        """
+        Принудительное открытие/закрытие смены: ближайший (прошедший или предстоящий)
+        плановый момент задачи считается выполненным, чтобы планировщик не повторил рассылку.
+        """
+        if not self.shift_start or not self.shift_end:
+            return
+        now = datetime.now(pytz.utc)
+        last_due = self._last_due(job, now)
+        next_due = self._next_due(job, now)
+        due = last_due if now - last_due <= next_due - now else next_due
+        await self._mark_fired(job, due)
+        log_system(f"[SCHEDULER] {job} выполнен вручную, отметка за {due.astimezone(SHIFT_TZ).strftime('%d.%m.%Y %H:%M')} (Bali)")
+
+    async def _catch_up(self, now: datetime):
+        """
+        Пропущенные срабатывания (бот был остановлен или цикл опоздал):
+        выполняется только последний наступивший переход смены; более ранний уже неактуален
+        (не объявляем открытие смены, которая успела закрыться) и только отмечается.
+        При первом запуске без отметок в БД рассылка не выполняется, отметки просто создаются.
+        """
+        last_dues = {job: self._last_due(job, now) for job in SHIFT_JOBS}
+        latest_job = max(SHIFT_JOBS, key=lambda job: last_dues[job])
+        for job in SHIFT_JOBS:
+            due = last_dues[job]
+            if self._is_fired(job, due):
+                continue
+            due_local = due.astimezone(SHIFT_TZ).strftime('%d.%m.%Y %H:%M')
+            if job not in self._markers:
+                log_system(f"[SCHEDULER] Нет отметки для {job}, считаю выполненным {due_local} (Bali)")
+                await self._mark_fired(job, due)
+            elif job == latest_job:
+                log_warning(f"[SCHEDULER] Пропущено срабатывание {job} за {due_local} (Bali), выполняю с опозданием")
+                await self._fire(job, due)
+            else:
+                log_warning(f"[SCHEDULER] Пропущено срабатывание {job} за {due_local} (Bali), неактуально — только отмечаю")
+                await self._mark_fired(job, due)
+
+    def _build_heap(self, now: datetime):
+        self._heap = [(self._next_due(job, now), job) for job in SHIFT_JOBS]
+        heapq.heapify(self._heap)
+        for due, job in sorted(self._heap):
+            log_system(f"[SCHEDULER] Следующее срабатывание {job}: {due.astimezone(SHIFT_TZ).strftime('%d.%m.%Y %H:%M')} (Bali)")
 
     async def scheduler_loop(self):
-        global night_shift
-        tz = pytz.timezone("Asia/Makassar")
+        """Спит до ближайшего планового момента из кучи вместо ежеминутного опроса"""
+        now = datetime.now(pytz.utc)
+        try:
+            await self._catch_up(now)
+        except Exception as e:
+            log_system(f"Ошибка при догоне пропущенных срабатываний: {e}", level=logging.ERROR)
+        self._build_heap(now)
         while self.is_running:
             try:
-                now = datetime.now(tz)
-                # log_system(f"[DEBUG] Текущее время: {now.strftime('%H:%M:%S')}")
-                
-                # Проверяем и обновляем статус ночной смены
-                is_night = self.is_night_shift(now)
-                if is_night != night_shift:
-                    night_shift = is_night
-                    log_system(f"Статус ночной смены изменен: {night_shift}")
-                
-                # Открытие смены
-                # Теперь shift_start и shift_end - это объекты time
-                start_hour = self.shift_start.hour
-                start_minute = self.shift_start.minute
-                # log_system(f"[DEBUG] Проверка начала смены: текущее время {now.hour}:{now.minute}, время начала {start_hour}:{start_minute}")
-                if now.hour == start_hour and now.minute == start_minute and not self.sent_start_today:
-                    log_system(f"[DEBUG] Условия для отправки сообщения о начале смены выполнены")
-                    try:
-                        await self.send_shift_start()
-                        self.sent_start_today = True
-                        self.sent_end_today = False
-                        log_system("Сообщение о начале смены успешно отправлено")
-                    except Exception as e:
-                        log_system(f"Ошибка при отправке сообщения о начале смены: {e}", level=logging.ERROR)
-                
-                # Закрытие смены
-                end_hour = self.shift_end.hour
-                end_minute = self.shift_end.minute
-                # log_system(f"[DEBUG] Проверка конца смены: текущее время {now.hour}:{now.minute}, время конца {end_hour}:{end_minute}")
-                if now.hour == end_hour and now.minute == end_minute and not self.sent_end_today:
-                    log_system(f"[DEBUG] Условия для отправки сообщения о конце смены выполнены")
+                due, job = self._heap[0]
+                delay = (due - datetime.now(pytz.utc)).total_seconds()
+                if delay > 0:
+                    # Сон ограничен SCHEDULER_MAX_SLEEP, чтобы сверяться с настенными часами
                     try:
-                        await self.send_shift_end()
-                        self.sent_end_today = True
-                        log_system("Сообщение о конце смены успешно отправлено")
-                    except Exception as e:
-                        log_system(f"Ошибка при отправке сообщения о конце смены: {e}", level=logging.ERROR)
-                
-                # Сброс флагов в полночь
-                if now.hour == 0 and now.minute == 0:
-                    self.sent_start_today = False
-                    self.sent_end_today = False
-                    log_system("Сброс флагов отправки сообщений")
-                
-                # Ждем до следующей минуты
-                await asyncio.sleep(60 - now.second)
-                
+                        await asyncio.wait_for(self._reschedule.wait(), timeout=min(delay, SCHEDULER_MAX_SLEEP))
+                    except asyncio.TimeoutError:
+                        pass
+                    if self._reschedule.is_set():
+                        self._reschedule.clear()
+                        self._build_heap(datetime.now(pytz.utc))
+                    continue
+
+                heapq.heapreplace(self._heap, (self._next_due(job, due), job))
+                if self._is_fired(job, due):
+                    log_system(f"[SCHEDULER] {job} уже выполнен вручную, пропускаю")
+                    continue
+                await self._fire(job, due)
             except Exception as e:
                 log_system(f"Ошибка в scheduler_loop: {e}", level=logging.ERROR)
                 await asyncio.sleep(60)  # В случае ошибки ждем минуту
 
+    async def reschedule(self):
+        """Перечитывает время смены (после /worktime) и пересобирает расписание"""
+        if await self.update_shift_times():
+            self._reschedule.set()
+
     async def start(self):
         """Запуск планировщика"""
         if not self.is_running:
             self.is_running = True
-            # Инициализируем время смены
-            await self.update_shift_times()
+            # Инициализируем время смены и отметки последних срабатываний
+            if not await self.update_shift_times():
+                self.is_running = False
+                log_system("Планировщик не запущен: не задано время смены", level=logging.ERROR)
+                return
+            self._markers = await db.get_scheduler_markers()
             # Запускаем основной цикл
-            asyncio.create_task(self.scheduler_loop())
+            self._task = asyncio.create_task(self.scheduler_loop())
             log_system("Планировщик запущен")
 
     def stop(self):
         """Остановка планировщика"""
         self.is_running = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
         log_system("Планировщик остановлен")
 
-    def reset_flags_and_night_shift(self):
-        self.sent_start_today = False
-        self.sent_end_today = False
-        tz = pytz.timezone("Asia/Makassar")
-        now = datetime.now(tz)
-        global night_shift
-        old_night_shift = night_shift
-        night_shift = self.is_night_shift(now)
-        log_system(f"[SCHEDULER] Флаги сброшены, night_shift={night_shift}")
-        if night_shift != old_night_shift:
-            log_system(f"Статус ночной смены изменен: {night_shift}")
-
 # Создаем глобальный экземпляр планировщика
 scheduler = None
 
@@ -347,4 +406,8 @@ def init_scheduler(bot: Bot):
     """Инициализация планировщика"""
     global scheduler
     scheduler = Scheduler(bot)
-    return scheduler 
\ No newline at end of file
+    return scheduler
+
+def get_scheduler():
+    """Текущий экземпляр планировщика (None до init_scheduler)"""
+    return scheduler
@@ -0,0 +1,166 @@
+"""
+🟤 Состояние смены (день/ночь)
+==============================
+Единый источник ответа «сейчас ночная смена?» для приёма заявок и планировщика.
+Моменты ближайших открытия и закрытия смены вычисляются один раз при изменении настроек
+(загрузка system_settings, /worktime) и при принудительном открытии/закрытии смены,
+а проверка is_night() — это одно сравнение с моментом следующего перехода.
+Бот может работать в нескольких процессах, поэтому время смены и принудительный режим
+хранятся в system_settings и перечитываются не реже раза в SHIFT_STATE_TTL секунд.
+"""
+import asyncio
+import json
+import time as time_module
+from datetime import datetime, time, timedelta
+from typing import Optional, Tuple, Union
+
+import pytz
+
+from db import db
+from logger import log_system, log_error
+from time_utils import BALI_TZ
+
+SHIFT_TZ = BALI_TZ
+# Как часто перечитывать время смены и принудительный режим из БД, сек
+SHIFT_STATE_TTL = 15
+# Ключ system_settings с принудительным открытием/закрытием смены
+SHIFT_FORCE_KEY = "shift_force"
+
+
+def parse_shift_time(value: Union[str, time, None]) -> Optional[time]:
+    """Время смены из настроек: объект time или строка HH:MM[:SS]"""
+    if value is None or isinstance(value, time):
+        return value
+    try:
+        return datetime.strptime(value, '%H:%M:%S').time()
+    except ValueError:
+        return datetime.strptime(value, '%H:%M').time()
+
+
+class ShiftState:
+
+    def __init__(self, ttl: float = SHIFT_STATE_TTL):
+        self.ttl = ttl
+        self.shift_start: Optional[time] = None
+        self.shift_end: Optional[time] = None
+        self._is_night = False
+        self._next_change = 0.0         # момент следующего перехода, unix time
+        # Принудительный режим (ночь?, до какого момента unix time), действует только для своего времени смены
+        self._forced: Optional[Tuple[bool, float]] = None
+        self._forced_shift: Optional[str] = None
+        self._loaded_at = float('-inf')
+        self._lock = asyncio.Lock()
+
+    def configure(self, shift_start, shift_end):
+        """Устанавливает время смены; при неизменном времени состояние (в т.ч. принудительное) сохраняется"""
+        start, end = parse_shift_time(shift_start), parse_shift_time(shift_end)
+        if start == self.shift_start and end == self.shift_end:
+            return
+        self.shift_start, self.shift_end = start, end
+        self._recompute()
+        log_system(f"[SHIFT_STATE] Время смены {start}-{end}, ночная смена: {self._is_night}")
+
+    def _next_occurrence(self, moment: time, now: datetime) -> datetime:
+        """Ближайший момент moment по балийскому времени строго после now"""
+        local_now = now.astimezone(SHIFT_TZ)
+        due = SHIFT_TZ.localize(datetime.combine(local_now.date(), moment))
+        if due <= local_now:
+            due = SHIFT_TZ.localize(datetime.combine(local_now.date() + timedelta(days=1), moment))
+        return due
+
+    def _shift_key(self) -> str:
+        return f"{self.shift_start}-{self.shift_end}"
+
+    def _recompute(self):
+        """Состояние по расписанию (ночь, если следующим наступит открытие смены) или принудительное"""
+        if self._forced and self._forced_shift == self._shift_key() and self._forced[1] > time_module.time():
+            self._is_night, self._next_change = self._forced
+            return
+        if not self.shift_start or not self.shift_end:
+            self._is_night = False
+            self._next_change = float('inf')
+            return
+        now = datetime.now(pytz.utc)
+        next_open = self._next_occurrence(self.shift_start, now)
+        next_close = self._next_occurrence(self.shift_end, now)
+        self._is_night = next_open < next_close
+        self._next_change = min(next_open, next_close).timestamp()
+
+    def _is_fresh(self) -> bool:
+        return time_module.monotonic() - self._loaded_at <= self.ttl
+
+    async def refresh(self):
+        """Перечитывает время смены и принудительный режим из БД, если кэш устарел"""
+        if self._is_fresh():
+            return
+        async with self._lock:
+            if not self._is_fresh():
+                await self._load()
+
+    async def _load(self) -> bool:
+        try:
+            settings = await db.get_all_system_settings()
+        except Exception as e:
+            log_error(f"ShiftState: ошибка загрузки настроек смены: {e}")
+            return False
+        if settings is None:
+            return False
+        forced, forced_shift = None, None
+        raw = settings.get(SHIFT_FORCE_KEY)
+        if raw:
+            try:
+                data = json.loads(raw)
+                forced, forced_shift = (bool(data['is_night']), float(data['until'])), data['shift']
+            except (ValueError, TypeError, KeyError) as e:
+                log_error(f"ShiftState: некорректное значение {SHIFT_FORCE_KEY}={raw!r}: {e}")
+        self._loaded_at = time_module.monotonic()
+        forced_changed = (forced, forced_shift) != (self._forced, self._forced_shift)
+        self._forced, self._forced_shift = forced, forced_shift
+        start = parse_shift_time(settings.get('shift_start_time'))
+        end = parse_shift_time(settings.get('shift_end_time'))
+        if start and end and (start, end) != (self.shift_start, self.shift_end):
+            self.configure(start, end)
+        elif forced_changed:
+            self._recompute()
+            log_system(f"[SHIFT_STATE] Принудительный режим смены обновлён из БД, ночная смена: {self._is_night}")
+        return True
+
+    async def is_night(self) -> bool:
+        """Ночная смена сейчас? Пересчёт — только после наступления очередного перехода"""
+        await self.refresh()
+        if time_module.time() >= self._next_change:
+            was_night = self._is_night
+            self._recompute()
+            if was_night != self._is_night:
+                log_system(f"Статус ночной смены изменен: {self._is_night}")
+        return self._is_night
+
+    def hours(self) -> Tuple[str, str]:
+        """Время открытия и закрытия смены в виде HH:MM для сообщений"""
+        start = self.shift_start.strftime('%H:%M') if self.shift_start else ''
+        end = self.shift_end.strftime('%H:%M') if self.shift_end else ''
+        return start, end
+
+    async def force_open(self):
+        """Принудительное открытие: дневной режим до ближайшего планового закрытия"""
+        await self._force(is_night=False, until=self.shift_end, kind="open")
+
+    async def force_close(self):
+        """Принудительное закрытие: ночной режим до ближайшего планового открытия"""
+        await self._force(is_night=True, until=self.shift_start, kind="close")
+
+    async def _force(self, is_night: bool, until: Optional[time], kind: str):
+        if until is None:
+            return
+        until_ts = self._next_occurrence(until, datetime.now(pytz.utc)).timestamp()
+        self._forced, self._forced_shift = (is_night, until_ts), self._shift_key()
+        self._recompute()
+        # Остальные процессы подхватят режим при очередном refresh()
+        await db.set_system_setting(SHIFT_FORCE_KEY, json.dumps({
+            "is_night": is_night, "until": until_ts, "shift": self._forced_shift
+        }))
+        log_system(f"[SHIFT_STATE] Смена принудительно: {kind}, ночная смена: {is_night} до {until}")
+
+
+# Глобальное состояние смены
+shift_state = ShiftState()
@@ -1,5 +1,6 @@
 import asyncio
 from bybit_p2p import get_p2p_idr_usdt_avg_rate
+from http_client import http_clients
 
 async def main():
     try:
@@ -7,6 +8,8 @@ async def main():
         print(f"Средний курс P2P Bybit (3-10 заявки): {avg}")
     except Exception as e:
         print(f"Ошибка: {e}")
+    finally:
+        await http_clients.close()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Тест замков смены статуса заявки (order_locks.OrderLocks.claim)
+"""
+import unittest
+
+from order_locks import OrderLocks
+
+
+class OrderLocksClaimTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_second_claim_is_rejected(self):
+        locks = OrderLocks()
+        async with locks.claim("1502MBT001") as first:
+            self.assertTrue(first)
+            async with locks.claim("1502MBT001") as second:
+                self.assertFalse(second)
+            # Другая заявка захватывается независимо
+            async with locks.claim("1502MBT002") as other:
+                self.assertTrue(other)
+
+    async def test_released_after_block(self):
+        locks = OrderLocks()
+        async with locks.claim("1502MBT001") as claimed:
+            self.assertTrue(claimed)
+        async with locks.claim("1502MBT001") as claimed:
+            self.assertTrue(claimed)
+
+    async def test_released_on_error(self):
+        locks = OrderLocks()
+        with self.assertRaises(RuntimeError):
+            async with locks.claim("1502MBT001"):
+                raise RuntimeError("ошибка обработки")
+        async with locks.claim("1502MBT001") as claimed:
+            self.assertTrue(claimed)
+
+    async def test_rejected_claim_keeps_lock(self):
+        locks = OrderLocks()
+        async with locks.claim("1502MBT001"):
+            async with locks.claim("1502MBT001") as second:
+                self.assertFalse(second)
+            # Выход из отклонённого захвата не снимает чужой замок
+            async with locks.claim("1502MBT001") as third:
+                self.assertFalse(third)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Тест разбора сумм и итогов отчёта /report_vsep (report_engine)
+"""
+import unittest
+from decimal import Decimal
+
+from report_engine import parse_amount, build_vsep_report
+
+
+class ParseAmountTest(unittest.TestCase):
+
+    def test_thousands_separators(self):
+        self.assertEqual(parse_amount("1.234.567"), Decimal("1234567"))
+        self.assertEqual(parse_amount("1 234 567,89 IDR", "IDR"), Decimal("1234567.89"))
+        self.assertEqual(parse_amount("1 234 567"), Decimal("1234567"))
+
+    def test_decimal_separator(self):
+        self.assertEqual(parse_amount("1,234.56"), Decimal("1234.56"))
+        self.assertEqual(parse_amount("Rp 2.000.000,50"), Decimal("2000000.50"))
+        self.assertEqual(parse_amount("12,5 USDT", "USDT"), Decimal("12.5"))
+
+    def test_empty_cell(self):
+        self.assertEqual(parse_amount(""), Decimal("0"))
+        self.assertEqual(parse_amount(None), Decimal("0"))
+        self.assertEqual(parse_amount("-"), Decimal("0"))
+
+
+class BuildVsepReportTest(unittest.TestCase):
+
+    def row(self, project, turnover, commission, currency="", commission_currency=""):
+        return {
+            'project': project, 'count': 1, 'commission_percent': '1%',
+            'turnover': turnover, 'commission': commission,
+            'currency': currency, 'commission_currency': commission_currency,
+        }
+
+    def test_default_currency_by_project(self):
+        report = build_vsep_report("01.2025", [
+            self.row("MBT", "1.000.000", "10 000"),
+            self.row("SAL_Shop", "150,50", "1,5"),
+        ])
+        self.assertEqual(list(report.projects['currency']), ['IDR', 'USDT'])
+        self.assertEqual(report.turnover_totals, {'IDR': Decimal("1000000"), 'USDT': Decimal("150.50")})
+        self.assertEqual(report.commission_totals, {'IDR': Decimal("10000"), 'USDT': Decimal("1.5")})
+
+    def test_totals_by_currency(self):
+        report = build_vsep_report("01.2025", [
+            self.row("MBT", "1.000.000 IDR", "10 000 IDR", "IDR", "IDR"),
+            self.row("LGI", "2.500.000 IDR", "25 000 IDR", "IDR", "IDR"),
+        ])
+        self.assertEqual(report.turnover_totals, {'IDR': Decimal("3500000")})
+        usdt = report.usdt_totals([Decimal("16000")]).iloc[0]
+        self.assertEqual(usdt['commission_usdt'], Decimal("35000") / Decimal("16000"))
+
+    def test_empty_report(self):
+        report = build_vsep_report("01.2025", [])
+        self.assertTrue(report.projects.empty)
+        self.assertEqual(report.turnover_totals, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
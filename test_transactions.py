@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Тест компактного кода заявки (transactions.encode_tx_id / decode_tx_code)
+"""
+import unittest
+
+from transactions import encode_tx_id, decode_tx_code
+
+
+class TxCodeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for tx_id in (0, 1, 35, 36, 1295, 123456, 2 ** 40):
+            code = encode_tx_id(tx_id)
+            self.assertTrue(code.startswith("T"))
+            self.assertEqual(decode_tx_code(code), tx_id)
+
+    def test_known_code(self):
+        self.assertEqual(encode_tx_id(36), "T10")
+        self.assertEqual(decode_tx_code(" t10 "), 36)
+
+    def test_not_a_code(self):
+        self.assertEqual(encode_tx_id(None), "")
+        self.assertIsNone(decode_tx_code(""))
+        self.assertIsNone(decode_tx_code("T"))
+        self.assertIsNone(decode_tx_code("1502MBT001"))
+        self.assertIsNone(decode_tx_code("T-1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,28 +1,90 @@
+"""
+🟢 Часы бота: время по Бали, Москве и UTC
+=========================================
+Часовые пояса создаются один раз при импорте. Строки форматируются только по запросу
+и кэшируются до смены секунды (поля с секундами) или минуты (поля HH:MM),
+поэтому частые вызовы из обработчиков сообщений не повторяют strftime.
+"""
+import time
 from datetime import datetime, timezone
+
 import pytz
 
-# def get_bali_and_msk_time_list():
-#     """Вернуть список из 8 вариантов времени: 
-#     UTC (дата+время), UTC (только время), Бали (дата+время), Бали (только время), МСК (дата+время), МСК (только время), Бали (дата+время), МСК (дата+время)
-#     """
-#     now_utc = datetime.utcnow()
-#     bali_tz = pytz.timezone("Asia/Makassar")
-#     msk_tz = pytz.timezone("Europe/Moscow")
-#     now_utc_long = now_utc.strftime("%d.%m.%Y %H:%M:%S")
-#     now_utc_short = now_utc.strftime("%H:%M")
-#     now_bali = now_utc.astimezone(bali_tz).strftime("%d.%m.%Y %H:%M:%S")
-#     now_bali_long = now_utc.astimezone(bali_tz).strftime("%d.%m.%Y %H:%M")
-#     now_bali_short = now_utc.astimezone(bali_tz).strftime("%H:%M")
-#     now_msk = now_utc.astimezone(msk_tz).strftime("%d.%m.%Y %H:%M:%S")
-#     now_msk_short = now_utc.astimezone(msk_tz).strftime("%H:%M")
-#     now_msk_long = now_utc.astimezone(msk_tz).strftime("%d.%m.%Y %H:%M")
-#     return [
-#         now_utc_long,      # 0: UTC дата+время
-#         now_utc_short,     # 1: UTC только время
-#         now_bali,          # 2: Бали дата+время часы:минуты:секунды
-#         now_bali_short,    # 3: Бали только время часы:минуты
-#         now_msk,           # 4: МСК дата+времячасы:минуты:секунды
-#         now_msk_short,     # 5: МСК только время часы:минуты
-#         now_bali_long,     # 6: Бали дата+время часы:минуты
-#         now_msk_long,      # 7: МСК дата+время часы:минуты
-#     ]
\ No newline at end of file
+UTC_TZ = timezone.utc
+BALI_TZ = pytz.timezone("Asia/Makassar")
+MSK_TZ = pytz.timezone("Europe/Moscow")
+
+FMT_DATETIME_FULL = "%d.%m.%Y %H:%M:%S"
+FMT_DATETIME = "%d.%m.%Y %H:%M"
+FMT_TIME = "%H:%M"
+
+
+class Clock:
+
+    def __init__(self):
+        # {(id пояса, формат): (номер секунды/минуты, строка)}
+        self._cache = {}
+
+    def _format(self, tz, fmt: str, resolution: int) -> str:
+        now = int(time.time())
+        bucket = now // resolution
+        key = (id(tz), fmt)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == bucket:
+            return cached[1]
+        value = datetime.fromtimestamp(now, tz).strftime(fmt)
+        self._cache[key] = (bucket, value)
+        return value
+
+    # --- Текущий момент ---
+    def now_utc(self) -> datetime:
+        return datetime.now(UTC_TZ)
+
+    def now_bali(self) -> datetime:
+        return datetime.now(BALI_TZ)
+
+    def now_msk(self) -> datetime:
+        return datetime.now(MSK_TZ)
+
+    # --- UTC ---
+    def utc_datetime_full(self) -> str:
+        """UTC дата+время часы:минуты:секунды"""
+        return self._format(UTC_TZ, FMT_DATETIME_FULL, 1)
+
+    def utc_time(self) -> str:
+        """UTC только время часы:минуты"""
+        return self._format(UTC_TZ, FMT_TIME, 60)
+
+    # --- Бали ---
+    def bali_datetime_full(self) -> str:
+        """Бали дата+время часы:минуты:секунды"""
+        return self._format(BALI_TZ, FMT_DATETIME_FULL, 1)
+
+    def bali_datetime(self) -> str:
+        """Бали дата+время часы:минуты"""
+        return self._format(BALI_TZ, FMT_DATETIME, 60)
+
+    def bali_time(self) -> str:
+        """Бали только время часы:минуты"""
+        return self._format(BALI_TZ, FMT_TIME, 60)
+
+    # --- Москва ---
+    def msk_datetime_full(self) -> str:
+        """МСК дата+время часы:минуты:секунды"""
+        return self._format(MSK_TZ, FMT_DATETIME_FULL, 1)
+
+    def msk_datetime(self) -> str:
+        """МСК дата+время часы:минуты"""
+        return self._format(MSK_TZ, FMT_DATETIME, 60)
+
+    def msk_time(self) -> str:
+        """МСК только время часы:минуты"""
+        return self._format(MSK_TZ, FMT_TIME, 60)
+
+    def bali_msk_str(self) -> str:
+        """Строка вида "дд.мм.гггг чч:мм (Bali) / чч:мм (MSK)" для сообщений и логов"""
+        return f"{self.bali_datetime()} (Bali) / {self.msk_time()} (MSK)"
+
+
+# Глобальные часы бота
+clock = Clock()
@@ -1,2 +1,114 @@
 # transactions.py
-# TODO: Вынести сюда работу с транзакциями (создание, обновление, выборка) из handlers.py и db.py 
\ No newline at end of file
+# TODO: Вынести сюда работу с транзакциями (создание, обновление, выборка) из handlers.py и db.py
+"""
+История заявок: типизированное событие из таблицы "VSEPExchanger"."transaction_event"
+и общее форматирование хронологии для /order_show и /order_change.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+BALI_TZ = timezone(timedelta(hours=8))
+
+# Компактный код заявки: "T" + tx_id в base36 (номера заявок начинаются с цифры дня, пересечений нет)
+TX_CODE_PREFIX = "T"
+TX_CODE_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def encode_tx_id(tx_id: int) -> str:
+    """tx_id из последовательности -> короткий код вида T2N9"""
+    if tx_id is None:
+        return ""
+    digits = []
+    value = int(tx_id)
+    while True:
+        value, rem = divmod(value, 36)
+        digits.append(TX_CODE_ALPHABET[rem])
+        if not value:
+            break
+    return TX_CODE_PREFIX + "".join(reversed(digits))
+
+
+def decode_tx_code(code: str) -> Optional[int]:
+    """Короткий код T2N9 -> tx_id; None, если строка — не код (например, обычный номер заявки)"""
+    if not code:
+        return None
+    code = code.strip().upper()
+    digits = code[len(TX_CODE_PREFIX):]
+    # int(..., 36) принимает знак и "_", поэтому символы проверяются по алфавиту кода
+    if not code.startswith(TX_CODE_PREFIX) or not digits or any(ch not in TX_CODE_ALPHABET for ch in digits):
+        return None
+    return int(digits, 36)
+
+
+@dataclass(frozen=True)
+class TransactionEvent:
+    """Одно событие в истории заявки (время в UTC без зоны, как в остальных колонках transactions)"""
+    transaction_number: str
+    event_at: Optional[datetime]
+    actor: Optional[str]
+    status: Optional[str]
+    link: Optional[str]
+    raw: Optional[str] = None
+    id: Optional[int] = None
+
+    @classmethod
+    def from_row(cls, row) -> "TransactionEvent":
+        return cls(
+            transaction_number=row['transaction_number'],
+            event_at=row['event_at'],
+            actor=row['actor'],
+            status=row['status'],
+            link=row['link'],
+            raw=row['raw'],
+            id=row['id'],
+        )
+
+    def to_legacy(self) -> str:
+        """Запись в старом формате "dt$user$status$link" — для столбца истории в Google Sheets"""
+        if self.raw is not None:
+            return self.raw
+        dt_str = self.event_at.strftime("%Y-%m-%d %H:%M:%S") if self.event_at else "unknown"
+        return f"{dt_str}${self.actor}${self.status}${self.link}"
+
+
+def history_to_legacy(events: Iterable[TransactionEvent]) -> str:
+    """Склеивает события в строку "%%%" для выгрузки в Google Sheets"""
+    return "%%%".join(event.to_legacy() for event in events)
+
+
+def format_history_lines(events: List[TransactionEvent], status_names: Optional[Dict[str, str]] = None) -> List[str]:
+    """
+    Хронология заявки: первая строка с датой, далее — разница во времени с предыдущим событием.
+    status_names — отображаемые названия статусов (по умолчанию статус выводится как есть).
+    """
+    status_names = status_names or {}
+    hist_lines = []
+    prev_time = None
+    for idx, event in enumerate(events):
+        if event.raw is not None:
+            # Нераспознанная запись старого формата
+            if idx == 0 and event.raw.strip():
+                hist_lines.append(f"{event.raw.strip()} (создано)")
+            continue
+        dt = event.event_at
+        dt_bali = dt.replace(tzinfo=timezone.utc).astimezone(BALI_TZ) if dt else None
+        status_disp = status_names.get(event.status, event.status)
+        time_str = dt_bali.strftime("%H:%M") if dt_bali else "--:--"
+        if idx == 0:
+            # Первая строка — дата дд.мм.гг
+            date_str = dt_bali.strftime("%d.%m.%y") if dt_bali else "--.--.--"
+            hist_lines.append(f"{date_str} {status_disp}: {time_str} {event.actor} (<a href='{event.link}'>link</a>)")
+        else:
+            # Разница во времени с предыдущим статусом
+            if prev_time and dt:
+                total_seconds = int((dt - prev_time).total_seconds())
+                hours = total_seconds // 3600
+                minutes = (total_seconds % 3600) // 60
+                seconds = total_seconds % 60
+                delta_str = f"+{hours:02}:{minutes:02}:{seconds:02}"
+            else:
+                delta_str = "+--:--:--"
+            hist_lines.append(f"{delta_str} {status_disp}: {time_str} {event.actor} (<a href='{event.link}'>link</a>)")
+        prev_time = dt
+    return hist_lines
@@ -0,0 +1,90 @@
+"""
+🟤 Отложенное сохранение пользователей
+======================================
+UserSaveMiddleware кладёт пары (user_id, nickname) в буфер, не дожидаясь БД.
+Новые пары (в том числе сменившийся ник) сбрасываются в БД пачкой раз в USER_FLUSH_INTERVAL секунд
+или сразу при накоплении USER_FLUSH_BATCH записей. При остановке бота буфер дописывается.
+"""
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+
+from db import db
+from logger import log_system, log_error
+
+USER_FLUSH_INTERVAL = 5
+USER_FLUSH_BATCH = 100
+# Ограничение памяти на множество уже сохранённых пар
+USER_SEEN_LIMIT = 50000
+
+
+class UserSaveBuffer:
+
+    def __init__(self, interval: float = USER_FLUSH_INTERVAL, batch_size: int = USER_FLUSH_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._seen: Set[Tuple[int, str]] = set()
+        self._pending: Dict[int, str] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    def add(self, user_id: int, nickname: str):
+        """Запоминает пользователя; не блокирует обработку сообщения"""
+        key = (user_id, nickname)
+        if key in self._seen:
+            return
+        self._pending[user_id] = nickname
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Записывает накопленных пользователей одним executemany"""
+        if not self._pending:
+            return
+        batch = list(self._pending.items())
+        self._pending = {}
+        try:
+            await db.add_users_if_not_exist(batch)
+        except Exception as e:
+            log_error(f"UserSaveBuffer: ошибка сохранения {len(batch)} пользователей: {e}")
+            # Возвращаем в очередь, не затирая более свежие ники
+            for user_id, nickname in batch:
+                self._pending.setdefault(user_id, nickname)
+            return
+        if len(self._seen) > USER_SEEN_LIMIT:
+            self._seen.clear()
+        self._seen.update(batch)
+
+    async def _loop(self):
+        while self._running:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._running = True
+            self._task = asyncio.create_task(self._loop())
+            log_system("UserSaveBuffer: фоновое сохранение пользователей запущено")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает остаток буфера"""
+        self._running = False
+        if self._task is not None:
+            self._wakeup.set()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                log_error(f"UserSaveBuffer: ошибка при остановке: {e}")
+            self._task = None
+        await self.flush()
+        log_system("UserSaveBuffer: буфер пользователей сброшен")
+
+
+# Глобальный буфер сохранения пользователей
+user_buffer = UserSaveBuffer()
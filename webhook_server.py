@@ -0,0 +1,161 @@
+"""
+🟤 Приём обновлений через webhook
+=================================
+Режим VSEP_BOT_MODE=webhook: Telegram присылает обновления POST-запросами на aiohttp-сервер.
+Запрос проверяется по секрету X-Telegram-Bot-Api-Secret-Token, обновление сразу подтверждается
+и передаётся в dp.feed_update отдельной задачей; порядок внутри чата и общий предел параллельности
+обеспечивает chat_lanes. Незавершённых обновлений не больше WEBHOOK_PENDING_LIMIT, сверх этого
+отвечаем 503 — Telegram повторит доставку позже.
+По SIGTERM (перезапуск дайно Heroku) сервер перестаёт принимать обновления и дорабатывает принятые.
+GET /health — счётчики и очереди чатов.
+
+Для локальной проверки обновления можно подать без сети: server.feed_raw(update_json)
+или через aiohttp TestClient поверх server.build_app().
+"""
+import asyncio
+import hashlib
+import hmac
+import signal
+import time
+from typing import Any, Dict, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from chat_lanes import chat_lanes
+from config import config
+from logger import log_system, log_error, log_warning
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_DRAIN_TIMEOUT = 20       # сколько дорабатывать принятые обновления после SIGTERM (Heroku ждёт 30 с), сек
+
+
+def webhook_secret() -> str:
+    """Секрет webhook: из настроек или детерминированно из токена (одинаковый на всех дайно)"""
+    if config.WEBHOOK_SECRET:
+        return config.WEBHOOK_SECRET
+    token = config.BOT_TOKEN.get_secret_value()
+    return hashlib.sha256(f"vsep-webhook:{token}".encode()).hexdigest()
+
+
+class WebhookServer:
+
+    def __init__(self, dp: Dispatcher, bot: Bot, pending_limit: int = 1000, **workflow_data: Any):
+        self.dp = dp
+        self.bot = bot
+        self.pending_limit = pending_limit
+        # Доп. аргументы обработчиков, как в dp.start_polling(bot, scheduler=...)
+        self.workflow_data = workflow_data
+        self.secret = webhook_secret()
+        self.draining = False
+        self.started_at = time.time()
+        self.stats = {"accepted": 0, "processed": 0, "failed": 0, "rejected": 0}
+        # Принятые, но ещё не обработанные обновления
+        self._pending: Set[asyncio.Task] = set()
+        self._stop = asyncio.Event()
+
+    # --- HTTP ---
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(config.WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            log_warning(f"Webhook: запрос с неверным секретом от {request.remote}")
+            return web.Response(status=401)
+        if self.draining:
+            return web.Response(status=503)
+        try:
+            accepted = self.feed_raw(await request.json())
+        except ValueError as e:
+            # Некорректный JSON или обновление, не прошедшее валидацию aiogram
+            log_warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+        return web.Response() if accepted else web.Response(status=503)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "draining" if self.draining else "ok",
+            "pending": len(self._pending),
+            "pending_limit": self.pending_limit,
+            "uptime": int(time.time() - self.started_at),
+            **self.stats,
+            "chat_lanes": chat_lanes.snapshot(),
+        })
+
+    # --- Обработка ---
+    def feed_raw(self, data: Dict[str, Any]) -> bool:
+        """Принимает JSON обновления в обработку; False — превышен лимит или сервер останавливается"""
+        if self.draining:
+            return False
+        update = Update.model_validate(data, context={"bot": self.bot})
+        if len(self._pending) >= self.pending_limit:
+            self.stats["rejected"] += 1
+            log_warning(f"Webhook: незавершённых обновлений {len(self._pending)}, обновление {update.update_id} отклонено")
+            return False
+        task = asyncio.create_task(self._process(update))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        self.stats["accepted"] += 1
+        return True
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update, **self.workflow_data)
+            self.stats["processed"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            log_error(f"Webhook: ошибка обработки обновления {update.update_id}: {e}")
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Перестаёт принимать обновления и ждёт завершения принятых (не дольше timeout)"""
+        self.draining = True
+        if not self._pending:
+            return
+        _, pending = await asyncio.wait(set(self._pending), timeout=timeout)
+        if pending:
+            log_warning(f"Webhook: за {timeout} с не обработано обновлений: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    # --- Запуск ---
+    def stop(self):
+        self._stop.set()
+
+    async def run(self):
+        """Регистрирует webhook, обслуживает запросы до SIGTERM/SIGINT и корректно останавливается"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                # Windows: сигналы через event loop не поддерживаются
+                pass
+
+        await self.dp.emit_startup(bot=self.bot, **self.workflow_data)
+        runner = web.AppRunner(self.build_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT)
+        await site.start()
+        log_system(f"Webhook: сервер слушает {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+
+        webhook_url = f"{config.WEBHOOK_BASE_URL.rstrip('/')}{config.WEBHOOK_PATH}"
+        await self.bot.set_webhook(
+            webhook_url,
+            secret_token=self.secret,
+            allowed_updates=self.dp.resolve_used_update_types(),
+        )
+        log_system(f"Webhook: зарегистрирован {webhook_url}")
+
+        try:
+            await self._stop.wait()
+        finally:
+            log_system("Webhook: остановка, дорабатываем принятые обновления...")
+            await self.drain()
+            await runner.cleanup()
+            await self.dp.emit_shutdown(bot=self.bot, **self.workflow_data)
+            log_system(f"Webhook: сервер остановлен, обработано обновлений: {self.stats['processed']}")